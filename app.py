@@ -1,90 +1,435 @@
+import hashlib
 import json
+import mimetypes
 import sys
 import sqlite3
 import os
+import queue
+import re
 import string
+import threading
 import random
+import time
 import traceback
-from flask import Flask, render_template, request, redirect, url_for, g, flash, session
-from flask_socketio import SocketIO, emit
-
-app = Flask(__name__)
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import Flask, render_template, request, redirect, url_for, g, flash, session, send_from_directory, stream_template, abort, has_app_context, has_request_context
+from flask.sessions import SecureCookieSessionInterface
+from flask_socketio import SocketIO, join_room
+from scoring import score_round, LEADER_GUESSED_BY_ALL
+from image_variants import variant_path
+from static_assets import file_fingerprint, pick_precompressed
+
+class GameFlask(Flask):
+    """Flask, у которого эндпоинт static отдает файлы через send_static_asset (отпечатки в URL, заранее сжатые копии)."""
+    def send_static_file(self, filename): return send_static_asset(filename)
+
+app = GameFlask(__name__)
 # ВАЖНО: Убедитесь, что этот ключ ИДЕНТИЧЕН тому, что был в работающей версии
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your_very_secret_fallback_key_for_dev_only_12345') 
 if app.config['SECRET_KEY'] == 'your_very_secret_fallback_key_for_dev_only_12345':
     print("ПРЕДУПРЕЖДЕНИЕ: Используется SECRET_KEY по умолчанию. Установите переменную окружения SECRET_KEY!", file=sys.stderr)
 
-socketio = SocketIO(app)
-DB_PATH = 'database.db'
+# Очередь сообщений Socket.IO (например redis://localhost:6379/0): emit из любого воркера доходит до клиентов всех воркеров.
+# Без нее приложение работает в одном процессе, как раньше.
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or None
+SOCKET_REGISTRY_PREFIX = os.environ.get('SOCKET_REGISTRY_PREFIX', 'hello-flask:')  # Префикс ключей общего реестра в redis
+SOCKET_REGISTRY_TTL = int(os.environ.get('SOCKET_REGISTRY_TTL', 60))  # Воркер без отметки дольше - упал или перезапущен, его sid убираются из реестра
+SOCKETIO_ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE') or None  # eventlet/gevent/threading; без значения Flask-SocketIO выбирает сам (eventlet, если установлен)
+socketio = SocketIO(app, message_queue=SOCKETIO_MESSAGE_QUEUE, async_mode=SOCKETIO_ASYNC_MODE)
+DB_PATH = 'database.db'  # БД основного стола; у остальных столов - database-<стол>.db рядом
+# Столы: основной (URL без префикса) и перечисленные через запятую в GAME_TABLES (URL /t/<стол>/...). У каждого стола
+# свой файл БД (своя копия каталога колод, игроки, поле, ведущий), свои кэши, раунд в памяти, комнаты Socket.IO и рассылка.
+# Закрепление стола за процессом - на балансировщике перед несколькими экземплярами приложения, например в nginx:
+#   map $uri $game_table { ~^/t/([a-z0-9_-]+)/ $1; default $arg_table; }  # сокеты передают стол в ?table=
+#   upstream game { hash $game_table consistent; server 127.0.0.1:8001; server 127.0.0.1:8002; }
+# Тогда раунд, кэши и рассылки стола живут в одном процессе; без закрепления все тоже работает, только с перечитыванием.
+TABLE_SLUG_RE = re.compile(r'^[a-z0-9][a-z0-9_-]{0,31}$')
+TABLE_PATH_RE = re.compile(r'^/t/([^/]+)/')
+_game_table_slugs = [part.strip().lower() for part in os.environ.get('GAME_TABLES', '').split(',') if part.strip()]
+for slug in _game_table_slugs:
+    if not TABLE_SLUG_RE.match(slug): print(f"ПРЕДУПРЕЖДЕНИЕ: Стол '{slug}' из GAME_TABLES пропущен - имя должно состоять из a-z, 0-9, '_' и '-' (до 32 символов, первый - буква или цифра).", file=sys.stderr)
+GAME_TABLES = ('',) + tuple(dict.fromkeys(slug for slug in _game_table_slugs if TABLE_SLUG_RE.match(slug)))
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))  # Сколько простаивающих соединений держит процесс
+DB_PRAGMAS = ("PRAGMA journal_mode = WAL", "PRAGMA synchronous = NORMAL", "PRAGMA cache_size = -8192",
+              "PRAGMA mmap_size = 67108864", "PRAGMA temp_store = MEMORY", "PRAGMA foreign_keys = OFF")
+# Учет SQL: число, время и самые долгие запросы на HTTP-запрос, действие по сокету и рассылку (в режиме debug - в заголовках ответа)
+SQL_INSTRUMENTATION = os.environ.get('SQL_INSTRUMENTATION', 'True').lower() in ['true', '1', 't']
+SQL_SLOW_QUERY_MS = float(os.environ.get('SQL_SLOW_QUERY_MS', 50))  # Запрос дольше (execute и выборка строк) - в лог с текстом (0 - не писать)
+SQL_WARN_QUERIES = int(os.environ.get('SQL_WARN_QUERIES', 40))  # Больше запросов на запрос/рассылку - сводка в лог
+SQL_WARN_REPEATS = int(os.environ.get('SQL_WARN_REPEATS', 10))  # Один и тот же запрос столько раз за единицу (всего, не подряд) - похоже на N+1
 
 GAME_BOARD_POLE_IMG_SUBFOLDER = "pole"
 GAME_BOARD_POLE_IMAGES = [f"p{i}.jpg" for i in range(1, 8)]
 DEFAULT_NUM_BOARD_CELLS = 40
-_current_game_board_pole_image_config = []
-_current_game_board_num_cells = 0
 
-connected_users_socketio = {}  # {sid: user_code}
+# Состояние карты (images.state); владелец хранится отдельно в images.owner_id
+CARD_STATE_FREE = 'free'        # в колоде ('Свободно')
+CARD_STATE_HAND = 'hand'        # на руке у owner_id ('Занято:<id>')
+CARD_STATE_TABLE = 'table'      # на столе от owner_id ('На столе:<id>')
+CARD_STATE_DISCARD = 'discard'  # вне игры, owner_id = NULL ('Занято:Админ')
+CARD_STATE_LABELS = {CARD_STATE_FREE: 'Свободно', CARD_STATE_HAND: 'Занято', CARD_STATE_TABLE: 'На столе', CARD_STATE_DISCARD: 'Занято:Админ'}
+
+# Журнал событий игры (game_events, только дописывается) и снимки состояния (game_snapshots)
+EVENT_BASELINE = 'baseline'    # снимок при включении журнала
+EVENT_JOIN = 'join'            # новый игрок
+EVENT_DELETE = 'delete'        # игрок удален (со снимком: карты вернулись в стопку в случайном порядке)
+EVENT_NEW_GAME = 'new_game'    # новая игра (со снимком: стопка перетасована)
+EVENT_DEAL = 'deal'
+EVENT_PLACE = 'place'
+EVENT_GUESS = 'guess'
+EVENT_OPEN = 'open'
+EVENT_SCORE = 'score'
+EVENT_LEADER = 'leader'
+EVENT_NEW_ROUND = 'new_round'  # карты со стола в сброс, предположения очищены
+EVENT_SETTINGS = 'settings'    # прочие изменения настроек
+GAME_SNAPSHOT_EVERY = int(os.environ.get('GAME_SNAPSHOT_EVERY', 200))  # Событий между снимками - столько самое большее повторяется при восстановлении
+
+IMAGE_DECK_FOLDERS = ['ariadna', 'detstvo', 'imaginarium', 'odissey', 'pandora', 'persephone', 'soyuzmultfilm', 'himera']
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+ADMIN_IMAGES_PAGE_SIZE = 100  # Строк каталога карт на первой странице админки и в одной подгрузке
+ADMIN_IMAGES_MAX_LIMIT = 10000  # Верхняя граница limit для потоковой выдачи /admin/images
+DEFAULT_SETTINGS = {'game_over': 'false', 'game_in_progress': 'false', 'show_card_info': 'false', 'leading_user_id': '', 'active_subfolder': 'koloda1'}
+
+_game_tables = {}  # {стол: GameTable} - создаются при старте для всех GAME_TABLES
+# Клиент redis общего реестра (создается лениво; в тестах можно подставить совместимый объект) и отметка этого воркера в нем
+_socket_registry = {'client': None, 'pid': None, 'worker': None, 'heartbeat_started': False, 'pruned_at': {}}
+# Комнаты Socket.IO (внутри стола): своя у каждого игрока (все его вкладки), общая для зрителей без кода и для всех сокетов стола
+ROOM_SPECTATORS = 'spectators'
+ROOM_TABLE = 'table'
+BROADCAST_DEBOUNCE_SECONDS = float(os.environ.get('BROADCAST_DEBOUNCE_SECONDS', 0.05))  # Окно, за которое серия изменений сливается в одну рассылку
+
+class GameTable:
+    """Игровой стол: файл БД и все, что процесс держит для него в памяти. Состояние столов не пересекается,
+    поэтому запись, подсчет очков и рассылка одного стола не ждут другой."""
+    def __init__(self, slug, db_path=None):
+        self.slug = slug
+        self.db_path = db_path or (f"database-{slug}.db" if slug else DB_PATH)
+        self.settings_version_path = self.db_path + '.settings-version'  # Меняется при каждой записи настроек - сигнал другим воркерам
+        self.users_version_path = self.db_path + '.users-version'  # То же для таблицы users (создание, удаление, статус, рейтинг)
+        self.round_version_path = self.db_path + '.round-version'  # Содержит game_round.version последней записи карт/предположений
+        self.registry_prefix = f"{SOCKET_REGISTRY_PREFIX}{slug}:" if slug else SOCKET_REGISTRY_PREFIX
+        self.db_pool = {'pid': None, 'idle': None}  # Пул соединений SQLite текущего процесса (после fork создается заново)
+        self.settings_cache = {'stamp': None, 'values': None}  # Кэш таблицы settings в процессе
+        self.users_cache = {'stamp': None, 'by_id': None, 'by_code': None}  # Кэш таблицы users в процессе
+        self.board_cache = {'layout_raw': None, 'layout': [], 'buckets': {}, 'cells': []}  # Разобранная раскладка поля и последние ячейки
+        self.room = GameRoom(self.round_version_path)
+        self.sockets = {}  # {sid: user_code} - реестр сокетов, когда общего хранилища нет
+        self.state_version = 0  # Монотонно растущая версия состояния игры (без общего хранилища)
+        self.last_state_sent_by_room = {}  # {room: (state_version, game_state)} - последнее, что получила комната
+        self.broadcast_scheduler = {'lock': threading.Lock(), 'dirty': False, 'running': False, 'triggers': set()}
+    def room_name(self, room):
+        """Имя комнаты Socket.IO этого стола (у основного стола - без префикса)."""
+        return f"t:{self.slug}:{room}" if self.slug else room
+
+def request_table_slug():
+    """Стол из URL запроса (/t/<стол>/...) или, для Socket.IO, из ?table= при подключении."""
+    match = TABLE_PATH_RE.match(request.path)
+    if match: return match.group(1)
+    return request.args.get('table', '') if request.path.startswith('/socket.io') else ''
+def current_table_slug():
+    if has_app_context() and 'table' in g: return g.table
+    return request_table_slug() if has_request_context() else ''
+def current_table(): return _game_tables[current_table_slug()]
+@contextmanager
+def table_context(slug):
+    """Контекст приложения для фоновой задачи: get_db(), кэши и комнаты - этого стола."""
+    with app.app_context(): g.table = slug; yield
+
+_sql_stats = ContextVar('sql_stats', default=None)  # Счетчики текущей единицы работы (запрос, действие, рассылка)
+
+def record_sql_statement(cursor, started, new_statement=False, finished=False):
+    """Добавляет время execute или выборки строк к запросу курсора. В лог медленных запрос попадает, как только медленным
+    оказался его execute или когда выборка закончилась (fetchall, последняя строка) - со всем временем запроса."""
+    elapsed_ms = (time.perf_counter() - started) * 1000; stats = _sql_stats.get()
+    cursor.sql_elapsed_ms += elapsed_ms
+    if stats is not None:
+        entry = stats['statements'].setdefault(cursor.sql_text, [0, 0.0, 0.0]) # [раз, всего мс, самый долгий мс]
+        if new_statement: entry[0] += 1; stats['count'] += 1
+        entry[1] += elapsed_ms; entry[2] = max(entry[2], cursor.sql_elapsed_ms); stats['ms'] += elapsed_ms
+    if SQL_SLOW_QUERY_MS and not cursor.sql_slow_logged and cursor.sql_elapsed_ms >= SQL_SLOW_QUERY_MS and (new_statement or finished):
+        cursor.sql_slow_logged = True
+        print(f"SQL: Slow query {cursor.sql_elapsed_ms:.1f} ms ({stats['label'] if stats else 'вне запроса'}): {' '.join(cursor.sql_text.split())[:300]}", file=sys.stderr)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Курсор, замеряющий execute и выборку строк (fetch*, итерация): долгие сканы тратят время именно в выборке."""
+    sql_text = ''; sql_elapsed_ms = 0.0; sql_slow_logged = False
+    def execute(self, sql, parameters=()):
+        self.sql_text, self.sql_elapsed_ms, self.sql_slow_logged = sql, 0.0, False; started = time.perf_counter()
+        try: return super().execute(sql, parameters)
+        finally: record_sql_statement(self, started, new_statement=True)
+    def executemany(self, sql, seq_of_parameters):
+        self.sql_text, self.sql_elapsed_ms, self.sql_slow_logged = sql, 0.0, False; started = time.perf_counter()
+        try: return super().executemany(sql, seq_of_parameters)
+        finally: record_sql_statement(self, started, new_statement=True)
+    def fetchone(self):
+        started = time.perf_counter(); row = None
+        try: row = super().fetchone(); return row
+        finally: record_sql_statement(self, started, finished=row is None)
+    def fetchmany(self, *args):
+        started = time.perf_counter(); rows = None
+        try: rows = super().fetchmany(*args); return rows
+        finally: record_sql_statement(self, started, finished=not rows)
+    def fetchall(self):
+        started = time.perf_counter()
+        try: return super().fetchall()
+        finally: record_sql_statement(self, started, finished=True)
+    def __next__(self):
+        started = time.perf_counter(); finished = True
+        try: row = super().__next__(); finished = False; return row
+        finally: record_sql_statement(self, started, finished=finished)
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor): return super().cursor(factory)
+    def execute(self, sql, parameters=()): return self.cursor().execute(sql, parameters)
+    def executemany(self, sql, seq_of_parameters): return self.cursor().executemany(sql, seq_of_parameters)
+
+def begin_sql_stats(label): return _sql_stats.set({'label': label, 'count': 0, 'ms': 0.0, 'statements': {}})
+def end_sql_stats(token):
+    """Закрывает единицу учета; сводка уходит в лог в debug или если запросов много / один запрос повторяется (N+1)."""
+    stats = _sql_stats.get(); _sql_stats.reset(token)
+    if not stats or not stats['count']: return stats
+    repeated_sql, (repeats, repeated_ms, _) = max(stats['statements'].items(), key=lambda item: item[1][0])
+    if app.debug or stats['count'] >= SQL_WARN_QUERIES or repeats >= SQL_WARN_REPEATS:
+        slowest = sorted(stats['statements'].items(), key=lambda item: -item[1][2])[:3]
+        print(f"SQL: {stats['label']}: {stats['count']} queries, {stats['ms']:.1f} ms; slowest: "
+              + "; ".join(f"{entry[2]:.1f} ms {' '.join(sql.split())[:120]}" for sql, entry in slowest)
+              + (f"; REPEATED {repeats}x ({repeated_ms:.1f} ms): {' '.join(repeated_sql.split())[:200]}" if repeats >= SQL_WARN_REPEATS else ""), file=sys.stderr)
+    return stats
+@contextmanager
+def sql_stats_scope(label):
+    token = begin_sql_stats(label)
+    try: yield
+    finally: end_sql_stats(token)
+
+def connect_db(db_path=DB_PATH):
+    """Новое соединение с WAL и настроенными PRAGMA: читатели не ждут пишущую транзакцию (например, подсчет очков)."""
+    conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False, factory=InstrumentedConnection if SQL_INSTRUMENTATION else sqlite3.Connection) # Соединение переходит между гринлетами через пул
+    conn.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS: conn.execute(pragma)
+    return conn
+
+def acquire_db(table):
+    pool = table.db_pool
+    if pool['pid'] != os.getpid(): pool.update(pid=os.getpid(), idle=queue.LifoQueue(maxsize=DB_POOL_SIZE))
+    try: return pool['idle'].get_nowait()
+    except queue.Empty: return connect_db(table.db_path)
+
+def release_db(table, conn):
+    try:
+        if conn.in_transaction: conn.rollback() # Незакоммиченное не должно доставаться следующему владельцу
+        if table.db_pool['pid'] == os.getpid(): table.db_pool['idle'].put_nowait(conn); return
+    except (sqlite3.Error, queue.Full): pass
+    conn.close()
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(DB_PATH, timeout=10)
-        g.db.row_factory = sqlite3.Row
+        g.db_table = current_table(); g.db = acquire_db(g.db_table)
     return g.db
 
 @app.teardown_appcontext
 def close_db(error=None):
     db = g.pop('db', None)
     if db is not None:
-        db.close()
-
-def init_db(): # Эта функция остается без изменений с последнего раза
-    print(f"DB Init: Attempting to initialize database at {os.path.abspath(DB_PATH)}", file=sys.stderr)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+        release_db(g.pop('db_table'), db)
+
+def _version_stamp(path):
+    try: st = os.stat(path); return (st.st_ino, st.st_mtime_ns)
+    except OSError: return None
+
+def bump_version_stamp(path):
+    """Сообщает всем воркерам, что закэшированная таблица изменилась (атомарная замена файла-метки)."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f: f.write(str(time.time_ns()))
+    os.replace(tmp_path, path)
+    return _version_stamp(path)
+def bump_settings_version(table=None): return bump_version_stamp((table or current_table()).settings_version_path)
+def publish_round_version(version, table=None):
+    """Метка версии раунда с номером внутри: по ней GameRoom понимает, догнала ли БД опубликованную запись."""
+    path = (table or current_table()).round_version_path
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f: f.write(str(version))
+    os.replace(tmp_path, path)
+    return _version_stamp(path)
+
+def get_all_settings(db=None):
+    """Все настройки из кэша; таблица перечитывается, только если другой процесс поменял метку версии."""
+    table = current_table(); cache = table.settings_cache
+    stamp = _version_stamp(table.settings_version_path)
+    if cache['values'] is None or stamp is None or stamp != cache['stamp']:
+        rows = (db or get_db()).execute("SELECT key, value FROM settings").fetchall()
+        cache.update(values={row['key']: row['value'] for row in rows}, stamp=stamp)
+    return cache['values']
+
+def get_users_cache(db=None):
+    """Игроки по id и по коду из кэша процесса; таблица перечитывается, только если метка версии users сменилась."""
+    table = current_table(); cache = table.users_cache
+    stamp = _version_stamp(table.users_version_path)
+    if cache['by_id'] is None or stamp is None or stamp != cache['stamp']:
+        rows = [dict(row) for row in (db or get_db()).execute("SELECT id, name, code, rating, status FROM users ORDER BY id").fetchall()]
+        cache.update(by_id={row['id']: row for row in rows}, by_code={row['code']: row for row in rows}, stamp=stamp)
+    return cache
+def invalidate_users_cache(table=None):
+    """Вызывать после коммита любого изменения users: сбрасывает кэш здесь и в остальных воркерах."""
+    table = table or current_table()
+    table.users_cache.update(stamp=bump_version_stamp(table.users_version_path), by_id=None, by_code=None)
+def get_user_by_code(code, db=None):
+    user = get_users_cache(db)['by_code'].get(code) if code else None
+    return dict(user) if user else None
+
+def ensure_card_state_schema(conn):
+    """Переводит старые БД со строковым images.status на state + owner_id и создает индексы. Идемпотентна."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(images)").fetchall()}
+    if 'status' in columns and 'state' not in columns:
+        print("DB Migrate: Converting images.status to images.state...", file=sys.stderr)
+        conn.execute(f"ALTER TABLE images ADD COLUMN state TEXT NOT NULL DEFAULT '{CARD_STATE_FREE}'")
+        conn.execute(f"""UPDATE images SET
+            state = CASE WHEN status LIKE 'На столе:%' THEN '{CARD_STATE_TABLE}'
+                         WHEN status = 'Занято:Админ' THEN '{CARD_STATE_DISCARD}'
+                         WHEN status LIKE 'Занято:%' THEN '{CARD_STATE_HAND}'
+                         ELSE '{CARD_STATE_FREE}' END,
+            owner_id = CASE WHEN status LIKE 'На столе:%' OR (status LIKE 'Занято:%' AND status != 'Занято:Админ') THEN COALESCE(owner_id, CAST(substr(status, instr(status, ':') + 1) AS INTEGER)) END""")
+        if sqlite3.sqlite_version_info >= (3, 35, 0): conn.execute("ALTER TABLE images DROP COLUMN status")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_subfolder_state ON images (subfolder, state)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_owner_state ON images (owner_id, state)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_state ON images (state)")
+
+def ensure_guesses_schema(conn):
+    """Таблица guesses (одно предположение на игрока и карту) вместо JSON в images.guesses; переносит старые данные. Идемпотентна."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS guesses (image_id INTEGER NOT NULL, guesser_id INTEGER NOT NULL, guessed_owner_id INTEGER NOT NULL, PRIMARY KEY (image_id, guesser_id))""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_guesses_guesser ON guesses (guesser_id)")
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(images)").fetchall()}
+    if 'guesses' in columns:
+        print("DB Migrate: Moving images.guesses JSON into the guesses table...", file=sys.stderr)
+        rows_to_insert = []
+        for image_id, guesses_json in conn.execute("SELECT id, guesses FROM images WHERE guesses IS NOT NULL AND guesses != '{}'").fetchall():
+            try: rows_to_insert.extend([(image_id, int(guesser), int(target)) for guesser, target in json.loads(guesses_json).items()])
+            except (ValueError, TypeError) as e: print(f"DB Migrate Warning: Skipping invalid guesses for image {image_id}: {e}", file=sys.stderr)
+        conn.executemany("INSERT OR REPLACE INTO guesses (image_id, guesser_id, guessed_owner_id) VALUES (?, ?, ?)", rows_to_insert)
+        if sqlite3.sqlite_version_info >= (3, 35, 0): conn.execute("ALTER TABLE images DROP COLUMN guesses")
+
+def create_base_schema(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, code TEXT UNIQUE NOT NULL, rating INTEGER DEFAULT 0, status TEXT DEFAULT 'pending' NOT NULL)""")
+    conn.execute(f"""CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY AUTOINCREMENT, subfolder TEXT NOT NULL, image TEXT NOT NULL, state TEXT NOT NULL DEFAULT '{CARD_STATE_FREE}' CHECK (state IN ('{CARD_STATE_FREE}', '{CARD_STATE_HAND}', '{CARD_STATE_TABLE}', '{CARD_STATE_DISCARD}')), owner_id INTEGER)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS deck_votes (subfolder TEXT PRIMARY KEY, votes INTEGER DEFAULT 0)""")
+    conn.executemany("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", list(DEFAULT_SETTINGS.items()))
+
+def create_image_catalog_schema(conn):
+    """Уникальность (колода, файл) для инкрементальной синхронизации и манифест папок колод."""
+    conn.execute("DELETE FROM images WHERE id NOT IN (SELECT MIN(id) FROM images GROUP BY subfolder, image)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_images_subfolder_image ON images (subfolder, image)")
+    conn.execute("""CREATE TABLE IF NOT EXISTS deck_manifest (subfolder TEXT PRIMARY KEY, dir_mtime_ns INTEGER NOT NULL, listing_hash TEXT NOT NULL)""")
+
+def create_draw_pile_schema(conn):
+    """Колода-стопка: порядок свободных карт (images.pile_position) задается одной перетасовкой на игру, draw_piles хранит курсор."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(images)").fetchall()}
+    if 'pile_position' not in columns: conn.execute("ALTER TABLE images ADD COLUMN pile_position INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_pile ON images (subfolder, pile_position) WHERE pile_position IS NOT NULL")
+    conn.execute("""CREATE TABLE IF NOT EXISTS draw_piles (subfolder TEXT PRIMARY KEY, cursor INTEGER NOT NULL DEFAULT 0, size INTEGER NOT NULL DEFAULT 0)""")
+
+def create_game_round_schema(conn):
+    """Номер версии раунда: растет в каждой транзакции, меняющей карты в игре или предположения."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS game_round (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL DEFAULT 0)""")
+    conn.execute("INSERT OR IGNORE INTO game_round (id, version) VALUES (1, 0)")
+
+def create_game_log_schema(conn):
+    """Журнал событий (только INSERT) и снимки состояния; первый снимок - текущее состояние на момент миграции."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS game_events (id INTEGER PRIMARY KEY AUTOINCREMENT, at REAL NOT NULL, kind TEXT NOT NULL, data TEXT NOT NULL)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS game_snapshots (event_id INTEGER PRIMARY KEY, at REAL NOT NULL, state BLOB NOT NULL)""")
+    record_game_event(conn, EVENT_BASELINE, snapshot=True)
+
+# Миграции по порядку; номер версии схемы (PRAGMA user_version) = число примененных миграций.
+# Новые миграции только дописываются в конец.
+SCHEMA_MIGRATIONS = [create_base_schema, ensure_card_state_schema, ensure_guesses_schema, create_image_catalog_schema, create_draw_pile_schema, create_game_round_schema, create_game_log_schema]
+
+def sync_image_catalog(conn):
+    """Досинхронизирует images с папками колод. Папка, чей mtime совпадает с манифестом, не читается;
+    иначе новые файлы добавляются одним executemany, исчезнувшие - удаляются, если карта не в игре."""
+    manifest = {row['subfolder']: row for row in conn.execute("SELECT subfolder, dir_mtime_ns, listing_hash FROM deck_manifest").fetchall()}
+    added_count = removed_count = scanned_count = 0
+    for folder in IMAGE_DECK_FOLDERS:
+        folder_path = os.path.join(app.static_folder, 'images', folder)
+        try: dir_mtime_ns = os.stat(folder_path).st_mtime_ns
+        except OSError: print(f"DB Init Warning: Folder not found: {folder_path}", file=sys.stderr); continue
+        cached = manifest.get(folder)
+        if cached and cached['dir_mtime_ns'] == dir_mtime_ns: continue
+        filenames = sorted(f for f in os.listdir(folder_path) if f.lower().endswith(IMAGE_EXTENSIONS))
+        listing_hash = hashlib.sha1("\n".join(filenames).encode('utf-8')).hexdigest()
+        scanned_count += 1
+        if not cached or cached['listing_hash'] != listing_hash:
+            changes_before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO images (subfolder, image, state) VALUES (?, ?, ?)", [(folder, filename, CARD_STATE_FREE) for filename in filenames])
+            added_count += conn.total_changes - changes_before
+            known_files = set(filenames)
+            stale_ids = [(row['id'],) for row in conn.execute("SELECT id, image FROM images WHERE subfolder = ? AND state IN (?, ?)", (folder, CARD_STATE_FREE, CARD_STATE_DISCARD)).fetchall() if row['image'] not in known_files]
+            conn.executemany("DELETE FROM images WHERE id = ?", stale_ids); removed_count += len(stale_ids)
+        conn.execute("REPLACE INTO deck_manifest (subfolder, dir_mtime_ns, listing_hash) VALUES (?, ?, ?)", (folder, dir_mtime_ns, listing_hash))
+    return added_count, removed_count, scanned_count
+
+def build_board_layout(num_cells_for_board=None, all_users_for_rating_check=None):
+    """Случайная картинка-клетка для каждой ячейки поля: список путей относительно static."""
+    actual_num_cells = DEFAULT_NUM_BOARD_CELLS
+    if num_cells_for_board is not None: actual_num_cells = num_cells_for_board
+    elif all_users_for_rating_check:
+        max_rating = 0
+        for user_data_item in all_users_for_rating_check:
+            user_rating = user_data_item.get('rating', 0) if isinstance(user_data_item, dict) else user_data_item['rating']
+            if isinstance(user_rating, int) and user_rating > max_rating: max_rating = user_rating
+        actual_num_cells = max(DEFAULT_NUM_BOARD_CELLS, max_rating + 6)
+    pole_image_folder_path = os.path.join(app.static_folder, 'images', GAME_BOARD_POLE_IMG_SUBFOLDER)
+    if GAME_BOARD_POLE_IMAGES and os.path.exists(pole_image_folder_path) and os.path.isdir(pole_image_folder_path):
+        available_pole_images = [f for f in os.listdir(pole_image_folder_path) if f.lower().endswith(('.jpg', '.png', '.jpeg')) and f in GAME_BOARD_POLE_IMAGES]
+        if not available_pole_images: available_pole_images = ["p1.jpg"]
+        return [os.path.join('images', GAME_BOARD_POLE_IMG_SUBFOLDER, random.choice(available_pole_images)).replace("\\", "/") for _ in range(actual_num_cells)]
+    return [os.path.join('images', GAME_BOARD_POLE_IMG_SUBFOLDER, "p1.jpg").replace("\\", "/")] * actual_num_cells
+def init_db(table):
+    """Идемпотентный старт стола: применяет недостающие миграции и досинхронизирует каталог карт. Игровые данные не трогает."""
+    started = time.perf_counter()
+    conn = connect_db(table.db_path)
     try:
-        c.execute("DROP TABLE IF EXISTS users"); c.execute("DROP TABLE IF EXISTS images")
-        c.execute("DROP TABLE IF EXISTS settings"); c.execute("DROP TABLE IF EXISTS deck_votes")
-        c.execute("""CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, code TEXT UNIQUE NOT NULL, rating INTEGER DEFAULT 0, status TEXT DEFAULT 'pending' NOT NULL)""")
-        c.execute("""CREATE TABLE images (id INTEGER PRIMARY KEY AUTOINCREMENT, subfolder TEXT NOT NULL, image TEXT NOT NULL, status TEXT, owner_id INTEGER, guesses TEXT DEFAULT '{}')""")
-        c.execute("""CREATE TABLE settings (key TEXT PRIMARY KEY, value TEXT)""")
-        c.execute("""CREATE TABLE deck_votes (subfolder TEXT PRIMARY KEY, votes INTEGER DEFAULT 0)""")
-        conn.commit()
-        settings_to_init = {'game_over': 'false', 'game_in_progress': 'false', 'show_card_info': 'false', 'leading_user_id': '', 'active_subfolder': 'koloda1'}
-        for key, value in settings_to_init.items(): c.execute("REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+        conn.execute("BEGIN IMMEDIATE") # Воркеры, стартующие одновременно, мигрируют по очереди
+        schema_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for version, migration in enumerate(SCHEMA_MIGRATIONS[schema_version:], start=schema_version + 1):
+            print(f"DB Init: Applying migration {version} ({migration.__name__})", file=sys.stderr)
+            migration(conn)
+        if schema_version < len(SCHEMA_MIGRATIONS): conn.execute(f"PRAGMA user_version = {len(SCHEMA_MIGRATIONS)}")
+        added_count, removed_count, scanned_count = sync_image_catalog(conn)
+        # Раскладка поля есть всегда (и в лобби, и в БД, обновленной посреди игры): путь показа состояния только читает
+        board_seeded = conn.execute("SELECT 1 FROM settings WHERE key = 'board_layout' AND value != ''").fetchone() is None
+        if board_seeded:
+            board_layout = json.dumps(build_board_layout(all_users_for_rating_check=conn.execute("SELECT rating FROM users WHERE status = 'active'").fetchall()))
+            conn.execute("REPLACE INTO settings (key, value) VALUES ('board_layout', ?)", (board_layout,))
+            record_game_event(conn, EVENT_SETTINGS, {'s': {'board_layout': board_layout}})
         conn.commit()
-        image_folders = ['ariadna', 'detstvo', 'imaginarium', 'odissey', 'pandora', 'persephone', 'soyuzmultfilm', 'himera']
-        images_added_count = 0
-        for folder in image_folders:
-            folder_path = os.path.join(app.static_folder, 'images', folder.strip())
-            if os.path.exists(folder_path) and os.path.isdir(folder_path):
-                for filename in os.listdir(folder_path):
-                    if filename.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
-                        c.execute("INSERT OR IGNORE INTO images (subfolder, image, status, guesses) VALUES (?, ?, 'Свободно', '{}')", (folder.strip(), filename))
-                        if c.rowcount > 0: images_added_count += 1
-            else: print(f"DB Init Warning: Folder not found: {folder_path}", file=sys.stderr)
-        conn.commit()
-        print(f"DB Init: Added {images_added_count} new images.", file=sys.stderr)
+        # Без файла-метки кэш настроек/игроков перечитывал бы таблицу при каждом обращении - метка создается заново
+        if schema_version < len(SCHEMA_MIGRATIONS) or board_seeded or _version_stamp(table.settings_version_path) is None: bump_settings_version(table)
+        if schema_version < len(SCHEMA_MIGRATIONS) or _version_stamp(table.users_version_path) is None: invalidate_users_cache(table)
+        if schema_version < len(SCHEMA_MIGRATIONS) or _version_stamp(table.round_version_path) is None: publish_round_version(conn.execute("SELECT version FROM game_round WHERE id = 1").fetchone()[0], table)
+        print(f"DB Init: Schema v{len(SCHEMA_MIGRATIONS)} at {os.path.abspath(table.db_path)}; decks rescanned: {scanned_count}, images added: {added_count}, removed: {removed_count}; {(time.perf_counter() - started) * 1000:.1f} ms.", file=sys.stderr)
     except sqlite3.Error as e: print(f"CRITICAL ERROR during init_db: {e}\n{traceback.format_exc()}", file=sys.stderr); conn.rollback(); raise
-    finally:
-        if conn: conn.close()
-    print("DB Init: Database initialized.", file=sys.stderr)
-
-print("DB Init: Calling init_db() on module load.", file=sys.stderr)
-init_db()
-print("DB Init: init_db() call completed.", file=sys.stderr)
+    finally: conn.close()
 
 # --- Вспомогательные функции (get_setting, set_setting, etc.) ---
-# Эти функции остаются без изменений с последнего раза
 def get_setting(key):
-    try: db = get_db(); c = db.cursor(); c.execute("SELECT value FROM settings WHERE key = ?", (key,)); row = c.fetchone(); return row['value'] if row else None
+    try: return get_all_settings().get(key)
     except sqlite3.Error as e: print(f"DB error in get_setting for '{key}': {e}", file=sys.stderr); return None
-def set_setting(key, value):
+def set_settings(values, event_kind=EVENT_SETTINGS, event_data=None):
+    """Записывает несколько настроек одной транзакцией (фиксирует и все прочие незакоммиченные изменения соединения).
+    В журнал уходит событие event_kind с новыми значениями в поле 's'."""
     db = get_db()
-    try: c = db.cursor(); c.execute("REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value)); db.commit(); return True
-    except sqlite3.Error as e: print(f"DB error in set_setting for '{key}': {e}", file=sys.stderr); db.rollback(); return False
+    try:
+        db.executemany("REPLACE INTO settings (key, value) VALUES (?, ?)", list(values.items()))
+        record_game_event(db, event_kind, dict(event_data or {}, s=values)); db.commit()
+        # Write-through: новая метка для остальных воркеров, свой кэш перечитываем под этой меткой сразу
+        stamp = bump_settings_version()
+        current_table().settings_cache.update(values={row['key']: row['value'] for row in db.execute("SELECT key, value FROM settings").fetchall()}, stamp=stamp); return True
+    except sqlite3.Error as e: print(f"DB error in set_settings for {list(values)}: {e}", file=sys.stderr); db.rollback(); return False
+def set_setting(key, value, event_kind=EVENT_SETTINGS): return set_settings({key: value}, event_kind)
 def get_user_name(user_id):
     if user_id is None: return None
-    try: db = get_db(); c = db.cursor(); c.execute("SELECT name FROM users WHERE id = ?", (int(user_id),)); row = c.fetchone(); return row['name'] if row else None
+    try: user = get_users_cache()['by_id'].get(int(user_id)); return user['name'] if user else None
     except Exception as e: print(f"Error in get_user_name for ID '{user_id}': {e}", file=sys.stderr); return None
 def is_game_in_progress(): return get_setting('game_in_progress') == 'true'
 def set_game_in_progress(state=True): return set_setting('game_in_progress', 'true' if state else 'false')
@@ -92,7 +437,7 @@ def is_game_over(): return get_setting('game_over') == 'true'
 def set_game_over(state=True): return set_setting('game_over', 'true' if state else 'false')
 def generate_unique_code(length=8): return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
 def get_leading_user_id(): val = get_setting('leading_user_id'); return int(val) if val and val.strip() else None
-def set_leading_user_id(uid): return set_setting('leading_user_id', str(uid) if uid is not None else '')
+def set_leading_user_id(uid): return set_setting('leading_user_id', str(uid) if uid is not None else '', EVENT_LEADER)
 def determine_new_leader(current_leader_id):
     db = get_db(); c = db.cursor()
     try:
@@ -106,131 +451,326 @@ def determine_new_leader(current_leader_id):
 def get_active_players_count(db_conn):
     try: cur = db_conn.execute("SELECT COUNT(id) FROM users WHERE status = 'active'"); return cur.fetchone()[0] or 0
     except Exception as e: print(f"DB error in get_active_players_count: {e}", file=sys.stderr); return 0
+def load_table_guesses(db_conn, subfolder=None):
+    """Предположения по картам на столе одним запросом: {image_id: {guesser_id: guessed_owner_id}}."""
+    query = "SELECT g.image_id, g.guesser_id, g.guessed_owner_id FROM guesses g JOIN images i ON i.id = g.image_id WHERE i.state = ?"
+    params = (CARD_STATE_TABLE,) if subfolder is None else (CARD_STATE_TABLE, subfolder)
+    guesses_by_image = {}
+    for row in db_conn.execute(query + ("" if subfolder is None else " AND i.subfolder = ?"), params).fetchall():
+        guesses_by_image.setdefault(row['image_id'], {})[row['guesser_id']] = row['guessed_owner_id']
+    return guesses_by_image
+def advance_round_version(db_conn):
+    """Вызывать в транзакции записи карт/предположений, перед коммитом. Увеличивает game_round.version и, пока
+    держится блокировка записи, публикует номер в метке round-version стола - поэтому номера в метке идут строго по порядку.
+    Возвращает (версия, метка)."""
+    db_conn.execute("UPDATE game_round SET version = version + 1 WHERE id = 1")
+    version = db_conn.execute("SELECT version FROM game_round WHERE id = 1").fetchone()[0]
+    return version, publish_round_version(version)
+def rollback_round_write(db_conn):
+    """Откат транзакции, в которой мог быть вызван advance_round_version: метка уже опубликована с номером, которого
+    в БД не будет, поэтому в ней снова зафиксированная версия - иначе GameRoom всех воркеров перечитывал бы раунд
+    при каждом чтении до следующей удачной записи. Вызывать вместо db.rollback() на всех путях записи раунда."""
+    db_conn.rollback(); current_table().room.stamp = None
+    try: publish_round_version(db_conn.execute("SELECT version FROM game_round WHERE id = 1").fetchone()[0])
+    except (sqlite3.Error, OSError) as e: print(f"DB error in rollback_round_write: {e}", file=sys.stderr)
+
+def record_game_event(db_conn, kind, data=None, snapshot=False):
+    """Дописывает событие в журнал в транзакции самого изменения (вызывать после его запросов, до коммита), поэтому
+    журнал и таблицы не расходятся. Снимок состояния пишется, если его просят (изменение не повторить по событию,
+    например перетасовка) или с прошлого снимка накопилось GAME_SNAPSHOT_EVERY событий. Возвращает id события."""
+    event_id = db_conn.execute("INSERT INTO game_events (at, kind, data) VALUES (?, ?, ?)", (time.time(), kind, json.dumps(data or {}, ensure_ascii=False, separators=(',', ':')))).lastrowid
+    if not snapshot: snapshot = event_id - (db_conn.execute("SELECT MAX(event_id) FROM game_snapshots").fetchone()[0] or 0) >= GAME_SNAPSHOT_EVERY
+    if snapshot: db_conn.execute("INSERT INTO game_snapshots (event_id, at, state) VALUES (?, ?, ?)", (event_id, time.time(), dump_game_state(db_conn)))
+    return event_id
+def dump_game_state(db_conn):
+    """Все изменяемое игрой (игроки, настройки, карты не в исходном состоянии, стопки, предположения) - сжатый JSON."""
+    state = {
+        'users': [list(row) for row in db_conn.execute("SELECT id, name, code, rating, status FROM users ORDER BY id")],
+        'settings': {row['key']: row['value'] for row in db_conn.execute("SELECT key, value FROM settings")},
+        'cards': [list(row) for row in db_conn.execute("SELECT id, state, owner_id, pile_position FROM images WHERE state != ? OR owner_id IS NOT NULL OR pile_position IS NOT NULL ORDER BY id", (CARD_STATE_FREE,))],
+        'piles': [list(row) for row in db_conn.execute("SELECT subfolder, cursor, size FROM draw_piles ORDER BY subfolder")],
+        'guesses': [list(row) for row in db_conn.execute("SELECT image_id, guesser_id, guessed_owner_id FROM guesses ORDER BY image_id, guesser_id")],
+    }
+    return zlib.compress(json.dumps(state, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+def restore_game_state(db_conn, blob):
+    """Обратное к dump_game_state: приводит таблицы игры к снимку. Коммит остается за вызывающим."""
+    state = json.loads(zlib.decompress(blob))
+    db_conn.execute("DELETE FROM users"); db_conn.executemany("INSERT INTO users (id, name, code, rating, status) VALUES (?, ?, ?, ?, ?)", state['users'])
+    db_conn.execute("DELETE FROM settings"); db_conn.executemany("INSERT INTO settings (key, value) VALUES (?, ?)", list(state['settings'].items()))
+    db_conn.execute("UPDATE images SET state = ?, owner_id = NULL, pile_position = NULL WHERE state != ? OR owner_id IS NOT NULL OR pile_position IS NOT NULL", (CARD_STATE_FREE, CARD_STATE_FREE))
+    db_conn.executemany("UPDATE images SET state = ?, owner_id = ?, pile_position = ? WHERE id = ?", [(card_state, owner_id, pile_position, card_id) for card_id, card_state, owner_id, pile_position in state['cards']])
+    db_conn.execute("DELETE FROM draw_piles"); db_conn.executemany("INSERT INTO draw_piles (subfolder, cursor, size) VALUES (?, ?, ?)", state['piles'])
+    db_conn.execute("DELETE FROM guesses"); db_conn.executemany("INSERT INTO guesses (image_id, guesser_id, guessed_owner_id) VALUES (?, ?, ?)", state['guesses'])
+def iter_game_events(db_conn, after_event_id=0, upto_event_id=None):
+    """События журнала по порядку: (id, at, kind, data, снимок после события или None)."""
+    rows = db_conn.execute("SELECT e.id, e.at, e.kind, e.data, s.state FROM game_events e LEFT JOIN game_snapshots s ON s.event_id = e.id WHERE e.id > ? AND e.id <= ? ORDER BY e.id",
+                           (after_event_id, upto_event_id if upto_event_id is not None else sys.maxsize))
+    for event_id, at, kind, data, snapshot in rows: yield event_id, at, kind, json.loads(data), snapshot
+def apply_game_event(db_conn, kind, data, snapshot=None):
+    """Повторяет записанное событие на db_conn (восстановление, повтор журнала). Коммит остается за вызывающим."""
+    if snapshot is not None: restore_game_state(db_conn, snapshot); return # Снимок уже содержит результат события
+    if 's' in data: db_conn.executemany("REPLACE INTO settings (key, value) VALUES (?, ?)", list(data['s'].items()))
+    if kind == EVENT_JOIN: db_conn.execute("INSERT OR REPLACE INTO users (id, name, code, rating, status) VALUES (?, ?, ?, 0, ?)", (data['u'], data['n'], data['c'], data['st']))
+    elif kind == EVENT_DEAL:
+        db_conn.executemany("UPDATE images SET state = ?, owner_id = ?, pile_position = NULL WHERE id = ?", [(CARD_STATE_HAND, user_id, card_id) for card_id, user_id in data['cards']])
+        db_conn.execute("UPDATE draw_piles SET cursor = ? WHERE subfolder = ?", (data['cur'], data['d']))
+    elif kind == EVENT_PLACE:
+        if data.get('r') is not None: db_conn.execute("UPDATE images SET state = ? WHERE id = ?", (CARD_STATE_HAND, data['r']))
+        db_conn.execute("UPDATE images SET state = ? WHERE id = ?", (CARD_STATE_TABLE, data['i']))
+        db_conn.executemany("DELETE FROM guesses WHERE image_id = ?", [(card_id,) for card_id in (data['i'], data.get('r')) if card_id is not None])
+    elif kind == EVENT_GUESS: db_conn.execute("REPLACE INTO guesses (image_id, guesser_id, guessed_owner_id) VALUES (?, ?, ?)", (data['i'], data['u'], data['o']))
+    elif kind == EVENT_SCORE: db_conn.executemany("UPDATE users SET rating = ? WHERE id = ?", [(rating, int(user_id)) for user_id, rating in data['r'].items()])
+    elif kind == EVENT_NEW_ROUND:
+        db_conn.execute("UPDATE images SET owner_id = NULL, state = ? WHERE state = ?", (CARD_STATE_DISCARD, CARD_STATE_TABLE)); db_conn.execute("DELETE FROM guesses")
+def score_current_round(db_conn):
+    """score_round по состоянию в БД (открытие карт и повтор журнала): активные игроки, ведущий, карты на столе и
+    предположения - четыре запроса. Возвращает ({user_id: rating} до подсчета, результат) или (None, None) без активных игроков."""
+    active_users = db_conn.execute("SELECT id, name, rating FROM users WHERE status = 'active'").fetchall()
+    if not active_users: return None, None
+    leader_value = db_conn.execute("SELECT value FROM settings WHERE key = 'leading_user_id'").fetchone()
+    table_cards = db_conn.execute("SELECT id, owner_id FROM images WHERE state = ?", (CARD_STATE_TABLE,)).fetchall()
+    players = {user['id']: user['rating'] for user in active_users}
+    result = score_round(players, int(leader_value[0]) if leader_value and (leader_value[0] or '').strip() else None, [(card['id'], card['owner_id']) for card in table_cards],
+                         load_table_guesses(db_conn), names={user['id']: user['name'] for user in active_users})
+    return players, result
+def rebuild_game_state(db_conn, upto_event_id=None):
+    """Восстанавливает таблицы игры из журнала: последний снимок не позже upto_event_id и события после него.
+    Коммит остается за вызывающим. Возвращает (id события снимка, число повторенных событий) или None, если снимков нет."""
+    upto = upto_event_id if upto_event_id is not None else sys.maxsize
+    row = db_conn.execute("SELECT event_id, state FROM game_snapshots WHERE event_id <= ? ORDER BY event_id DESC LIMIT 1", (upto,)).fetchone()
+    if row is None: return None
+    events = list(iter_game_events(db_conn, row[0], upto)) # Читаем до записи: восстановление идет в той же БД
+    restore_game_state(db_conn, row[1])
+    for _, _, kind, data, snapshot in events: apply_game_event(db_conn, kind, data, snapshot)
+    return row[0], len(events)
+
+class CardRecord:
+    """Карта в игре (на руке или на столе); URL картинок считаются один раз при загрузке."""
+    __slots__ = ('id', 'subfolder', 'image', 'state', 'owner_id', 'urls')
+    def __init__(self, card_id, subfolder, image, state, owner_id):
+        self.id, self.subfolder, self.image, self.state, self.owner_id = card_id, subfolder, image, state, owner_id
+        self.urls = card_image_urls(subfolder, image)
+    def as_dict(self): return {'id': self.id, 'image': self.image, 'subfolder': self.subfolder, **self.urls}
+
+class GameRoom:
+    """Текущий раунд в памяти процесса: карты на руках и на столе активной колоды и предположения по ним.
+    Источник истины - SQLite (она общая для воркеров). Пока метка версии раунда не менялась, чтение состояния
+    не трогает БД; ходы этого процесса применяются к памяти на месте, если память отражала версию прямо перед ходом."""
+    __slots__ = ('version_path', 'stamp', 'version', 'subfolder', 'cards', 'guesses')
+    def __init__(self, version_path): self.version_path = version_path; self.stamp = self.version = self.subfolder = None; self.cards = {}; self.guesses = {}
+    def sync(self, db_conn, subfolder):
+        """Актуализирует комнату: при смене метки или колоды перечитывает карты и предположения одним чтением."""
+        stamp = _version_stamp(self.version_path)
+        if stamp is not None and stamp == self.stamp and subfolder == self.subfolder: return self
+        try:
+            with open(self.version_path) as f: published_version = int(f.read() or 0)
+        except (OSError, ValueError): published_version = 0
+        own_transaction = not db_conn.in_transaction
+        if own_transaction: db_conn.execute("BEGIN") # Версия, карты и предположения - из одного снимка БД
+        try:
+            self.version = db_conn.execute("SELECT version FROM game_round WHERE id = 1").fetchone()[0]
+            rows = db_conn.execute("SELECT id, subfolder, image, state, owner_id FROM images WHERE subfolder = ? AND state IN (?, ?) ORDER BY id", (subfolder, CARD_STATE_HAND, CARD_STATE_TABLE)).fetchall() if subfolder else []
+            self.guesses = load_table_guesses(db_conn, subfolder) if subfolder else {}
+        finally:
+            if own_transaction: db_conn.commit()
+        self.cards = {row['id']: CardRecord(row['id'], row['subfolder'], row['image'], row['state'], row['owner_id']) for row in rows}
+        self.subfolder = subfolder
+        # Метка опубликована раньше коммита записи - если БД еще не догнала ее, перечитаем в следующий раз
+        self.stamp = stamp if self.version >= published_version else None
+        return self
+    def _advance(self, version, stamp, apply_change):
+        # Память отстала от БД или изменение к ней неприменимо - полная перезагрузка при следующем чтении
+        if self.stamp is not None and self.version == version - 1 and apply_change() is not False: self.version, self.stamp = version, stamp
+        else: self.stamp = None
+    def card_placed(self, version, stamp, card_id, returned_card_id=None):
+        """Зафиксированный ход: карта на стол, предыдущая карта игрока - в руку, предположения по обеим сброшены."""
+        def change():
+            moved = [(moved_id, state) for moved_id, state in ((returned_card_id, CARD_STATE_HAND), (card_id, CARD_STATE_TABLE)) if moved_id is not None]
+            if any(moved_id not in self.cards for moved_id, _ in moved): return False # Карты нет в памяти (другая колода?)
+            for moved_id, state in moved: self.guesses.pop(moved_id, None); self.cards[moved_id].state = state
+        self._advance(version, stamp, change)
+    def guess_made(self, version, stamp, image_id, guesser_id, guessed_owner_id):
+        self._advance(version, stamp, lambda: self.guesses.setdefault(image_id, {}).__setitem__(guesser_id, guessed_owner_id))
+    def table_cards(self): return [card for card in self.cards.values() if card.state == CARD_STATE_TABLE]
+    def hands(self):
+        hands = {}
+        for card in self.cards.values():
+            if card.state == CARD_STATE_HAND and card.owner_id is not None: hands.setdefault(card.owner_id, []).append(card.as_dict())
+        return hands
+
+GAME_INIT_DB = os.environ.get('GAME_INIT_DB', 'True').lower() in ['true', '1', 't']  # False - БД столов не трогаются при импорте (утилиты только для чтения)
+for table_slug in GAME_TABLES:
+    _game_tables[table_slug] = GameTable(table_slug)
+    if GAME_INIT_DB: init_db(_game_tables[table_slug])
+
+def shuffle_draw_pile(db_conn, subfolder):
+    """Перетасовывает все свободные карты колоды в новую стопку (один раз на игру). Коммит остается за вызывающим."""
+    free_cards = [row['id'] for row in db_conn.execute("SELECT id FROM images WHERE subfolder = ? AND state = ?", (subfolder, CARD_STATE_FREE)).fetchall()]
+    random.shuffle(free_cards)
+    db_conn.execute("UPDATE images SET pile_position = NULL WHERE subfolder = ? AND pile_position IS NOT NULL", (subfolder,))
+    db_conn.executemany("UPDATE images SET pile_position = ? WHERE id = ?", list(enumerate(free_cards)))
+    db_conn.execute("REPLACE INTO draw_piles (subfolder, cursor, size) VALUES (?, 0, ?)", (subfolder, len(free_cards)))
+    return len(free_cards)
+def return_cards_to_draw_pile(db_conn, subfolder, card_ids):
+    """Кладет освободившиеся карты под низ стопки в случайном порядке. Без стопки ничего не делает - она соберется при раздаче."""
+    pile = db_conn.execute("SELECT size FROM draw_piles WHERE subfolder = ?", (subfolder,)).fetchone()
+    if pile is None or not card_ids: return
+    card_ids = list(card_ids); random.shuffle(card_ids)
+    db_conn.executemany("UPDATE images SET pile_position = ? WHERE id = ?", [(pile['size'] + i, card_id) for i, card_id in enumerate(card_ids)])
+    db_conn.execute("UPDATE draw_piles SET size = size + ? WHERE subfolder = ?", (len(card_ids), subfolder))
+def draw_pile_remaining(db_conn, subfolder):
+    """Сколько карт осталось в стопке (без COUNT по images); None, если стопки для колоды еще нет."""
+    pile = db_conn.execute("SELECT cursor, size FROM draw_piles WHERE subfolder = ?", (subfolder,)).fetchone()
+    return max(0, pile['size'] - pile['cursor']) if pile else None
+def deal_cards(db_conn, subfolder, user_ids, cards_per_player=1):
+    """Раздает карты с верха стопки колоды: читается ровно столько карт, сколько раздается, и один executemany.
+    Игроки получают карты по очереди блоками по cards_per_player. Коммит остается за вызывающим.
+    Возвращает (роздано, было в стопке)."""
+    started = time.perf_counter()
+    available_count = draw_pile_remaining(db_conn, subfolder); shuffled = available_count is None
+    if shuffled: available_count = shuffle_draw_pile(db_conn, subfolder) # Игра начата до появления стопок
+    wanted = len(user_ids) * cards_per_player
+    top_cards = [row['id'] for row in db_conn.execute("SELECT id FROM images WHERE subfolder = ? AND pile_position IS NOT NULL ORDER BY pile_position LIMIT ?", (subfolder, wanted)).fetchall()]
+    seats = (user_id for user_id in user_ids for _ in range(cards_per_player))
+    assignments = [(CARD_STATE_HAND, user_id, card_id) for card_id, user_id in zip(top_cards, seats)]
+    db_conn.executemany("UPDATE images SET state = ?, owner_id = ?, pile_position = NULL WHERE id = ?", assignments)
+    # Стопка кончилась раньше, чем ожидал курсор (например, карты удалены из папки) - курсор упирается в конец
+    if len(top_cards) < wanted: db_conn.execute("UPDATE draw_piles SET cursor = size WHERE subfolder = ?", (subfolder,))
+    else: db_conn.execute("UPDATE draw_piles SET cursor = cursor + ? WHERE subfolder = ?", (len(assignments), subfolder))
+    if assignments or shuffled: record_game_event(db_conn, EVENT_DEAL, {'d': subfolder, 'cards': [[card_id, user_id] for _, user_id, card_id in assignments],
+                                                            'cur': db_conn.execute("SELECT cursor FROM draw_piles WHERE subfolder = ?", (subfolder,)).fetchone()[0]}, snapshot=shuffled)
+    print(f"Deal: {len(assignments)} карт из '{subfolder}' ({len(user_ids)} игроков по {cards_per_player}, в стопке {available_count}) за {(time.perf_counter() - started) * 1000:.1f} мс", file=sys.stderr)
+    return len(assignments), available_count
 def check_and_end_game_if_player_out_of_cards(db_conn):
     if not is_game_in_progress(): return False
     c = db_conn.cursor()
     c.execute("SELECT id, name FROM users WHERE status = 'active'")
     active_players = c.fetchall()
     if not active_players: return False
-    player_who_ran_out = None
-    for player in active_players:
-        c.execute("SELECT COUNT(id) FROM images WHERE owner_id = ? AND status LIKE 'Занято:%'", (player['id'],))
-        card_count_row = c.fetchone()
-        if card_count_row and card_count_row[0] == 0:
-            player_who_ran_out = player; break
+    # Одним запросом по индексу state: у кого из игроков есть карты на руке
+    hand_counts = {row['owner_id']: row['cards'] for row in c.execute("SELECT owner_id, COUNT(*) AS cards FROM images WHERE state = ? GROUP BY owner_id", (CARD_STATE_HAND,))}
+    player_who_ran_out = next((player for player in active_players if not hand_counts.get(player['id'])), None)
     if player_who_ran_out:
         set_game_over(True); set_game_in_progress(False)
         flash(f"Игра окончена! У игрока '{player_who_ran_out['name']}' закончились карты.", "danger")
         print(f"GAME OVER: Player {player_who_ran_out['name']} (ID: {player_who_ran_out['id']}) ran out of cards.", file=sys.stderr)
         return True
     return False
-def initialize_new_game_board_visuals(num_cells_for_board=None, all_users_for_rating_check=None): # Без изменений
-    global _current_game_board_pole_image_config, _current_game_board_num_cells
-    actual_num_cells = DEFAULT_NUM_BOARD_CELLS
-    if num_cells_for_board is not None: actual_num_cells = num_cells_for_board
-    elif all_users_for_rating_check:
-        max_rating = 0
-        for user_data_item in all_users_for_rating_check:
-            user_rating = user_data_item.get('rating', 0) if isinstance(user_data_item, dict) else getattr(user_data_item, 'rating', 0)
-            if isinstance(user_rating, int) and user_rating > max_rating: max_rating = user_rating
-        actual_num_cells = max(DEFAULT_NUM_BOARD_CELLS, max_rating + 6)
-    _current_game_board_num_cells = actual_num_cells; _current_game_board_pole_image_config = []
-    pole_image_folder_path = os.path.join(app.static_folder, 'images', GAME_BOARD_POLE_IMG_SUBFOLDER)
-    if GAME_BOARD_POLE_IMAGES and os.path.exists(pole_image_folder_path) and os.path.isdir(pole_image_folder_path):
-        available_pole_images = [f for f in os.listdir(pole_image_folder_path) if f.lower().endswith(('.jpg', '.png', '.jpeg')) and f in GAME_BOARD_POLE_IMAGES]
-        if not available_pole_images: available_pole_images = ["p1.jpg"]
-        for _ in range(_current_game_board_num_cells): _current_game_board_pole_image_config.append(os.path.join('images', GAME_BOARD_POLE_IMG_SUBFOLDER, random.choice(available_pole_images)).replace("\\", "/"))
-    else: _current_game_board_pole_image_config = [os.path.join('images', GAME_BOARD_POLE_IMG_SUBFOLDER, "p1.jpg").replace("\\", "/")] * _current_game_board_num_cells
-def generate_game_board_data_for_display(all_users_data_for_board): # Без изменений
-    global _current_game_board_pole_image_config, _current_game_board_num_cells
-    if not _current_game_board_pole_image_config or _current_game_board_num_cells == 0:
-        initialize_new_game_board_visuals(all_users_for_rating_check=all_users_data_for_board)
-        if not _current_game_board_pole_image_config or _current_game_board_num_cells == 0: return []
-    board_cells_data = []
-    for i in range(_current_game_board_num_cells):
-        cell_number = i + 1; cell_image_path = "images/default_pole_image.png"
-        if _current_game_board_pole_image_config:
-            try: cell_image_path = _current_game_board_pole_image_config[i % len(_current_game_board_pole_image_config)]
-            except Exception as e: print(f"Error getting board cell image: {e}", file=sys.stderr)
-        users_in_this_cell = []
-        for user_data_item_board in all_users_data_for_board:
-            user_rating = int(user_data_item_board.get('rating', 0) if isinstance(user_data_item_board, dict) else user_data_item_board['rating'] or 0)
-            if user_rating == cell_number: users_in_this_cell.append({'id': user_data_item_board['id'], 'name': user_data_item_board['name'], 'rating': user_rating})
-        board_cells_data.append({'cell_number': cell_number, 'image_path': cell_image_path, 'users_in_cell': users_in_this_cell})
+def initialize_new_game_board_visuals(num_cells_for_board=None, all_users_for_rating_check=None):
+    """Новая раскладка поля; хранится в settings['board_layout'], поэтому все воркеры показывают одно и то же поле."""
+    layout = build_board_layout(num_cells_for_board, all_users_for_rating_check)
+    set_setting('board_layout', json.dumps(layout))
+    return layout
+def get_board_layout():
+    """Раскладка поля из кэша настроек; JSON разбирается заново только после ее смены."""
+    raw_layout = get_setting('board_layout') or ''
+    board_cache = current_table().board_cache
+    if raw_layout != board_cache['layout_raw']:
+        layout = json.loads(raw_layout) if raw_layout else []
+        board_cache.update(layout_raw=raw_layout, layout=layout, buckets={},
+                            cells=[{'cell_number': i + 1, 'image_path': image_path, 'image_url': static_url(image_path), 'users_in_cell': []} for i, image_path in enumerate(layout)])
+    return board_cache['layout']
+def generate_game_board_data_for_display(all_users_data_for_board):
+    """Клетки поля с игроками по рейтингу. Только чтение: раскладку создают init_db (если ее нет), start_new_game
+    и сброс поля в админке (путь рассылки не должен ничего коммитить)."""
+    layout = get_board_layout()
+    if not layout: return []
+    # Один проход по игрокам: раскладываем по клеткам согласно рейтингу
+    buckets = {}
+    for user_data_item_board in all_users_data_for_board:
+        user_rating = int(user_data_item_board.get('rating', 0) if isinstance(user_data_item_board, dict) else user_data_item_board['rating'] or 0)
+        if 1 <= user_rating <= len(layout): buckets.setdefault(user_rating, []).append({'id': user_data_item_board['id'], 'name': user_data_item_board['name'], 'rating': user_rating})
+    # Пересобираем только клетки, где состав игроков изменился; остальные объекты ячеек переиспользуются
+    board_cache = current_table().board_cache
+    previous_buckets = board_cache['buckets']; board_cells_data = list(board_cache['cells'])
+    for cell_number in set(buckets) | set(previous_buckets):
+        if buckets.get(cell_number) != previous_buckets.get(cell_number):
+            board_cells_data[cell_number - 1] = dict(board_cells_data[cell_number - 1], users_in_cell=buckets.get(cell_number, []))
+    board_cache.update(buckets=buckets, cells=board_cells_data)
     return board_cells_data
-def get_full_game_state_data(user_code_for_state=None):
-    db = get_db()
-    current_g_user_dict = None
-    if user_code_for_state:
-        user_row = db.execute("SELECT id, name, code, rating, status FROM users WHERE code = ?", (user_code_for_state,)).fetchone()
-        if user_row:
-            current_g_user_dict = dict(user_row)
-    active_subfolder_val = get_setting('active_subfolder')
-
-    # --- ДОБАВЛЕНО: Получаем данные обо ВСЕХ пользователях ---
-    all_users_info_db = db.execute("SELECT id, name FROM users").fetchall()
-    all_users_info_list = [{'id': u['id'], 'name': u['name']} for u in all_users_info_db]
-    # --- КОНЕЦ ДОБАВЛЕННОГО БЛОКА ---
+def image_variant_path(subfolder, image, variant='card'):
+    """Уменьшенный WebP-вариант карты (путь относительно static); пока варианты не собраны - оригинал."""
+    return variant_path(app.static_folder, subfolder, image, variant)
+def static_url(filename):
+    """URL файла из static с отпечатком содержимого (?v=...) - такой URL кэшируется браузером бессрочно."""
+    fingerprint = file_fingerprint(app.static_folder, filename)
+    return f"{app.static_url_path}/{filename}" + (f"?v={fingerprint}" if fingerprint else "")
+def card_image_urls(subfolder, image):
+    """URL оригинала (увеличенный просмотр) и уменьшенного варианта (рука, стол) для состояния игры."""
+    return {'image_url': static_url(f"images/{subfolder}/{image}"), 'preview_url': static_url(image_variant_path(subfolder, image))}
+
+def get_shared_game_state_snapshot(db):
+    """Общая часть состояния игры: читается из БД один раз на изменение и переиспользуется для всех сокетов."""
+    settings = get_all_settings(db)
+    active_subfolder_val = settings.get('active_subfolder')
+    leader_val = settings.get('leading_user_id')
+    users = [dict(user) for user in get_users_cache(db)['by_id'].values()]
+    active_users = [u for u in users if u['status'] == 'active']
+    snapshot = {
+        'game_in_progress': settings.get('game_in_progress') == 'true', 'game_over': settings.get('game_over') == 'true',
+        'show_card_info': settings.get('show_card_info') == 'true', 'active_subfolder': active_subfolder_val,
+        'db_current_leader_id': int(leader_val) if leader_val and leader_val.strip() else None,
+        'users_by_code': {u['code']: u for u in users}, 'users_by_id': {u['id']: u for u in users},
+        'all_users_info': [{'id': u['id'], 'name': u['name']} for u in users],
+        'num_active_players': len(active_users), 'table_cards': [], 'hands': {},
+    }
+    if active_subfolder_val:
+        room = current_table().room.sync(db, active_subfolder_val) # Без изменений раунда - ни одного запроса к БД
+        users_by_id = snapshot['users_by_id']
+        # Ключи guesses - строки, как их ожидает user.html
+        snapshot['table_cards'] = [dict(card.as_dict(), owner_id=card.owner_id, guesses={str(k): v for k, v in room.guesses.get(card.id, {}).items()})
+                                   for card in room.table_cards() if card.owner_id is None or users_by_id.get(card.owner_id, {}).get('status') == 'active']
+        if snapshot['game_in_progress'] and not snapshot['game_over']: snapshot['hands'] = room.hands()
+    table_owner_ids = {card['owner_id'] for card in snapshot['table_cards']}
+    snapshot['all_users_for_guessing'] = [{'id': u['id'], 'name': u['name']} for u in active_users if u['id'] in table_owner_ids]
+    snapshot['all_cards_placed'] = (snapshot['game_in_progress'] and not snapshot['game_over'] and snapshot['num_active_players'] > 0 and len(snapshot['table_cards']) >= snapshot['num_active_players'])
+    # Always get data for the game board based on active users
+    snapshot['game_board'] = generate_game_board_data_for_display(active_users)
+    snapshot['board_layout'] = get_board_layout()
+    snapshot['current_num_board_cells'] = len(snapshot['board_layout'])
+    return snapshot
 
+def build_game_state_for_user(snapshot, current_g_user_dict=None):
+    """Персональная часть состояния (рука, свой голос, флаги ведущего) поверх общего снимка. Запросов к БД не делает."""
     game_state = {
-        'game_in_progress': is_game_in_progress(), 'game_over': is_game_over(),
-        'show_card_info': get_setting("show_card_info") == "true",
-        'active_subfolder': active_subfolder_val, 'db_current_leader_id': get_leading_user_id(),
-        'num_active_players': get_active_players_count(db),
+        'game_in_progress': snapshot['game_in_progress'], 'game_over': snapshot['game_over'],
+        'show_card_info': snapshot['show_card_info'],
+        'active_subfolder': snapshot['active_subfolder'], 'db_current_leader_id': snapshot['db_current_leader_id'],
+        'num_active_players': snapshot['num_active_players'],
         'table_images': [], 'user_cards': [],
         'all_users_for_guessing': [], # Этот список используется для выпадающего списка угадывания (активные игроки с картами на столе)
-        'all_users_info': all_users_info_list, # --- ДОБАВЛЕНО: Новый список со всеми пользователями для поиска имен ---
+        'all_users_info': snapshot['all_users_info'], # Список со всеми пользователями для поиска имен
         'on_table_status': False, 'is_current_user_the_db_leader': False,
-        'leader_pole_pictogram_path': None, 'leader_pictogram_rating_display': None,
-        'game_board': [], 'current_num_board_cells': _current_game_board_num_cells,
-        'current_user_data': current_g_user_dict, 'num_cards_on_table': 0,
+        'leader_pole_pictogram_path': None, 'leader_pole_pictogram_url': None, 'leader_pictogram_rating_display': None,
+        'game_board': snapshot['game_board'], 'current_num_board_cells': snapshot['current_num_board_cells'],
+        'current_user_data': dict(current_g_user_dict) if current_g_user_dict else None, 'num_cards_on_table': len(snapshot['table_cards']),
         'all_cards_placed_for_guessing_phase_to_template': False, 'flashed_messages': []
     }
-
-    raw_table_cards = db.execute("SELECT i.id, i.image, i.subfolder, i.owner_id, u.name as owner_name, i.guesses FROM images i LEFT JOIN users u ON i.owner_id = u.id WHERE i.subfolder = ? AND i.status LIKE 'На столе:%' AND (u.status = 'active' OR u.status IS NULL)", (active_subfolder_val,)).fetchall() if active_subfolder_val else []
-    game_state['num_cards_on_table'] = len(raw_table_cards)
+    users_by_id = snapshot['users_by_id']
+    is_active_user = bool(current_g_user_dict and current_g_user_dict['status'] == 'active')
 
     if game_state['game_in_progress'] and not game_state['game_over']:
         # This condition checks if enough cards are placed for guessing phase
-        game_state['all_cards_placed_for_guessing_phase_to_template'] = (game_state['num_active_players'] > 0 and game_state['num_cards_on_table'] >= game_state['num_active_players'])
+        game_state['all_cards_placed_for_guessing_phase_to_template'] = snapshot['all_cards_placed']
 
-        for card_row in raw_table_cards:
-            guesses_data = json.loads(card_row['guesses'] or '{}')
+        for card in snapshot['table_cards']:
             my_guess_val = None
             # If current user is active, in guessing phase, and not the owner, show their guess
-            if current_g_user_dict and current_g_user_dict['status'] == 'active' and \
-               game_state['all_cards_placed_for_guessing_phase_to_template'] and \
-               not game_state['show_card_info'] and card_row['owner_id'] != current_g_user_dict['id']:
-                my_guess_val = guesses_data.get(str(current_g_user_dict['id']))
-
-            game_state['table_images'].append({
-                'id': card_row['id'],
-                'image': card_row['image'],
-                'subfolder': card_row['subfolder'],
-                'owner_id': card_row['owner_id'],
-                'owner_name': get_user_name(card_row['owner_id']) or "N/A", # Still use get_user_name for initial owner_name
-                'guesses': guesses_data,
-                'my_guess_for_this_card_value': my_guess_val
-            })
-
-        if current_g_user_dict and current_g_user_dict['status'] == 'active' and active_subfolder_val:
-            user_cards_db = db.execute("SELECT id, image, subfolder FROM images WHERE owner_id = ? AND subfolder = ? AND status LIKE 'Занято:%'", (current_g_user_dict['id'], active_subfolder_val)).fetchall()
-            game_state['user_cards'] = [{'id': r['id'], 'image': r['image'], 'subfolder': r['subfolder']} for r in user_cards_db]
+            if is_active_user and game_state['all_cards_placed_for_guessing_phase_to_template'] and \
+               not game_state['show_card_info'] and card['owner_id'] != current_g_user_dict['id']:
+                my_guess_val = card['guesses'].get(str(current_g_user_dict['id']))
+            owner = users_by_id.get(card['owner_id'])
+            game_state['table_images'].append(dict(card, owner_name=owner['name'] if owner else "N/A", my_guess_for_this_card_value=my_guess_val))
+
+        if is_active_user and game_state['active_subfolder']:
+            game_state['user_cards'] = snapshot['hands'].get(current_g_user_dict['id'], [])
 
             # Check if current user has a card on the table
             if any(tc['owner_id'] == current_g_user_dict['id'] for tc in game_state['table_images']):
                 game_state['on_table_status'] = True
 
-            # Populate all_users_for_guessing with active users who have cards on the table
-            # --- ИЗМЕНЕНО: Этот список только для выпадающего списка, имена берутся из all_users_info ---
-            all_active_users_db = db.execute("SELECT id, name FROM users WHERE status = 'active'").fetchall()
-            active_users_with_card_on_table = [
-                u for u in all_active_users_db
-                if any(card['owner_id'] == u['id'] for card in game_state['table_images'])
-            ]
-            game_state['all_users_for_guessing'] = [{'id': u['id'], 'name': u['name']} for u in active_users_with_card_on_table] # Пока оставляем имена здесь, но основная логика в user.html будет брать из all_users_info
-            # --- КОНЕЦ ИЗМЕНЕННОГО БЛОКА ---
-
+            # Активные игроки с картами на столе; имена в user.html берутся из all_users_info
+            game_state['all_users_for_guessing'] = snapshot['all_users_for_guessing']
 
             if game_state['db_current_leader_id'] is not None:
                 game_state['is_current_user_the_db_leader'] = (current_g_user_dict['id'] == game_state['db_current_leader_id'])
@@ -240,66 +780,240 @@ def get_full_game_state_data(user_code_for_state=None):
                not game_state['show_card_info'] and not game_state['all_cards_placed_for_guessing_phase_to_template']:
                 leader_rating = int(current_g_user_dict.get('rating', 0))
                 game_state['leader_pictogram_rating_display'] = leader_rating
-                if leader_rating > 0 and _current_game_board_pole_image_config and leader_rating <= _current_game_board_num_cells and (leader_rating - 1) < len(_current_game_board_pole_image_config):
-                    game_state['leader_pole_pictogram_path'] = _current_game_board_pole_image_config[leader_rating - 1]
+                if 0 < leader_rating <= len(snapshot['board_layout']):
+                    game_state['leader_pole_pictogram_path'] = snapshot['board_layout'][leader_rating - 1]
+                    game_state['leader_pole_pictogram_url'] = static_url(game_state['leader_pole_pictogram_path'])
 
     elif game_state['show_card_info']:
         # If game is not in progress but cards are shown (e.g., after scoring)
-        for card_row in raw_table_cards:
-             guesses_data = json.loads(card_row['guesses'] or '{}')
-             game_state['table_images'].append({
-                 'id': card_row['id'],
-                 'image': card_row['image'],
-                 'subfolder': card_row['subfolder'],
-                 'owner_id': card_row['owner_id'],
-                 'owner_name': get_user_name(card_row['owner_id']) or "N/A",
-                 'guesses': guesses_data,
-                 'my_guess_for_this_card_value': None # No active guessing possible here
-             })
+        for card in snapshot['table_cards']:
+            owner = users_by_id.get(card['owner_id'])
+            game_state['table_images'].append(dict(card, owner_name=owner['name'] if owner else "N/A", my_guess_for_this_card_value=None))
         # all_users_for_guessing remains empty in this case
 
-
-    # Always get data for the game board based on active users
-    all_active_users_for_board = db.execute("SELECT id, name, rating FROM users WHERE status = 'active'").fetchall()
-    game_state['game_board'] = generate_game_board_data_for_display(all_active_users_for_board)
-    game_state['current_num_board_cells'] = _current_game_board_num_cells
-
     # Flashed messages are handled by the template on initial render/redirect.
     # For SocketIO updates, we don't need to pass them here.
-
     return game_state
-    
-def broadcast_game_state_update(user_code_trigger=None): # Без изменений
-    print(f"SocketIO: Broadcasting game_update. Triggered by: {user_code_trigger or 'System'}", file=sys.stderr)
-    active_sids = list(connected_users_socketio.keys())
-    if not active_sids: print("SocketIO: No identified clients to broadcast to.", file=sys.stderr); return
-    for sid_to_update in active_sids:
-        user_code_for_sid = connected_users_socketio.get(sid_to_update)
-        if user_code_for_sid:
-            try:
-                with app.app_context(): state_data = get_full_game_state_data(user_code_for_state=user_code_for_sid); socketio.emit('game_update', state_data, room=sid_to_update)
-            except Exception as e: print(f"SocketIO: Error sending update to SID {sid_to_update} (user {user_code_for_sid}): {e}\n{traceback.format_exc()}", file=sys.stderr)
+
+def get_full_game_state_data(user_code_for_state=None, snapshot=None):
+    if snapshot is None: snapshot = get_shared_game_state_snapshot(get_db())
+    current_g_user_dict = snapshot['users_by_code'].get(user_code_for_state) if user_code_for_state else None
+    return build_game_state_for_user(snapshot, current_g_user_dict)
+
+def get_socket_registry_client():
+    """Клиент redis для реестра сокетов и версии состояния, общих для всех воркеров; None - реестр в памяти процесса."""
+    if _socket_registry['client'] is None and SOCKETIO_MESSAGE_QUEUE and SOCKETIO_MESSAGE_QUEUE.startswith(('redis://', 'rediss://', 'unix://')):
+        import redis # Нужен только при работе через очередь сообщений
+        _socket_registry['client'] = redis.Redis.from_url(SOCKETIO_MESSAGE_QUEUE, decode_responses=True)
+    return _socket_registry['client']
+# Реестр в redis (для каждого стола): <префикс>sids - {sid: user_code} всех воркеров, <префикс>worker:<воркер> - sid этого
+# воркера, <префикс>workers - воркер -> время последней отметки. Отметку обновляет фоновая задача каждого воркера
+def registry_worker_id():
+    """Имя этого процесса в реестре; после fork или перезапуска - новое, а sid прежнего процесса уйдут по TTL."""
+    if _socket_registry['pid'] != os.getpid(): _socket_registry.update(pid=os.getpid(), worker=f"{os.getpid()}-{os.urandom(4).hex()}", heartbeat_started=False, pruned_at={})
+    return _socket_registry['worker']
+def heartbeat_socket_registry(client):
+    worker = registry_worker_id(); now = time.time()
+    for table in _game_tables.values(): client.zadd(table.registry_prefix + 'workers', {worker: now})
+def run_socket_registry_heartbeat():
+    while True:
+        try: heartbeat_socket_registry(get_socket_registry_client())
+        except Exception as e: print(f"SocketIO: Registry heartbeat error: {e}", file=sys.stderr)
+        socketio.sleep(SOCKET_REGISTRY_TTL / 3)
+def prune_socket_registry(client, table):
+    """Убирает из реестра стола sid воркеров без отметки дольше SOCKET_REGISTRY_TTL и sid, не принадлежащие ни одному воркеру.
+    Возвращает число удаленных sid."""
+    prefix = table.registry_prefix
+    for worker in client.zrangebyscore(prefix + 'workers', 0, time.time() - SOCKET_REGISTRY_TTL):
+        pipe = client.pipeline(); pipe.delete(prefix + 'worker:' + worker); pipe.zrem(prefix + 'workers', worker); pipe.execute()
+    registered_sids = client.hkeys(prefix + 'sids') # До множеств воркеров: sid, добавленный между чтениями, не попадет в удаляемые
+    live_sids = set()
+    for worker in client.zrange(prefix + 'workers', 0, -1): live_sids.update(client.smembers(prefix + 'worker:' + worker))
+    stale_sids = [sid for sid in registered_sids if sid not in live_sids]
+    if stale_sids: client.hdel(prefix + 'sids', *stale_sids); print(f"SocketIO: Removed {len(stale_sids)} stale sockets of stopped workers from the registry.", file=sys.stderr)
+    return len(stale_sids)
+def register_socket(sid, user_code):
+    client = get_socket_registry_client(); table = current_table()
+    if client is None: table.sockets[sid] = user_code; return
+    worker = registry_worker_id()
+    pipe = client.pipeline() # Транзакция: sid не бывает в общем списке без множества своего воркера
+    pipe.hset(table.registry_prefix + 'sids', sid, user_code); pipe.sadd(table.registry_prefix + 'worker:' + worker, sid)
+    pipe.zadd(table.registry_prefix + 'workers', {worker: time.time()}); pipe.execute()
+    if not _socket_registry['heartbeat_started']: _socket_registry['heartbeat_started'] = True; socketio.start_background_task(run_socket_registry_heartbeat)
+def unregister_socket(sid):
+    """Убирает sid из реестра, возвращает его user_code (или None)."""
+    client = get_socket_registry_client(); table = current_table()
+    if client is None: return table.sockets.pop(sid, None)
+    pipe = client.pipeline(); pipe.hget(table.registry_prefix + 'sids', sid); pipe.hdel(table.registry_prefix + 'sids', sid)
+    pipe.srem(table.registry_prefix + 'worker:' + registry_worker_id(), sid)
+    return pipe.execute()[0]
+def get_socket_user_code(sid):
+    client = get_socket_registry_client(); table = current_table()
+    return table.sockets.get(sid) if client is None else client.hget(table.registry_prefix + 'sids', sid)
+def get_connected_sockets():
+    """[(sid, user_code)] всех подключенных к столу клиентов, на каком бы воркере они ни были."""
+    client = get_socket_registry_client(); table = current_table()
+    if client is None: return list(table.sockets.items())
+    registry_worker_id() # Сбрасывает отметку чистки после fork
+    if time.time() - _socket_registry['pruned_at'].get(table.slug, 0) >= SOCKET_REGISTRY_TTL / 3: # Чистка не чаще раза за период отметки
+        _socket_registry['pruned_at'][table.slug] = time.time(); prune_socket_registry(client, table)
+    return list(client.hgetall(table.registry_prefix + 'sids').items())
+def table_room(room): return current_table().room_name(room)
+def user_room(user_code): return table_room(f"user:{user_code}")
+
+def next_game_state_version():
+    client = get_socket_registry_client(); table = current_table()
+    if client is not None: return int(client.incr(table.registry_prefix + 'state_version'))
+    table.state_version += 1
+    return table.state_version
+def current_game_state_version():
+    client = get_socket_registry_client(); table = current_table()
+    return table.state_version if client is None else int(client.get(table.registry_prefix + 'state_version') or 0)
+
+def emit_game_state(room, state, version):
+    """Отправляет комнате полный снимок (game_update) или только изменившиеся разделы (game_state_delta).
+    Базой дельты служит то, что этот воркер отправлял комнате последним; если с тех пор клиенту писал другой воркер,
+    base_version не совпадет, и клиент сам запросит полное состояние."""
+    last_state_sent = current_table().last_state_sent_by_room
+    prev = last_state_sent.get(room)
+    if prev is None:
+        last_state_sent[room] = (version, state)
+        socketio.emit('game_update', dict(state, state_version=version), room=room); return
+    changes = {k: v for k, v in state.items() if prev[1].get(k) != v}
+    if not changes: return # Комната уже видит это состояние, версию для нее не двигаем
+    last_state_sent[room] = (version, state)
+    socketio.emit('game_state_delta', {'state_version': version, 'base_version': prev[0], 'changes': changes}, room=room)
+def send_full_state_to_sid(sid, user_code):
+    """Полное состояние одному сокету (подключение или пересинхронизация)."""
+    table = current_table()
+    with table_context(table.slug): state = get_full_game_state_data(user_code_for_state=user_code)
+    room = user_room(user_code) if user_code else table_room(ROOM_SPECTATORS)
+    prev = table.last_state_sent_by_room.get(room)
+    # Комната видит то же состояние - новая вкладка получает ее версию, и следующая дельта комнаты ляжет на нее.
+    # Иначе другие вкладки комнаты могут видеть более старое состояние - следующая рассылка уйдет им полным снимком
+    if prev is not None and prev[1] == state: version = prev[0]
+    else: table.last_state_sent_by_room.pop(room, None); version = current_game_state_version()
+    socketio.emit('game_update', dict(state, state_version=version), room=sid)
+
+def broadcast_game_state_update(user_code_trigger=None):
+    """Помечает состояние стола измененным; рассылка уйдет фоновой задачей не чаще раза в BROADCAST_DEBOUNCE_SECONDS.
+    Обработчик HTTP не ждет emit, а серия изменений подряд дает одну рассылку с итоговым состоянием."""
+    table = current_table(); scheduler = table.broadcast_scheduler
+    with scheduler['lock']:
+        scheduler['dirty'] = True; scheduler['triggers'].add(user_code_trigger or 'System')
+        if scheduler['running']: return
+        scheduler['running'] = True
+    socketio.start_background_task(run_broadcast_scheduler, table.slug)
+def run_broadcast_scheduler(table_slug=''):
+    """Фоновый цикл рассылки стола: пока между проходами появлялись изменения, отправляет еще одну - последнее состояние уходит всегда.
+    У каждого стола свой цикл, так что долгая рассылка одного стола не задерживает другие."""
+    scheduler = _game_tables[table_slug].broadcast_scheduler
+    while True:
+        socketio.sleep(BROADCAST_DEBOUNCE_SECONDS)
+        with scheduler['lock']:
+            if not scheduler['dirty']: scheduler['running'] = False; return
+            triggers = scheduler['triggers']
+            scheduler.update(dirty=False, triggers=set())
+        try:
+            with table_context(table_slug), sql_stats_scope(f"broadcast{f' (table {table_slug})' if table_slug else ''}"): flush_game_state_broadcast(', '.join(sorted(triggers)))
+        except Exception as e: print(f"SocketIO: Broadcast scheduler error: {e}\n{traceback.format_exc()}", file=sys.stderr)
+def flush_game_state_broadcast(user_code_trigger=None):
+    """Немедленная рассылка текущего состояния всем подключенным к столу клиентам."""
+    table = current_table()
+    print(f"SocketIO: Broadcasting game_update{f' (table {table.slug})' if table.slug else ''}. Triggered by: {user_code_trigger or 'System'}", file=sys.stderr)
+    # Состояние строится один раз на игрока (а не на вкладку) и одно общее - для всех зрителей
+    user_codes = {user_code for _, user_code in get_connected_sockets()}
+    if not user_codes: print("SocketIO: No connected clients to broadcast to.", file=sys.stderr); return
+    try:
+        # Общий снимок строится один раз на всю рассылку, на игрока остается только персональная часть
+        with table_context(table.slug): snapshot = get_shared_game_state_snapshot(get_db())
+    except Exception as e: print(f"SocketIO: Error building shared game state snapshot: {e}\n{traceback.format_exc()}", file=sys.stderr); return
+    version = next_game_state_version()
+    for user_code in user_codes:
+        room = user_room(user_code) if user_code else table_room(ROOM_SPECTATORS)
+        try: emit_game_state(room, get_full_game_state_data(user_code_for_state=user_code or None, snapshot=snapshot), version)
+        except Exception as e: print(f"SocketIO: Error sending update to room {room}: {e}\n{traceback.format_exc()}", file=sys.stderr)
 def broadcast_user_list_update(): print("SocketIO: broadcast_user_list_update() called -> general game state update.", file=sys.stderr); broadcast_game_state_update()
 def broadcast_deck_votes_update(): # Без изменений
     print("SocketIO: broadcast_deck_votes_update() called.", file=sys.stderr)
     try:
-        with app.app_context():
+        with table_context(current_table_slug()):
             db = get_db(); c = db.cursor()
             c.execute("SELECT i.subfolder, COALESCE(dv.votes, 0) as votes FROM (SELECT DISTINCT subfolder FROM images ORDER BY subfolder) as i LEFT JOIN deck_votes as dv ON i.subfolder = dv.subfolder;")
             deck_votes_data = [dict(row) for row in c.fetchall()]
-            socketio.emit('deck_votes_updated', {'deck_votes': deck_votes_data})
+            socketio.emit('deck_votes_updated', {'deck_votes': deck_votes_data}, room=table_room(ROOM_TABLE))
     except Exception as e: print(f"Error broadcasting deck votes: {e}\n{traceback.format_exc()}", file=sys.stderr)
 
-app.jinja_env.globals.update(get_user_name=get_user_name, get_leading_user_id=get_leading_user_id)
-
-@app.before_request # Без изменений
+@app.url_defaults
+def add_static_fingerprint(endpoint, values):
+    """url_for('static', ...) во всех шаблонах получает отпечаток содержимого файла."""
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        fingerprint = file_fingerprint(app.static_folder, values['filename'])
+        if fingerprint: values['v'] = fingerprint
+
+@app.url_defaults
+def add_table_slug(endpoint, values):
+    """url_for() внутри стола ведет на этот же стол (/t/<стол>/...); table='' - ссылка на основной стол."""
+    if endpoint == 'static': return # Статика общая для всех столов
+    slug = values.pop('table') if 'table' in values else current_table_slug()
+    if slug: values['table'] = slug
+
+@app.url_value_preprocessor
+def pull_table_slug(endpoint, values):
+    """Стол из префикса URL - в g.table, представления его не принимают. Неизвестный стол - 404."""
+    g.table = values.pop('table', '') if values else ''
+    if g.table not in _game_tables: abort(404)
+
+class TableSessionInterface(SecureCookieSessionInterface):
+    """Своя cookie сессии у каждого стола: вход игрока и администратора действует только за своим столом."""
+    def get_cookie_name(self, app):
+        slug = request_table_slug()
+        return f"{app.config['SESSION_COOKIE_NAME']}-{slug}" if slug else app.config['SESSION_COOKIE_NAME']
+app.session_interface = TableSessionInterface()
+
+def send_static_asset(filename):
+    """Статика с учетом отпечатков: URL с ?v= (и content-addressed варианты карт) кэшируются навсегда,
+    для текстовых ассетов отдается заранее сжатая копия .br/.gz, если она есть."""
+    precompressed = pick_precompressed(app.static_folder, filename, request.headers.get('Accept-Encoding'))
+    if precompressed:
+        response = send_from_directory(app.static_folder, precompressed[0], mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['Content-Encoding'] = precompressed[1]
+    else: response = send_from_directory(app.static_folder, filename)
+    response.vary.add('Accept-Encoding')
+    # Навсегда - только если отпечаток в URL совпадает с текущим содержимым: устаревший или опечатанный ?v= иначе
+    # закрепил бы в кэшах не тот файл на год. Имена вариантов карт сами содержат SHA-1 содержимого
+    if filename.startswith('variants/') or (request.args.get('v') and request.args.get('v') == file_fingerprint(app.static_folder, filename)):
+        response.cache_control.no_cache = None; response.cache_control.public = True; response.cache_control.max_age = 31536000; response.cache_control.immutable = True
+    return response
+
+app.jinja_env.globals.update(get_user_name=get_user_name, get_leading_user_id=get_leading_user_id, image_variant_path=image_variant_path, game_tables=GAME_TABLES, current_table_slug=current_table_slug)
+
+@app.before_request
+def begin_request_sql_stats():
+    if request.endpoint != 'static': g.sql_stats_token = begin_sql_stats(f"{request.method} {request.path}")
+
+@app.after_request
+def add_sql_stats_headers(response):
+    stats = _sql_stats.get()
+    if app.debug and stats is not None and 'sql_stats_token' in g: # Видно во вкладке Network браузера, в том числе Server-Timing
+        response.headers['X-SQL-Queries'] = str(stats['count']); response.headers['X-SQL-Time-Ms'] = f"{stats['ms']:.2f}"
+        response.headers['Server-Timing'] = f'sql;dur={stats["ms"]:.2f};desc="{stats["count"]} queries"'
+    return response
+
+@app.teardown_request
+def end_request_sql_stats(error=None):
+    token = g.pop('sql_stats_token', None)
+    if token is not None: end_sql_stats(token)
+
+@app.before_request
 def before_request_func():
+    if request.endpoint == 'static': return # Статике не нужны ни БД, ни сессия
     db = get_db()
     code_param = request.args.get('code') or (request.view_args.get('code') if request.view_args else None) or session.get('user_code')
     g.user = None; g.user_id = None
     if code_param:
         try:
-            user_row = db.execute("SELECT id, name, code, rating, status FROM users WHERE code = ?", (code_param,)).fetchone()
+            user_row = get_user_by_code(code_param, db)
             if user_row:
                 g.user = dict(user_row); g.user_id = user_row['id']
                 session.update({k: user_row[k] for k in ['id', 'name', 'code', 'rating', 'status'] if k in user_row})
@@ -319,7 +1033,7 @@ def index():
     return render_template("index.html", deck_votes=deck_votes_data, current_vote=session.get('voted_for_deck'), active_subfolder=get_setting('active_subfolder') or "N/A")
 
 @app.route('/init_db_route_for_dev_only_make_sure_to_secure_or_remove') # Без изменений
-def init_db_route(): flash("БД инициализируется при старте приложения.", "info"); return redirect(url_for('index'))
+def init_db_route(): flash("Схема БД и каталог карт обновляются при старте приложения (без потери данных).", "info"); return redirect(url_for('index'))
 
 @app.route("/login_player") # Без изменений
 def login_player(): return redirect(url_for('user', code=session['user_code'])) if session.get('user_code') else render_template('login_player.html')
@@ -337,7 +1051,7 @@ def register_or_login_player():
         else:
             code = generate_unique_code(); status = 'pending' if is_game_in_progress() else 'active'
             c.execute("INSERT INTO users (name, code, status, rating) VALUES (?, ?, ?, 0)", (name, code, status))
-            uid = c.lastrowid; db.commit()
+            uid = c.lastrowid; record_game_event(db, EVENT_JOIN, {'u': uid, 'n': name, 'c': code, 'st': status}); db.commit(); invalidate_users_cache()
             session.update({'user_id': uid, 'user_name': name, 'user_code': code, 'user_status': status, 'user_rating': 0})
             flash(f"Добро пожаловать, {name}! Вы {'наблюдатель' if status == 'pending' else 'активный участник'}.", "success")
             broadcast_user_list_update()
@@ -422,7 +1136,8 @@ def admin():
                      status = 'pending' if is_game_in_progress() else 'active'
                      c.execute("INSERT INTO users (name, code, status, rating) VALUES (?, ?, ?, 0)", (name, code, status))
                      uid = c.lastrowid # Получаем ID нового пользователя
-                     db.commit() # Фиксируем создание пользователя
+                     record_game_event(db, EVENT_JOIN, {'u': uid, 'n': name, 'c': code, 'st': status})
+                     db.commit(); invalidate_users_cache() # Фиксируем создание пользователя
 
                      flash(f"Пользователь '{name}' добавлен (Код: {code}). Статус: {'Ожидает' if status == 'pending' else 'Активен'}.", "success")
                      # Отправляем обновление, чтобы другие клиенты увидели нового игрока в списке/на поле ожидания
@@ -456,13 +1171,18 @@ def admin():
                     is_deleted_user_leader = (current_leader_id is not None and current_leader_id == user_id_to_delete_int)
 
                     # 1. Возвращаем все карты удаляемого пользователя в колоду и сбрасываем их предположения
-                    # Это затронет как карты в руке ('Занято:...'), так и карты на столе ('На столе:...').
-                    c.execute("UPDATE images SET owner_id = NULL, status = 'Свободно', guesses = '{}' WHERE owner_id = ?", (user_id_to_delete_int,))
+                    # Это затронет как карты в руке (hand), так и карты на столе (table).
+                    c.execute("DELETE FROM guesses WHERE guesser_id = ? OR image_id IN (SELECT id FROM images WHERE owner_id = ?)", (user_id_to_delete_int, user_id_to_delete_int))
+                    returned_cards = c.execute("SELECT id, subfolder FROM images WHERE owner_id = ?", (user_id_to_delete_int,)).fetchall()
+                    c.execute("UPDATE images SET owner_id = NULL, state = ? WHERE owner_id = ?", (CARD_STATE_FREE, user_id_to_delete_int))
+                    for returned_subfolder in {row['subfolder'] for row in returned_cards}:
+                        return_cards_to_draw_pile(db, returned_subfolder, [row['id'] for row in returned_cards if row['subfolder'] == returned_subfolder])
                     print(f"Admin Delete: Вернули карты пользователя '{deleted_user_name}' (ID {user_id_to_delete_int}) в колоду и сбросили предположения на них.", file=sys.stderr)
 
                     # 2. Удаляем запись пользователя из таблицы users
                     c.execute("DELETE FROM users WHERE id = ?", (user_id_to_delete_int,))
-                    db.commit() # Фиксируем удаление пользователя и обновление карт
+                    record_game_event(db, EVENT_DELETE, {'u': user_id_to_delete_int}, snapshot=True)
+                    advance_round_version(db); db.commit(); invalidate_users_cache() # Фиксируем удаление пользователя и обновление карт
 
                     flash(f"Пользователь '{deleted_user_name}' удален.", "success")
                     print(f"Admin Delete: Пользователь '{deleted_user_name}' (ID {user_id_to_delete_int}) успешно удален из БД.", file=sys.stderr)
@@ -483,13 +1203,13 @@ def admin():
                               set_leading_user_id(None)
                               # Сообщение об отсутствии ведущего будет добавлено после broadcast
 
-                         # Перемещаем любые карты, оставшиеся на столе (от ЛЮБЫХ игроков), в статус "Занято:Админ" и сбрасываем информацию
-                         c.execute("UPDATE images SET owner_id = NULL, guesses = '{}', status = 'Занято:Админ' WHERE status LIKE 'На столе:%'")
+                         # Перемещаем любые карты, оставшиеся на столе (от ЛЮБЫХ игроков), в сброс ("Занято:Админ") и сбрасываем информацию
+                         c.execute("UPDATE images SET owner_id = NULL, state = ? WHERE state = ?", (CARD_STATE_DISCARD, CARD_STATE_TABLE))
                          print("Admin Delete: Переместили все карты со стола в статус 'Занято:Админ'.", file=sys.stderr)
 
-                         # Сбрасываем предположения на любых других картах, которые не были на столе
-                         c.execute("UPDATE images SET guesses = '{}' WHERE status NOT LIKE 'На столе:%' AND guesses != '{}'")
-                         print("Admin Delete: Сброшены предположения на картах вне стола.", file=sys.stderr)
+                         # Сбрасываем все предположения прошлого раунда
+                         c.execute("DELETE FROM guesses"); record_game_event(db, EVENT_NEW_ROUND)
+                         print("Admin Delete: Сброшены предположения.", file=sys.stderr)
 
                          # Сбрасываем флаг показа информации о картах
                          set_setting("show_card_info", "false")
@@ -510,26 +1230,19 @@ def admin():
                                    flash("Активная колода не установлена для раздачи карт в новом раунде после удаления ведущего.", "warning")
                                    print("Admin Delete: Активная колода не установлена для раздачи карт после удаления ведущего.", file=sys.stderr)
                               else:
-                                   available_cards = [r['id'] for r in c.execute("SELECT id FROM images WHERE subfolder = ? AND status = 'Свободно'", (active_subfolder,)).fetchall()]
-                                   random.shuffle(available_cards)
-                                   num_dealt_total = 0
                                    # Раздаем по одной карте каждому игроку
-                                   for i, user_id in enumerate(remaining_active_user_ids):
-                                        if num_dealt_total < len(available_cards):
-                                             c.execute("UPDATE images SET status = ?, owner_id = ? WHERE id = ?", (f"Занято:{user_id}", user_id, available_cards[num_dealt_total]));
-                                             num_dealt_total += 1
-                                        else:
-                                             flash(f"Внимание: Закончились карты в колоде '{active_subfolder}'. Не все игроки получили по 1 карте в новом раунде после удаления ведущего.", "warning");
-                                             print(f"Admin Delete: Закончились карты ({active_subfolder}) при раздаче 1 карты на игрока после удаления ведущего.", file=sys.stderr)
-                                             break # Недостаточно карт
+                                   num_dealt_total, num_available = deal_cards(db, active_subfolder, remaining_active_user_ids, 1)
+                                   if num_dealt_total < len(remaining_active_user_ids):
+                                        flash(f"Внимание: Закончились карты в колоде '{active_subfolder}'. Не все игроки получили по 1 карте в новом раунде после удаления ведущего.", "warning");
+                                        print(f"Admin Delete: Закончились карты ({active_subfolder}) при раздаче 1 карты на игрока после удаления ведущего.", file=sys.stderr)
 
                                    if num_dealt_total > 0 : flash(f"В новом раунде роздано {num_dealt_total} новых карт после удаления ведущего.", "info")
-                                   elif not available_cards and remaining_active_user_ids : flash(f"В колоде '{active_subfolder}' нет карт для раздачи в новом раунде после удаления ведущего.", "info")
+                                   elif not num_available and remaining_active_user_ids : flash(f"В колоде '{active_subfolder}' нет карт для раздачи в новом раунде после удаления ведущего.", "info")
                                    print(f"Admin Delete: Роздано {num_dealt_total} карт в новом раунде после удаления ведущего.", file=sys.stderr)
 
 
                          # Фиксируем все изменения, связанные с новым раундом
-                         db.commit()
+                         advance_round_version(db); db.commit()
 
                          # Сообщаем о новом ведущем, если он был определен
                          if next_leader_id_ar:
@@ -547,12 +1260,12 @@ def admin():
                     flash("Некорректный ID пользователя для удаления.", "danger")
                     print("Admin Delete Error: Некорректный формат ID пользователя.", file=sys.stderr)
                 except sqlite3.Error as e:
-                    db.rollback() # Откатываем изменения в случае ошибки БД
+                    rollback_round_write(db) # Откатываем изменения в случае ошибки БД
                     flash(f"Ошибка БД при удалении пользователя: {e}", "danger")
                     print(f"CRITICAL ERROR during user deletion DB operation: {e}\n{traceback.format_exc()}", file=sys.stderr)
                 except Exception as e:
                     # Перехватываем любые другие исключения в процессе удаления
-                    db.rollback() # Убеждаемся, что изменения отменены, если что-то пошло не так
+                    rollback_round_write(db) # Убеждаемся, что изменения отменены, если что-то пошло не так
                     flash(f"Произошла ошибка при удалении пользователя: {e}", "danger")
                     print(f"CRITICAL ERROR during user deletion process: {e}\n{traceback.format_exc()}", file=sys.stderr)
 
@@ -576,7 +1289,7 @@ def admin():
             active_users_for_board_init = c.execute("SELECT id, name, rating FROM users WHERE status = 'active'").fetchall()
             # Инициализируем новую конфигурацию визуализации поля
             initialize_new_game_board_visuals(num_cells_for_board=num_cells, all_users_for_rating_check=active_users_for_board_init)
-            # Изменения _current_game_board_pole_image_config хранятся в памяти, не требуют коммита БД
+            # Раскладка сохраняется в settings (set_setting фиксирует ее сама)
             flash("Визуализация игрового поля обновлена.", "success")
             # Сообщаем клиентам об обновлении игрового поля
             broadcast_game_state_update()
@@ -600,27 +1313,17 @@ def admin():
     users_raw = c.execute("SELECT id, name, code, rating, status FROM users ORDER BY status DESC, name ASC").fetchall()
     users_for_template = [dict(row) for row in users_raw]
 
-    # Получаем список изображений
-    images_db = c.execute("SELECT id, subfolder, image, status, owner_id, guesses FROM images ORDER BY subfolder, id LIMIT 1000").fetchall() # Ограничение для производительности
-    images_for_template = []
-    # Собираем информацию о владельцах карт и всех предположениях для отображения в таблице
+    # Первая страница каталога карт с фильтрами; остальное подгружается с /admin/images
+    image_filters = parse_admin_image_filters(request.args)
+    images_for_template = [dict(img_row) for img_row in query_admin_images(db, image_filters, limit=ADMIN_IMAGES_PAGE_SIZE).fetchall()]
+    images_total_for_template = query_admin_images(db, image_filters, count_only=True).fetchone()[0]
+    # Владельцы карт, по которым есть предположения (для отображения деталей предположений)
     image_owners_for_template = {}
+    # Все предположения в формате {image_id: {str(guesser_id): guessed_owner_id}}
     all_guesses_for_template = {}
-
-    for img_row in images_db:
-        img_dict = dict(img_row)
-        try:
-            # Парсим предположения
-            img_dict['guesses'] = json.loads(img_row['guesses'] or '{}')
-            # Сохраняем предположения, если они есть
-            if img_dict['guesses'] and img_dict['id'] is not None:
-                 all_guesses_for_template[img_dict['id']] = img_dict['guesses']
-        except json.JSONDecodeError:
-            img_dict['guesses'] = {} # В случае ошибки парсинга JSON делаем пустой словарь
-        # Сохраняем ID владельца, если он есть
-        if img_dict.get('owner_id') is not None:
-             image_owners_for_template[img_dict['id']] = img_dict['owner_id']
-        images_for_template.append(img_dict)
+    for row in c.execute("SELECT g.image_id, g.guesser_id, g.guessed_owner_id, i.owner_id FROM guesses g JOIN images i ON i.id = g.image_id").fetchall():
+        all_guesses_for_template.setdefault(row['image_id'], {})[str(row['guesser_id'])] = row['guessed_owner_id']
+        if row['owner_id'] is not None: image_owners_for_template[row['image_id']] = row['owner_id']
 
     # Получаем список всех подпапок с изображениями
     subfolders_for_template = [row['subfolder'] for row in c.execute("SELECT DISTINCT subfolder FROM images ORDER BY subfolder").fetchall()]
@@ -628,37 +1331,20 @@ def admin():
     # Фильтруем список активных пользователей для удобства
     active_users_for_template = [u for u in users_for_template if u['status'] == 'active']
 
-    # Пересчитываем количество предположений для каждого активного пользователя и проверяем на дубликаты
+    # Количество предположений каждого активного игрока и дубликаты (один и тот же игрок угадан для разных карт) - считает SQL
     guess_counts_by_user_for_template = {u['id']: 0 for u in active_users_for_template}
     user_has_duplicate_guesses_for_template = {u['id']: False for u in active_users_for_template}
-
-    if all_guesses_for_template and active_users_for_template:
-        for user_item_dict in active_users_for_template: # Перебираем активных пользователей
-            user_id_str = str(user_item_dict['id'])
-            guesses_made_by_this_user_targets = [] # Список ID игроков, которых угадал данный пользователь
-            for image_id_key_str in all_guesses_for_template: # Перебираем карты с предположениями
-                guesses_on_one_image = all_guesses_for_template[image_id_key_str] # Предположения по одной карте
-                if user_id_str in guesses_on_one_image: # Если текущий пользователь угадывал по этой карте
-                    # Увеличиваем счетчик предположений для этого пользователя
-                    guess_counts_by_user_for_template[user_item_dict['id']] += 1
-                    # Сохраняем ID игрока, которого он угадал (значение в словаре предположений)
-                    try:
-                         guessed_target_id = int(guesses_on_one_image[user_id_str])
-                         guesses_made_by_this_user_targets.append(guessed_target_id)
-                    except (ValueError, TypeError):
-                         print(f"Admin Template: Некорректный guessed_target_id в предположениях для карты {image_id_key_str} пользователем {user_id_str}.", file=sys.stderr)
-                         pass # Пропускаем некорректное значение
-
-            # Проверка на дубликаты: угадывал ли пользователь ОДНОГО И ТОГО ЖЕ ИГРОКА для РАЗНЫХ карт
-            if len(guesses_made_by_this_user_targets) > len(set(guesses_made_by_this_user_targets)):
-                user_has_duplicate_guesses_for_template[user_item_dict['id']] = True
+    for row in c.execute("SELECT g.guesser_id, COUNT(*) AS guess_count, COUNT(DISTINCT g.guessed_owner_id) AS distinct_targets FROM guesses g JOIN users u ON u.id = g.guesser_id WHERE u.status = 'active' GROUP BY g.guesser_id").fetchall():
+        guess_counts_by_user_for_template[row['guesser_id']] = row['guess_count']
+        user_has_duplicate_guesses_for_template[row['guesser_id']] = row['guess_count'] > row['distinct_targets']
 
 
     current_active_subfolder = get_setting('active_subfolder') or ''
     current_leader_from_db = get_leading_user_id()
 
     # Подсчет количества свободных изображений в активной колоде
-    free_image_count_for_template = sum(1 for img in images_for_template if img.get('status') == 'Свободно' and img.get('subfolder') == current_active_subfolder)
+    free_image_count_for_template = draw_pile_remaining(db, current_active_subfolder)
+    if free_image_count_for_template is None: free_image_count_for_template = c.execute("SELECT COUNT(id) FROM images WHERE subfolder = ? AND state = ?", (current_active_subfolder, CARD_STATE_FREE)).fetchone()[0]
 
 
     # Получаем данные для построения игрового поля (только активные игроки)
@@ -670,6 +1356,10 @@ def admin():
     return render_template("admin.html",
                            users=users_for_template,
                            images=images_for_template,
+                           images_total=images_total_for_template,
+                           images_page_size=ADMIN_IMAGES_PAGE_SIZE,
+                           image_filters=image_filters,
+                           card_state_labels=CARD_STATE_LABELS,
                            subfolders=subfolders_for_template,
                            active_subfolder=current_active_subfolder,
                            db_current_leader_id=current_leader_from_db,
@@ -681,11 +1371,39 @@ def admin():
                            guess_counts_by_user=guess_counts_by_user_for_template, # Передаем кол-во предположений по каждому игроку
                            user_has_duplicate_guesses=user_has_duplicate_guesses_for_template, # Передаем флаги дубликатов
                            get_user_name_func=get_user_name, # Функция для получения имени пользователя по ID в шаблоне
-                           current_num_board_cells=_current_game_board_num_cells # Передаем текущий размер игрового поля
+                           current_num_board_cells=len(get_board_layout()) # Передаем текущий размер игрового поля
                            )
 # ===== КОНЕЦ ИЗМЕНЕНИЙ В МАРШРУТЕ ADMIN =====
 
-@app.route("/start_new_game", methods=["POST"]) # Логика без изменений (с последнего раза)
+def parse_admin_image_filters(args):
+    """Фильтры каталога карт из query string: deck (колода), state (CARD_STATE_*), owner (ID игрока)."""
+    owner = args.get('owner', '')
+    return {'deck': args.get('deck') or None, 'state': args.get('state') if args.get('state') in CARD_STATE_LABELS else None,
+            'owner_id': int(owner) if owner.isdigit() else None}
+
+def query_admin_images(db, filters, after_id=0, limit=ADMIN_IMAGES_PAGE_SIZE, count_only=False):
+    """Курсор по каталогу карт: фильтры ложатся на индексы (subfolder/state, owner_id/state), страницы - по id > after_id
+    (без OFFSET), поэтому стоимость страницы не зависит от размера каталога."""
+    clauses, params = [], []
+    for column, key in (('subfolder', 'deck'), ('state', 'state'), ('owner_id', 'owner_id')):
+        if filters.get(key) is not None: clauses.append(f"{column} = ?"); params.append(filters[key])
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    if count_only: return db.execute(f"SELECT COUNT(id) FROM images{where}", params)
+    where = f"{where} AND id > ?" if clauses else " WHERE id > ?"
+    return db.execute(f"SELECT id, subfolder, image, state, owner_id FROM images{where} ORDER BY id LIMIT ?", params + [after_id, limit])
+
+@app.route("/admin/images")
+def admin_images():
+    """Строки таблицы изображений для подгрузки в админке; отдаются потоком прямо из курсора SQLite."""
+    if not session.get('is_admin'): return "Доступ запрещен.", 403
+    try: after_id = int(request.args.get('after_id', 0)); limit = min(max(int(request.args.get('limit', ADMIN_IMAGES_PAGE_SIZE)), 1), ADMIN_IMAGES_MAX_LIMIT)
+    except ValueError: return "Некорректные параметры страницы.", 400
+    images_cursor = query_admin_images(get_db(), parse_admin_image_filters(request.args), after_id, limit)
+    # stream_template держит контекст запроса (и соединение g.db) открытым, пока строки не отданы
+    return stream_template('admin_image_rows.html', images=(dict(row) for row in images_cursor),
+                           active_subfolder=get_setting('active_subfolder') or '', get_user_name_func=get_user_name)
+
+@app.route("/start_new_game", methods=["POST"])
 def start_new_game():
     if not session.get('is_admin'): flash('Доступ запрещен.', 'danger'); return redirect(url_for('login'))
     db = get_db(); c = db.cursor(); selected_deck = request.form.get("new_game_subfolder")
@@ -694,32 +1412,31 @@ def start_new_game():
     if not selected_deck: flash("Колода не выбрана.", "danger"); return redirect(url_for('admin'))
     new_leader_id_sng = None
     try:
+        started = time.perf_counter()
         c.execute("UPDATE users SET status = 'active', rating = 0 WHERE status = 'pending' OR status = 'active'")
-        c.execute("UPDATE images SET owner_id = NULL, guesses = '{}', status = 'Занято:Админ'")
-        c.execute("UPDATE images SET status = 'Свободно' WHERE subfolder = ?", (selected_deck,))
-        set_game_over(False); set_setting("show_card_info", "false"); set_setting("active_subfolder", selected_deck)
-        first_active_user = c.execute("SELECT id FROM users WHERE status = 'active' ORDER BY id LIMIT 1").fetchone()
-        if first_active_user: new_leader_id_sng = first_active_user['id']; set_leading_user_id(new_leader_id_sng)
-        else: set_leading_user_id(None)
-        initialize_new_game_board_visuals(all_users_for_rating_check=c.execute("SELECT id, name, rating FROM users WHERE status = 'active'").fetchall())
-        db.commit()
+        c.execute("UPDATE images SET owner_id = NULL, state = ?, pile_position = NULL", (CARD_STATE_DISCARD,)); c.execute("DELETE FROM guesses"); c.execute("DELETE FROM draw_piles")
+        c.execute("UPDATE images SET state = ? WHERE subfolder = ?", (CARD_STATE_FREE, selected_deck))
+        shuffle_draw_pile(db, selected_deck) # Единственная перетасовка за игру; дальше карты берутся с верха стопки
+        record_game_event(db, EVENT_NEW_GAME, {'d': selected_deck, 'n': num_cards_per_player}, snapshot=True)
         active_user_ids = [row['id'] for row in c.execute("SELECT id FROM users WHERE status = 'active' ORDER BY id").fetchall()]
+        if active_user_ids: new_leader_id_sng = active_user_ids[0]
         if not active_user_ids: flash("Нет активных игроков.", "warning")
         elif num_cards_per_player > 0:
-            available_cards = [row['id'] for row in c.execute("SELECT id FROM images WHERE subfolder = ? AND status = 'Свободно'", (selected_deck,)).fetchall()]
-            random.shuffle(available_cards); total_cards_needed = len(active_user_ids) * num_cards_per_player
-            if len(available_cards) < total_cards_needed: flash(f"Внимание: Недостаточно карт ({len(available_cards)}) для раздачи по {num_cards_per_player} карт {len(active_user_ids)} игрокам. Будет роздано сколько есть.", "warning")
-            card_idx = 0
-            for user_id in active_user_ids:
-                for _ in range(num_cards_per_player):
-                    if card_idx < len(available_cards): c.execute("UPDATE images SET status = ?, owner_id = ? WHERE id = ?", (f"Занято:{user_id}", user_id, available_cards[card_idx])); card_idx += 1
-                    else: break
-                if card_idx >= len(available_cards): break
+            card_idx, num_available = deal_cards(db, selected_deck, active_user_ids, num_cards_per_player)
+            if num_available < len(active_user_ids) * num_cards_per_player: flash(f"Внимание: Недостаточно карт ({num_available}) для раздачи по {num_cards_per_player} карт {len(active_user_ids)} игрокам. Будет роздано сколько есть.", "warning")
             flash(f"Новая игра! Колода: '{selected_deck}'. Роздано {card_idx} карт.", "success")
         else: flash(f"Новая игра! Колода: '{selected_deck}'. Карты не раздавались (0 на игрока).", "info")
+        # Все настройки новой игры и раздача фиксируются одним коммитом
+        # Рейтинги только что обнулены - новая раскладка поля размера по умолчанию
+        advance_round_version(db)
+        if not set_settings({'game_over': 'false', 'show_card_info': 'false', 'active_subfolder': selected_deck, 'board_layout': json.dumps(build_board_layout()),
+                             'leading_user_id': str(new_leader_id_sng) if new_leader_id_sng is not None else '', 'game_in_progress': 'true'}):
+            raise sqlite3.Error("Не удалось сохранить настройки новой игры")
+        invalidate_users_cache() # Статусы и рейтинги игроков сброшены тем же коммитом
+        print(f"New Game: Колода '{selected_deck}', {len(active_user_ids)} игроков, старт за {(time.perf_counter() - started) * 1000:.1f} мс", file=sys.stderr)
         if new_leader_id_sng: flash(f"Ведущий: {get_user_name(new_leader_id_sng)}.", "info")
-        set_game_in_progress(True); db.commit(); broadcast_game_state_update()
-    except Exception as e: db.rollback(); flash(f"Ошибка старта игры: {e}", "danger"); print(traceback.format_exc(), file=sys.stderr)
+        broadcast_game_state_update()
+    except Exception as e: rollback_round_write(db); flash(f"Ошибка старта игры: {e}", "danger"); print(traceback.format_exc(), file=sys.stderr)
     return redirect(url_for('admin', displayed_leader_id=new_leader_id_sng))
 
 @app.route('/user/<code>') # Логика без изменений
@@ -730,52 +1447,101 @@ def user(code):
     session.pop('is_admin', None)
     return render_template('user.html', user_data_for_init=dict(g.user))
 
-@app.route("/user/<code>/place/<int:image_id>", methods=["POST"]) # Логика без изменений
+# Условия хода, которые проверяются прямо в UPDATE/INSERT: значения настроек берутся из таблицы settings той же транзакцией
+SQL_SETTING = "(SELECT value FROM settings WHERE key = '{}')"
+PLACE_CARD_SQL = f"""UPDATE images SET state = '{CARD_STATE_TABLE}' WHERE id = :image_id AND owner_id = :user_id AND state = '{CARD_STATE_HAND}'
+    AND subfolder = {SQL_SETTING.format('active_subfolder')} AND {SQL_SETTING.format('game_in_progress')} = 'true'
+    AND {SQL_SETTING.format('game_over')} IS NOT 'true' AND {SQL_SETTING.format('show_card_info')} IS NOT 'true'
+    AND EXISTS (SELECT 1 FROM users WHERE id = :user_id AND status = 'active')
+    AND NOT (EXISTS (SELECT 1 FROM images WHERE owner_id = :user_id AND state = '{CARD_STATE_TABLE}' AND subfolder = {SQL_SETTING.format('active_subfolder')})
+             AND (SELECT COUNT(id) FROM images WHERE subfolder = {SQL_SETTING.format('active_subfolder')} AND state = '{CARD_STATE_TABLE}') >= (SELECT COUNT(id) FROM users WHERE status = 'active'))"""
+GUESS_SQL = f"""INSERT INTO guesses (image_id, guesser_id, guessed_owner_id)
+    SELECT i.id, :user_id, :guessed_user_id FROM images i JOIN users u ON i.owner_id = u.id
+    WHERE i.id = :image_id AND i.state = '{CARD_STATE_TABLE}' AND u.status = 'active' AND i.owner_id != :user_id
+      AND EXISTS (SELECT 1 FROM users WHERE id = :guessed_user_id AND status = 'active') AND EXISTS (SELECT 1 FROM users WHERE id = :user_id AND status = 'active')
+      AND {SQL_SETTING.format('show_card_info')} IS NOT 'true'
+    ON CONFLICT (image_id, guesser_id) DO UPDATE SET guessed_owner_id = excluded.guessed_owner_id"""
+
+def explain_place_card_rejection(db, player, image_id):
+    """Почему PLACE_CARD_SQL не изменил ни одной строки - (категория, сообщение) для игрока."""
+    c = db.cursor()
+    if is_game_over(): return "warning", "Игра окончена."
+    if not is_game_in_progress(): return "warning", "Игра еще не началась."
+    if get_setting("show_card_info") == "true": return "warning", "Карты уже открыты, менять нельзя."
+    active_subfolder = get_setting('active_subfolder')
+    num_on_table = c.execute("SELECT COUNT(id) FROM images WHERE subfolder = ? AND state = ?", (active_subfolder, CARD_STATE_TABLE)).fetchone()[0]
+    num_active = get_active_players_count(db)
+    card_of_this_user_on_table = c.execute("SELECT id FROM images WHERE owner_id = ? AND state = ? AND subfolder = ?", (player['id'], CARD_STATE_TABLE, active_subfolder)).fetchone()
+    if num_active > 0 and num_on_table >= num_active and card_of_this_user_on_table: return "warning", "Все игроки уже выложили карты, менять нельзя."
+    card_to_place = c.execute("SELECT id, state, owner_id, subfolder, image FROM images WHERE id = ?", (image_id,)).fetchone()
+    if not card_to_place: return "danger", f"Карта ID {image_id} не найдена."
+    if card_to_place['owner_id'] != player['id']: return "danger", f"Вы не владелец карты {image_id}."
+    if card_to_place['state'] == CARD_STATE_TABLE and card_of_this_user_on_table and card_to_place['id'] == card_of_this_user_on_table['id']: return "info", f"Карта '{card_to_place['image']}' уже на столе."
+    if card_to_place['state'] != CARD_STATE_HAND: return "danger", f"Карту '{card_to_place['image']}' ({image_id}) нельзя выложить. Статус: '{CARD_STATE_LABELS.get(card_to_place['state'], card_to_place['state'])}'."
+    if card_to_place['subfolder'] != active_subfolder: return "danger", "Карта не из активной колоды."
+    return "warning", "Состояние игры изменилось, попробуйте еще раз."
+
+def apply_place_card(db, player, image_id):
+    """Выкладывает карту игрока на стол (общая проверка для POST и сокета). Все условия проверяет сам UPDATE
+    внутри BEGIN IMMEDIATE, исход решает число измененных строк; разбор причины отказа - только при отказе.
+    Возвращает (успех, [(категория, сообщение), ...]); при успехе изменения уже зафиксированы."""
+    if not player or player['status'] != 'active': return False, [("warning", "Только активные игроки могут выкладывать карты.")]
+    room = current_table().room
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        previous_card = db.execute(f"SELECT id FROM images WHERE owner_id = ? AND state = '{CARD_STATE_TABLE}' AND subfolder = {SQL_SETTING.format('active_subfolder')}", (player['id'],)).fetchone()
+        if db.execute(PLACE_CARD_SQL, {'image_id': image_id, 'user_id': player['id']}).rowcount != 1:
+            rejection = explain_place_card_rejection(db, player, image_id); db.rollback()
+            return False, [rejection]
+        notes = []
+        returned_ids = [previous_card['id']] if previous_card and previous_card['id'] != image_id else []
+        if returned_ids: db.execute(f"UPDATE images SET state = '{CARD_STATE_HAND}' WHERE id = ?", (returned_ids[0],)); notes.append(("info", "Предыдущая карта возвращена в руку."))
+        db.executemany("DELETE FROM guesses WHERE image_id = ?", [(card_id,) for card_id in [image_id] + returned_ids])
+        image_name = db.execute("SELECT image FROM images WHERE id = ?", (image_id,)).fetchone()['image']
+        record_game_event(db, EVENT_PLACE, {'u': player['id'], 'i': image_id, 'r': returned_ids[0] if returned_ids else None})
+        round_version, round_stamp = advance_round_version(db)
+        db.commit()
+    except Exception: rollback_round_write(db); raise
+    room.card_placed(round_version, round_stamp, image_id, returned_ids[0] if returned_ids else None)
+    notes.append(("success", f"Ваша карта '{image_name}' выложена."))
+    broadcast_game_state_update(user_code_trigger=player['code'])
+    return True, notes
+
+def apply_guess(db, player, image_id, guessed_user_id):
+    """Сохраняет предположение игрока о владельце карты на столе одним условным upsert (GUESS_SQL);
+    возвращает то же, что apply_place_card."""
+    if not player or player['status'] != 'active': return False, [("warning", "Только активные игроки могут делать предположения.")]
+    try: guessed_user_id = int(guessed_user_id)
+    except (TypeError, ValueError): return False, [("warning", "Игрок для предположения не выбран.")]
+    room = current_table().room
+    db.execute("BEGIN IMMEDIATE")
+    if db.execute(GUESS_SQL, {'image_id': image_id, 'user_id': player['id'], 'guessed_user_id': guessed_user_id}).rowcount == 1:
+        try: record_game_event(db, EVENT_GUESS, {'u': player['id'], 'i': image_id, 'o': guessed_user_id}); round_version, round_stamp = advance_round_version(db); db.commit()
+        except Exception: rollback_round_write(db); raise
+        room.guess_made(round_version, round_stamp, image_id, player['id'], guessed_user_id)
+        broadcast_game_state_update(user_code_trigger=player['code'])
+        return True, [("success", f"Ваше предположение (карта '{get_user_name(guessed_user_id)}') сохранено.")]
+    db.rollback(); c = db.cursor()
+    if not c.execute("SELECT 1 FROM users WHERE id = ? AND status = 'active'", (guessed_user_id,)).fetchone(): return False, [("danger", "Выбранный игрок не существует/неактивен.")]
+    image_data = c.execute("SELECT i.owner_id FROM images i JOIN users u ON i.owner_id = u.id WHERE i.id = ? AND i.state = ? AND u.status = 'active'", (image_id, CARD_STATE_TABLE)).fetchone()
+    if not image_data: return False, [("danger", "Карта не найдена или принадлежит неактивному.")]
+    if image_data['owner_id'] == player['id']: return False, [("warning", "Нельзя угадывать свою карту.")]
+    if get_setting("show_card_info") == "true": return False, [("warning", "Карты уже открыты.")]
+    return False, [("warning", "Состояние игры изменилось, попробуйте еще раз.")]
+
+@app.route("/user/<code>/place/<int:image_id>", methods=["POST"])
 def place_card(code, image_id):
-    if not g.user or g.user['status'] != 'active': flash("Только активные игроки могут выкладывать карты.", "warning"); return redirect(url_for('user', code=code))
-    db = get_db(); c = db.cursor()
+    db = get_db()
     try:
-        if is_game_over(): flash("Игра окончена.", "warning"); return redirect(url_for('user', code=code))
-        if not is_game_in_progress(): flash("Игра еще не началась.", "warning"); return redirect(url_for('user', code=code))
-        active_subfolder = get_setting('active_subfolder')
-        num_on_table = c.execute("SELECT COUNT(id) FROM images WHERE subfolder = ? AND status LIKE 'На столе:%'", (active_subfolder,)).fetchone()[0]
-        num_active = get_active_players_count(db)
-        all_cards_placed = (num_active > 0 and num_on_table >= num_active)
-        if get_setting("show_card_info") == "true": flash("Карты уже открыты, менять нельзя.", "warning"); return redirect(url_for('user', code=code))
-        card_of_this_user_on_table = c.execute("SELECT id FROM images WHERE owner_id = ? AND subfolder = ? AND status LIKE 'На столе:%'", (g.user['id'], active_subfolder)).fetchone()
-        if all_cards_placed and card_of_this_user_on_table : flash("Все игроки уже выложили карты, менять нельзя.", "warning"); return redirect(url_for('user', code=code))
-        card_to_place = c.execute("SELECT status, owner_id, subfolder, image FROM images WHERE id = ?", (image_id,)).fetchone()
-        if not card_to_place: flash(f"Карта ID {image_id} не найдена.", "danger"); return redirect(url_for('user', code=code))
-        if card_to_place['owner_id'] != g.user['id']: flash(f"Вы не владелец карты {image_id}.", "danger"); return redirect(url_for('user', code=code))
-        if not card_to_place['status'].startswith(f"Занято:{g.user['id']}"):
-            if card_to_place['status'].startswith("На столе:") and card_to_place['id'] == (card_of_this_user_on_table['id'] if card_of_this_user_on_table else None): flash(f"Карта '{card_to_place['image']}' уже на столе.", "info"); return redirect(url_for('user', code=code))
-            flash(f"Карту '{card_to_place['image']}' ({image_id}) нельзя выложить. Статус: '{card_to_place['status']}'.", "danger"); return redirect(url_for('user', code=code))
-        if card_to_place['subfolder'] != active_subfolder: flash(f"Карта не из активной колоды.", "danger"); return redirect(url_for('user', code=code))
-        if card_of_this_user_on_table and card_of_this_user_on_table['id'] == image_id: flash(f"Карта уже на столе.", "info"); return redirect(url_for('user', code=code))
-        if card_of_this_user_on_table and card_of_this_user_on_table['id'] != image_id: c.execute("UPDATE images SET status = ?, guesses = '{}' WHERE id = ?", (f"Занято:{g.user['id']}", card_of_this_user_on_table['id'])); flash(f"Предыдущая карта возвращена в руку.", "info")
-        c.execute("UPDATE images SET status = ?, guesses = '{}' WHERE id = ?", (f"На столе:{g.user['id']}", image_id))
-        db.commit(); flash(f"Ваша карта '{card_to_place['image']}' выложена.", "success")
-        broadcast_game_state_update(user_code_trigger=code)
+        for category, message in apply_place_card(db, g.user, image_id)[1]: flash(message, category)
     except Exception as e: db.rollback(); flash(f"Ошибка выкладывания карты: {e}", "danger"); print(traceback.format_exc(), file=sys.stderr)
     return redirect(url_for('user', code=code))
 
-@app.route("/user/<code>/guess/<int:image_id>", methods=["POST"]) # Логика без изменений
+@app.route("/user/<code>/guess/<int:image_id>", methods=["POST"])
 def guess_image(code, image_id):
-    if not g.user or g.user['status'] != 'active': flash("Только активные игроки могут делать предположения.", "warning"); return redirect(url_for('user', code=code))
-    guessed_user_id_str = request.form.get("guessed_user_id")
-    if not guessed_user_id_str: flash("Игрок для предположения не выбран.", "warning"); return redirect(url_for('user', code=code))
-    db = get_db(); c = db.cursor()
+    db = get_db()
     try:
-        guessed_user_id = int(guessed_user_id_str)
-        if not c.execute("SELECT 1 FROM users WHERE id = ? AND status = 'active'", (guessed_user_id,)).fetchone(): flash("Выбранный игрок не существует/неактивен.", "danger"); return redirect(url_for('user', code=code))
-        image_data = c.execute("SELECT i.guesses, i.owner_id FROM images i JOIN users u ON i.owner_id = u.id WHERE i.id = ? AND i.status LIKE 'На столе:%' AND u.status = 'active'", (image_id,)).fetchone()
-        if not image_data: flash("Карта не найдена или принадлежит неактивному.", "danger"); return redirect(url_for('user', code=code))
-        if image_data['owner_id'] == g.user['id']: flash("Нельзя угадывать свою карту.", "warning"); return redirect(url_for('user', code=code))
-        if get_setting("show_card_info") == "true": flash("Карты уже открыты.", "warning"); return redirect(url_for('user', code=code))
-        guesses = json.loads(image_data['guesses'] or '{}'); guesses[str(g.user['id'])] = guessed_user_id
-        c.execute("UPDATE images SET guesses = ? WHERE id = ?", (json.dumps(guesses), image_id)); db.commit()
-        flash(f"Ваше предположение (карта '{get_user_name(guessed_user_id)}') сохранено.", "success")
-        broadcast_game_state_update(user_code_trigger=code)
+        for category, message in apply_guess(db, g.user, image_id, request.form.get("guessed_user_id"))[1]: flash(message, category)
     except Exception as e: db.rollback(); flash(f"Ошибка угадывания: {e}", "danger"); print(traceback.format_exc(), file=sys.stderr)
     return redirect(url_for('user', code=code))
 
@@ -799,201 +1565,27 @@ def open_cards():
     c = db.cursor()
 
     try:
-        # 1. Устанавливаем флаг, чтобы показать информацию о картах
-        set_setting("show_card_info", "true")
-
-        # --- Логика подсчета очков ---
-
-        # Получаем список активных игроков с их текущим рейтингом
-        active_users = c.execute("SELECT id, name, rating FROM users WHERE status = 'active'").fetchall() # Добавил user_code
-        active_user_ids = [user['id'] for user in active_users]
-        active_users_dict = {user['id']: dict(user) for user in active_users} # Словарь для быстрого поиска по ID
+        players, result = score_current_round(db)
 
-        # Если нет активных игроков, просто коммитим изменение show_card_info и выходим
-        if not active_users:
+        # Если нет активных игроков, просто открываем карты
+        if players is None:
+            set_setting("show_card_info", "true", EVENT_OPEN)
             flash("Нет активных игроков для подсчета очков.", "warning")
-            db.commit() # Commit the setting change
             broadcast_game_state_update()
             return redirect(url_for('admin'))
 
-        # Получаем карты, которые находятся на столе
-        table_cards = c.execute("SELECT id, owner_id, guesses FROM images WHERE status LIKE 'На столе:%'").fetchall()
-
-        # Получаем ID текущего ведущего
-        current_leader_id = get_leading_user_id()
-        leader_card_on_table = None
-
-        # Находим карту, выложенную ведущим
-        if current_leader_id in active_user_ids:
-            for card in table_cards:
-                if card['owner_id'] == current_leader_id:
-                    leader_card_on_table = card
-                    break
-        elif current_leader_id is not None:
-            print(f"Scoring Warning: Current leader ID {current_leader_id} is not in active users. Cannot find leader card on table.", file=sys.stderr)
-
-
-        # Инициализируем словарь для хранения изменений рейтинга для каждого активного игрока
-        # Изначально у всех 0 изменений.
-        rating_changes = {user_id: 0 for user_id in active_user_ids}
-
-        # Флаги для условий ведущего
-        leader_was_correctly_guessed_by_all_others = False
-        leader_was_guessed_by_none_others = False
-
-        # --- Анализ предположений относительно карты *ведущего* ---
-        correct_guesser_ids_for_leader = [] # Список ID игроков, правильно угадавших карту ведущего
-        # Количество активных игроков, кроме ведущего.
-        total_other_active_players = len(active_users_dict) - (1 if current_leader_id in active_users_dict else 0)
-
-        if leader_card_on_table and current_leader_id in active_users_dict: # Проверяем, что ведущий активен и его карта на столе
-            try:
-                leader_guesses = json.loads(leader_card_on_table['guesses'] or '{}')
-            except json.JSONDecodeError:
-                print(f"Scoring Error: Invalid JSON in leader card {leader_card_on_table['id']} guesses: {leader_card_on_table['guesses']}", file=sys.stderr)
-                leader_guesses = {}
-
-            # Собираем ID игроков, которые правильно угадали карту ведущего (исключая самого ведущего)
-            for guesser_id_str, guessed_owner_id_val in leader_guesses.items():
-                try:
-                    guesser_id = int(guesser_id_str)
-                    guessed_owner_id_int = int(guessed_owner_id_val)
-                except (ValueError, TypeError):
-                    print(f"Scoring Error: Invalid guesser_id or guessed_owner_id format in leader card {leader_card_on_table['id']} guesses: {guesser_id_str} -> {guessed_owner_id_val}", file=sys.stderr)
-                    continue # Пропускаем некорректное предположение
-
-                # Учитываем только предположения от других активных игроков
-                if guesser_id in active_user_ids and guesser_id != current_leader_id and guessed_owner_id_int == current_leader_id:
-                    correct_guesser_ids_for_leader.append(guesser_id)
-
-            correct_leader_guesses_count_by_others = len(correct_guesser_ids_for_leader)
-
-            # Правило 1: Если карточку ведущего угадали все игроки...
-            if total_other_active_players > 0 and correct_leader_guesses_count_by_others == total_other_active_players:
-                leader_was_correctly_guessed_by_all_others = True
-                leader_current_rating = active_users_dict[current_leader_id]['rating']
-                # Ведущий теряет 3 балла (или идет на поле 1). Это прямое изменение рейтинга.
-                new_leader_rating = max(1, leader_current_rating - 3)
-                c.execute("UPDATE users SET rating = ? WHERE id = ?", (new_leader_rating, current_leader_id))
-                db.commit() # Сохраняем это изменение немедленно, так как дальше не будет других начислений для ведущего
-
-                print(f"Scoring: Ведущий ({get_user_name(current_leader_id)}) угадан ВСЕМИ ({correct_leader_guesses_count_by_others} из {total_other_active_players} других игроков). Рейтинг изменен с {leader_current_rating} на {new_leader_rating}. Дальнейший подсчет очков пропускается.", file=sys.stderr)
-                flash("Карты открыты, очки начислены. Ведущий угадан всеми.", "success")
-                broadcast_game_state_update()
-                return redirect(url_for('admin')) # *** Выход из функции ***
-
-            # Правило 2.1: Если карточку ведущего никто не угадал (и Правило 1 не сработало)
-            elif correct_leader_guesses_count_by_others == 0 and total_other_active_players > 0:
-                leader_was_guessed_by_none_others = True
-                # Ведущий теряет 2 балла.
-                rating_changes[current_leader_id] -= 2 # Добавляем к изменению рейтинга
-                print(f"Scoring: Ведущий ({get_user_name(current_leader_id)}) не угадан НИКЕМ ({correct_leader_guesses_count_by_others} из {total_other_active_players} других игроков). Ведущий теряет 2 очка.", file=sys.stderr)
-
-        elif current_leader_id in active_users_dict:
-            # Ведущий активен, но других активных игроков нет или нет карты ведущего на столе.
-            # Специальные правила для ведущего (1, 2.1) не применяются.
-            print(f"Scoring: Ведущий ({get_user_name(current_leader_id)}) - особый случай (нет других игроков/нет карты). Специальные правила ведущего не применяются.", file=sys.stderr)
-        elif current_leader_id is None:
-            print("Scoring Warning: No current leader defined. Cannot apply leader scoring rules.", file=sys.stderr)
-        elif leader_card_on_table is None and current_leader_id in active_users_dict:
-            print(f"Scoring Warning: Leader ({get_user_name(current_leader_id)}) is active but no leader card on table. Cannot apply leader scoring rules.", file=sys.stderr)
-
-
-        # --- Начисление очков по остальным правилам, если Правило 1 НЕ сработало ---
-
-        # Правило 2.2 (часть 1): Все игроки (включая ведущего), чьи карточки угадали, получают по +1 очку за каждого угадавшего.
-        # ЭТО УЖЕ БЫЛО: Владелец карты, которую угадали, получает +1 балл за каждого, кто ее угадал.
-        # ПЛЮС ДОБАВЛЕНА НОВАЯ ЛОГИКА: Угадывающий игрок получает +1 балл за любую карту, кроме карты ведущего.
-        for card in table_cards:
-            card_owner_id = card['owner_id']
-            if card_owner_id not in active_user_ids:
-                continue # Пропускаем неактивных владельцев карт
-
-            try:
-                guesses_on_this_card = json.loads(card['guesses'] or '{}')
-            except json.JSONDecodeError:
-                guesses_on_this_card = {}
-                print(f"Scoring Error: Invalid JSON in card {card['id']} guesses: {card['guesses']}", file=sys.stderr)
-
-            guessed_by_this_card_count = 0 # Количество угадавших ЭТУ карту (для владельца)
-            
-            # Временный список для угадывающих игроков этой карты, чтобы применить +1 балл
-            guesser_ids_for_this_card = [] 
-
-            for guesser_id_str, guessed_owner_id_val in guesses_on_this_card.items():
-                try:
-                    guesser_id = int(guesser_id_str)
-                    guessed_owner_id_int = int(guessed_owner_id_val)
-                except (ValueError, TypeError):
-                    continue # Пропускаем некорректное предположение
-
-                # Проверяем, что угадавший игрок активен, не угадывает свою карту и угадал правильно
-                if guesser_id in active_user_ids and guesser_id != card_owner_id and guessed_owner_id_int == card_owner_id:
-                    guessed_by_this_card_count += 1
-                    
-                    # --- НОВАЯ ЛОГИКА: Угадывающий получает +1 балл, если это НЕ карта ведущего ---
-                    # Если карта, которую угадали, не принадлежит ведущему И угадывающий не является ведущим,
-                    # или угадывающий - это ведущий (но он не может угадывать свою карту),
-                    # тогда угадывающий получает +1 балл.
-                    # Случай +3 за карту ведущего обрабатывается отдельно ниже в "Правиле 2.2 часть 2".
-                    if card_owner_id != current_leader_id:
-                        if guesser_id in rating_changes:
-                            rating_changes[guesser_id] += 1
-                            print(f"Scoring: Игрок {get_user_name(guesser_id)} получил +1 очко за угадывание карты игрока {get_user_name(card_owner_id)} (не ведущего).", file=sys.stderr)
-                        else:
-                            print(f"Scoring Warning: Guesser ID {guesser_id} for non-leader card not found in active users rating_changes dict.", file=sys.stderr)
-                    # --- КОНЕЦ НОВОЙ ЛОГИКИ ---
-
-            if guessed_by_this_card_count > 0:
-                rating_changes[card_owner_id] += guessed_by_this_card_count
-                print(f"Scoring: Игрок {get_user_name(card_owner_id)} (владелец карты {card['id']}) получил +{guessed_by_this_card_count} очков (угадано {guessed_by_this_card_count} игроками) (Rule 2.2 part 1).", file=sys.stderr)
-
-
-        # Правило 2.2 (часть 2): По 3 очка получают все игроки, правильно угадавшие карточку Ведущего (не ведущий).
-        # ЭТО УЖЕ БЫЛО И ОСТАЕТСЯ БЕЗ ИЗМЕНЕНИЙ.
-        for guesser_id in correct_guesser_ids_for_leader:
-            if guesser_id in rating_changes: # Убедимся, что игрок активен
-                rating_changes[guesser_id] += 3
-                print(f"Scoring: Игрок {get_user_name(guesser_id)} получил +3 очка за правильное угадывание карты ведущего (Rule 2.2 part 2).", file=sys.stderr)
-            else:
-                print(f"Scoring Warning: Guesser ID {guesser_id} for leader card not found in active users rating_changes dict (Rule 2.2 part 2).", file=sys.stderr)
-
-
-        # Правило 2.3: Ведущий получает 3 очка если его карточку угадали не все игроки и не никто.
-        # ЭТО УЖЕ БЫЛО И ОСТАЕТСЯ БЕЗ ИЗМЕНЕНИЙ.
-        if current_leader_id in active_users_dict and not leader_was_correctly_guessed_by_all_others and not leader_was_guessed_by_none_others:
-            # Убеждаемся, что есть хотя бы один угадавший, чтобы это не было "никто"
-            # и что количество угадавших меньше, чем общее количество других игроков, чтобы это не было "все"
-            if correct_leader_guesses_count_by_others > 0 and correct_leader_guesses_count_by_others < total_other_active_players:
-                rating_changes[current_leader_id] += 3
-                print(f"Scoring: Ведущий ({get_user_name(current_leader_id)}) угадан SOME ({correct_leader_guesses_count_by_others} игроков). Получает +3 очка (Rule 2.3).", file=sys.stderr)
-            # Если total_other_active_players = 0, то этот случай также не должен срабатывать,
-            # так как условие "не все и не никто" не имеет смысла.
-            elif total_other_active_players == 0:
-                 print(f"Scoring: Ведущий ({get_user_name(current_leader_id)}) - единственный активный игрок. Правило 2.3 не применяется.", file=sys.stderr)
-
-
-        # 4. Окончательное обновление рейтинга в базе данных на основе накопленных изменений
-        for user in active_users:
-            user_id = user['id']
-            current_rating = user['rating']
-
-            calculated_rating_change = rating_changes.get(user_id, 0)
-            final_rating = max(1, current_rating + calculated_rating_change) # Убеждаемся, что рейтинг не падает ниже 1
-
-            if calculated_rating_change != 0:
-                print(f"Scoring Update: Игрок ({get_user_name(user_id)}) итоговый рейтинг: {current_rating} -> {final_rating} (изменения: {calculated_rating_change}).", file=sys.stderr)
-            else:
-                print(f"Scoring Update: Игрок ({get_user_name(user_id)}) рейтинг остался {current_rating}.", file=sys.stderr)
-
-            # Выполняем обновление в базе данных
-            c.execute("UPDATE users SET rating = ? WHERE id = ?", (final_rating, user_id))
-
-        # --- Конец логики подсчета очков ---
-
-        db.commit() # Сохраняем все изменения в базе данных
-
-        flash("Карты открыты, очки начислены.", "success")
+        for line in result['log']: print(f"Scoring: {line}", file=sys.stderr)
+
+        # Все изменения рейтинга одним executemany; set_setting фиксирует их вместе с show_card_info одной транзакцией
+        rating_updates = [(new_rating, user_id) for user_id, new_rating in result['ratings'].items() if new_rating != players[user_id]]
+        c.executemany("UPDATE users SET rating = ? WHERE id = ?", rating_updates)
+        record_game_event(db, EVENT_SCORE, {'r': {user_id: new_rating for new_rating, user_id in rating_updates}, 'ch': result['changes'], 'lo': result['leader_outcome']})
+        print(f"Scoring Update: Изменен рейтинг {len(rating_updates)} игроков: {result['changes']}", file=sys.stderr)
+        if not set_setting("show_card_info", "true", EVENT_OPEN): raise sqlite3.Error("Не удалось сохранить show_card_info")
+        if rating_updates: invalidate_users_cache()
+
+        if result['leader_outcome'] == LEADER_GUESSED_BY_ALL: flash("Карты открыты, очки начислены. Ведущий угадан всеми.", "success")
+        else: flash("Карты открыты, очки начислены.", "success")
         # Отправляем обновление состояния игры всем подключенным клиентам
         broadcast_game_state_update()
 
@@ -1006,9 +1598,7 @@ def open_cards():
     # Перенаправляем обратно на страницу администратора
     return redirect(url_for('admin'))
 
-    
-
-@app.route("/new_round", methods=["POST"]) # Логика без изменений
+@app.route("/new_round", methods=["POST"])
 def new_round():
     if not session.get('is_admin'): flash('Доступ запрещен.', 'danger'); return redirect(url_for('login'))
     if is_game_over(): flash("Игра окончена. Начните новую игру.", "warning"); return redirect(url_for('admin'))
@@ -1017,54 +1607,87 @@ def new_round():
     current_leader = get_leading_user_id(); next_leader = None
     try:
         next_leader = determine_new_leader(current_leader)
-        if next_leader: set_leading_user_id(next_leader); flash(f"Новый раунд! Ведущий: {get_user_name(next_leader) or f'ID {next_leader}'}.", "success")
-        else: set_leading_user_id(None); flash("Новый раунд, но ведущий не определен.", "warning")
-        c.execute("UPDATE images SET owner_id = NULL, guesses = '{}', status = 'Занято:Админ' WHERE status LIKE 'На столе:%'")
-        c.execute("UPDATE images SET guesses = '{}' WHERE status NOT LIKE 'На столе:%' AND guesses != '{}'")
-        set_setting("show_card_info", "false")
+        if next_leader: flash(f"Новый раунд! Ведущий: {get_user_name(next_leader) or f'ID {next_leader}'}.", "success")
+        else: flash("Новый раунд, но ведущий не определен.", "warning")
+        c.execute("UPDATE images SET owner_id = NULL, state = ? WHERE state = ?", (CARD_STATE_DISCARD, CARD_STATE_TABLE))
+        c.execute("DELETE FROM guesses"); record_game_event(db, EVENT_NEW_ROUND)
         active_users = [row['id'] for row in c.execute("SELECT id FROM users WHERE status = 'active' ORDER BY id").fetchall()]
         if not active_users: flash("Нет активных игроков.", "warning")
         elif not active_subfolder: flash("Активная колода не установлена.", "warning")
         else:
-            available_cards = [r['id'] for r in c.execute("SELECT id FROM images WHERE subfolder = ? AND status = 'Свободно'", (active_subfolder,)).fetchall()]
-            random.shuffle(available_cards); num_dealt_total = 0
-            for i, user_id in enumerate(active_users):
-                if i < len(available_cards): c.execute("UPDATE images SET status = ?, owner_id = ? WHERE id = ?", (f"Занято:{user_id}", user_id, available_cards[i])); num_dealt_total +=1
-                else: flash(f"Карты в колоде '{active_subfolder}' закончились. Не все игроки получили карту.", "warning"); break 
+            num_dealt_total, num_available = deal_cards(db, active_subfolder, active_users, 1)
+            if num_dealt_total < len(active_users): flash(f"Карты в колоде '{active_subfolder}' закончились. Не все игроки получили карту.", "warning")
             if num_dealt_total > 0 : flash(f"Роздано {num_dealt_total} новых карт.", "info")
-            elif not available_cards and active_users : flash(f"В колоде '{active_subfolder}' нет карт для раздачи.", "info")
-        db.commit() 
+            elif not num_available and active_users : flash(f"В колоде '{active_subfolder}' нет карт для раздачи.", "info")
+        # Смена ведущего, сброс show_card_info, очистка стола и раздача - одним коммитом
+        advance_round_version(db)
+        if not set_settings({'leading_user_id': str(next_leader) if next_leader else '', 'show_card_info': 'false'}, EVENT_LEADER): raise sqlite3.Error("Не удалось сохранить настройки раунда")
         if check_and_end_game_if_player_out_of_cards(db): # Проверка после коммита и перед broadcast
              pass # Сообщение об окончании уже во flash из функции
         broadcast_game_state_update()
-    except Exception as e: db.rollback(); flash(f"Ошибка нового раунда: {e}", "danger"); print(traceback.format_exc(), file=sys.stderr)
+    except Exception as e: rollback_round_write(db); flash(f"Ошибка нового раунда: {e}", "danger"); print(traceback.format_exc(), file=sys.stderr)
     return redirect(url_for('admin', displayed_leader_id=next_leader if next_leader else current_leader))
 
-@socketio.on('connect') # Логика без изменений
+# Каждый маршрут, кроме статики, доступен и под /t/<стол>; url_for сам выбирает вариант по текущему столу
+for rule in list(app.url_map.iter_rules()):
+    if rule.endpoint != 'static': app.add_url_rule(f"/t/<table>{rule.rule}", rule.endpoint, methods=sorted(rule.methods - {'HEAD', 'OPTIONS'}))
+
+@socketio.on('connect')
 def handle_connect():
+    if current_table_slug() not in _game_tables: return False # Неизвестный стол - соединение отклоняется
     sid = request.sid; user_code = session.get('user_code')
-    print(f"SocketIO: Client connected: SID={sid}, User code: {user_code or 'N/A'}", file=sys.stderr)
-    if user_code: connected_users_socketio[sid] = user_code
+    print(f"SocketIO: Client connected: SID={sid}, User code: {user_code or 'N/A'}{f', table: {current_table_slug()}' if current_table_slug() else ''}", file=sys.stderr)
+    for room in (ROOM_TABLE, f"user:{user_code}" if user_code else ROOM_SPECTATORS): join_room(table_room(room))
+    register_socket(sid, user_code or '') # Зрители тоже в реестре (с пустым кодом), чтобы рассылка знала о них
     try:
-        with app.app_context(): initial_state = get_full_game_state_data(user_code_for_state=user_code); emit('game_update', initial_state, room=sid)
+        with sql_stats_scope("socket connect"): send_full_state_to_sid(sid, user_code)
     except Exception as e: print(f"SocketIO: Error sending initial state to {sid}: {e}\n{traceback.format_exc()}", file=sys.stderr)
 
-@socketio.on('disconnect') # Логика без изменений
+@socketio.on('request_full_state')
+def handle_request_full_state():
+    sid = request.sid; user_code = get_socket_user_code(sid) or session.get('user_code')
+    print(f"SocketIO: Full state resync requested: SID={sid}, User code: {user_code or 'N/A'}", file=sys.stderr)
+    try:
+        with sql_stats_scope("socket request_full_state"): send_full_state_to_sid(sid, user_code)
+    except Exception as e: print(f"SocketIO: Error sending full state to {sid}: {e}\n{traceback.format_exc()}", file=sys.stderr)
+
+def run_socket_player_action(action_name, action, *args):
+    """Выполняет действие игрока, пришедшее по сокету; результат уходит клиенту в ack: {'ok', 'messages', 'error'}."""
+    user_code = get_socket_user_code(request.sid) or session.get('user_code')
+    with table_context(current_table_slug()), sql_stats_scope(f"socket {action_name}"):
+        db = get_db()
+        try:
+            player = get_user_by_code(user_code, db)
+            if player is None: return {'ok': False, 'messages': [], 'error': "Пользователь не найден."}
+            ok, notes = action(db, player, *args)
+        except Exception as e:
+            db.rollback(); print(f"SocketIO: Error in {action_name} for {user_code}: {e}\n{traceback.format_exc()}", file=sys.stderr)
+            return {'ok': False, 'messages': [], 'error': f"Ошибка: {e}"}
+    messages = [{'category': category, 'message': message} for category, message in notes]
+    return {'ok': ok, 'messages': messages, 'error': None if ok else (notes[-1][1] if notes else "Действие отклонено.")}
+
+@socketio.on('place_card')
+def handle_place_card(data):
+    if not isinstance(data, dict): return {'ok': False, 'messages': [], 'error': "Не указана карта."}
+    try: image_id = int(data.get('image_id'))
+    except (TypeError, ValueError): return {'ok': False, 'messages': [], 'error': "Не указана карта."}
+    return run_socket_player_action('place_card', apply_place_card, image_id)
+
+@socketio.on('guess')
+def handle_guess(data):
+    if not isinstance(data, dict): return {'ok': False, 'messages': [], 'error': "Не указана карта."}
+    try: image_id = int(data.get('image_id'))
+    except (TypeError, ValueError): return {'ok': False, 'messages': [], 'error': "Не указана карта."}
+    try: guessed_user_id = int(data.get('guessed_user_id'))
+    except (TypeError, ValueError): return {'ok': False, 'messages': [], 'error': "Игрок для предположения не выбран."}
+    return run_socket_player_action('guess', apply_guess, image_id, guessed_user_id)
+
+@socketio.on('disconnect')
 def handle_disconnect():
-    sid = request.sid; user_code = connected_users_socketio.pop(sid, None)
+    sid = request.sid; user_code = unregister_socket(sid) # Из комнат Socket.IO выводит сам
     print(f"SocketIO: Client disconnected: SID={sid}, User code: {user_code or 'N/A'}", file=sys.stderr)
 
-if __name__ == "__main__": # Логика без изменений
-    if not _current_game_board_pole_image_config:
-        print("Инициализация визуализации игрового поля...", file=sys.stderr)
-        users_at_start = []
-        if os.path.exists(DB_PATH):
-            try:
-                conn = sqlite3.connect(DB_PATH); conn.row_factory = sqlite3.Row; cur = conn.cursor()
-                cur.execute("SELECT id, name, rating FROM users WHERE status = 'active'")
-                users_at_start = cur.fetchall(); conn.close()
-            except Exception as e: print(f"Ошибка чтения пользователей для поля при старте: {e}", file=sys.stderr)
-        initialize_new_game_board_visuals(all_users_for_rating_check=users_at_start)
+if __name__ == "__main__": # Раскладка поля хранится в БД и создается при первом показе
     port = int(os.environ.get("PORT", 5000))
     debug = os.environ.get("FLASK_DEBUG", "False").lower() in ['true', '1', 't']
     print(f"Запуск Flask-SocketIO (socketio.run) на http://0.0.0.0:{port}/ debug={debug}", file=sys.stderr)
@@ -0,0 +1,279 @@
+"""Нагрузочный стенд: синтетическая игра на N игроков и M зрителей поверх настоящих колод.
+
+Стенд создает временную папку с новой БД, заводит игроков, начинает игру через /start_new_game и подключает клиентов
+через socketio.test_client (в одном процессе, без сети, SOCKETIO_ASYNC_MODE=threading). Дальше несколько раундов:
+игроки выкладывают карты и угадывают событиями сокета, администратор открывает карты и начинает новый раунд через HTTP.
+Измеряется:
+  - задержка действие -> обновление в комнате игрока (p50/p99), включая окно BROADCAST_DEBOUNCE_SECONDS;
+  - emit в секунду и доставок клиентам в секунду за время раундов;
+  - SQL-запросов на действие (поток обработчика) и на рассылку (фоновый поток), через sqlite3 trace callback;
+  - время рассылки, get_full_game_state_data на игрока, open_cards и new_round.
+Случайность фиксирована (--seed), поэтому число запросов от прогона к прогону совпадает, а время сравнимо на одной машине.
+Результат пишется в JSON; --compare сравнивает с прошлым прогоном и завершается с кодом 1 при ухудшении больше порога.
+
+  python benchmark.py --players 20 --spectators 10 --rounds 3 --out bench.json
+  python benchmark.py --players 20 --spectators 10 --rounds 3 --compare bench.json
+"""
+import argparse
+import bisect
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+UPDATE_EVENTS = ('game_update', 'game_state_delta')
+
+
+def percentile(values, fraction):
+    """Перцентиль по ближайшему рангу (значение из выборки, без интерполяции)."""
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def summarize(values):
+    return {'count': len(values), 'p50': round(percentile(values, 0.5), 3) if values else None,
+            'p99': round(percentile(values, 0.99), 3) if values else None, 'max': round(max(values), 3) if values else None}
+
+
+class Probe:
+    """Счетчики стенда: SQL-запросы по потокам, вызовы socketio.emit с временем и комнатой, рассылки."""
+    def __init__(self, game_app):
+        self.game_app = game_app
+        self.lock = threading.Lock()
+        self.main_thread = threading.get_ident()
+        self.queries = {'main': 0, 'background': 0}
+        self.emits = []  # [(perf_counter, event, room)]
+        self.flushes = []  # [(мс, запросов)]
+
+    def install(self):
+        game_app, probe = self.game_app, self
+        original_connect, original_emit, original_flush = game_app.connect_db, game_app.socketio.emit, game_app.flush_game_state_broadcast
+        def count_query(statement):
+            with probe.lock: probe.queries['main' if threading.get_ident() == probe.main_thread else 'background'] += 1
+        def connect_db(*args, **kwargs):
+            conn = original_connect(*args, **kwargs); conn.set_trace_callback(count_query); return conn
+        def emit(event, *args, **kwargs):
+            with probe.lock: probe.emits.append((time.perf_counter(), event, kwargs.get('room') or kwargs.get('to')))
+            return original_emit(event, *args, **kwargs)
+        def flush_game_state_broadcast(*args, **kwargs):
+            queries_before, started = probe.queries['background'], time.perf_counter()
+            try: return original_flush(*args, **kwargs)
+            finally: probe.flushes.append(((time.perf_counter() - started) * 1000, probe.queries['background'] - queries_before))
+        game_app.connect_db = connect_db # acquire_db() берет connect_db из модуля - новые соединения пула считают запросы
+        game_app.socketio.emit = emit
+        game_app.flush_game_state_broadcast = flush_game_state_broadcast
+
+    def main_queries(self):
+        with self.lock: return self.queries['main']
+
+
+def wait_until_idle(game_app, table, timeout=30.0):
+    """Ждет, пока отложенная рассылка стола отработает (все ходы разосланы). Не дождались - прогон недействителен."""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        with table.broadcast_scheduler['lock']:
+            if not table.broadcast_scheduler['running'] and not table.broadcast_scheduler['dirty']: return
+        game_app.socketio.sleep(0.002) # Уступает фоновой задаче рассылки в любом async_mode
+    raise SystemExit(f"Benchmark: Рассылка не завершилась за {timeout:.0f} с (async_mode={game_app.socketio.async_mode}) - результаты недействительны.")
+
+
+def git_revision():
+    try: return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR, capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError): return None
+
+
+def run_benchmark(args):
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    previous_cwd, previous_stderr = os.getcwd(), sys.stderr
+    # threading: фоновая рассылка идет настоящим потоком; eventlet без monkey patching не дал бы ей работать, пока стенд ждет
+    os.environ.update(ADMIN_PASSWORD='bench', SECRET_KEY='bench', GAME_TABLES='', BROADCAST_DEBOUNCE_SECONDS=str(args.debounce), SOCKETIO_ASYNC_MODE='threading')
+    os.environ.pop('SOCKETIO_MESSAGE_QUEUE', None)
+    os.chdir(work_dir) # DB_PATH относительный - синтетическая БД создается во временной папке
+    if not args.verbose: sys.stderr = open(os.devnull, 'w') # Логи приложения на каждое действие искажают время
+    try:
+        sys.path.insert(0, APP_DIR)
+        import app as game_app
+        random.seed(args.seed); rng = random.Random(args.seed)
+        table = game_app._game_tables['']
+        probe = Probe(game_app); probe.install()
+        harness_db = sqlite3.connect(table.db_path); harness_db.row_factory = sqlite3.Row # Свои чтения стенда не попадают в счетчики
+
+        deck_size = harness_db.execute("SELECT COUNT(*) FROM images WHERE subfolder = ?", (args.deck,)).fetchone()[0]
+        cards_per_player = args.cards or min(6, (deck_size - args.players * args.rounds) // args.players)
+        if cards_per_player < 1: raise SystemExit(f"В колоде '{args.deck}' {deck_size} карт - мало для {args.players} игроков и {args.rounds} раундов.")
+
+        # Синтетические игроки - прямо в БД (с событиями журнала), сессии клиентов - через session_transaction
+        codes = [f"bench{i:04d}" for i in range(args.players)]
+        with game_app.table_context(''):
+            db = game_app.get_db()
+            for i, code in enumerate(codes):
+                user_id = db.execute("INSERT INTO users (name, code, status, rating) VALUES (?, ?, 'active', 0)", (f"Игрок {i + 1:03d}", code)).lastrowid
+                game_app.record_game_event(db, game_app.EVENT_JOIN, {'u': user_id, 'n': f"Игрок {i + 1:03d}", 'c': code, 'st': 'active'})
+            db.commit(); game_app.invalidate_users_cache()
+        admin = game_app.app.test_client()
+        admin.post('/login', data={'password': 'bench'})
+        admin.post('/start_new_game', data={'new_game_subfolder': args.deck, 'new_game_num_cards': str(cards_per_player)})
+        wait_until_idle(game_app, table)
+
+        started = time.perf_counter()
+        players = []
+        for code in codes:
+            http_client = game_app.app.test_client()
+            with http_client.session_transaction() as sess: sess['user_code'] = code
+            players.append((code, game_app.socketio.test_client(game_app.app, flask_test_client=http_client)))
+        spectators = [game_app.socketio.test_client(game_app.app) for _ in range(args.spectators)]
+        connect_ms = (time.perf_counter() - started) * 1000
+        clients = [sock for _, sock in players] + spectators
+        for sock in clients: sock.get_received()
+        user_ids = {row['code']: row['id'] for row in harness_db.execute("SELECT id, code FROM users")}
+        player_room = {code: table.room_name(f"user:{code}") for code in codes}
+
+        actions = []  # [(вид, perf_counter начала, комната игрока, запросов в обработчике)]
+        admin_timings = {'open_cards': [], 'new_round': []}; admin_queries = {'open_cards': [], 'new_round': []}
+        deliveries = 0; emits_before = len(probe.emits); rounds_started = time.perf_counter()
+
+        def act(kind, code, sock, event, payload):
+            queries_before, action_started = probe.main_queries(), time.perf_counter()
+            ack = sock.emit(event, payload, callback=True)
+            actions.append((kind, action_started, player_room[code], probe.main_queries() - queries_before, bool(ack and ack.get('ok'))))
+            if args.think_ms: game_app.socketio.sleep(args.think_ms / 1000)
+        def admin_post(name, url):
+            queries_before, action_started = probe.main_queries(), time.perf_counter()
+            admin.post(url)
+            admin_timings[name].append((time.perf_counter() - action_started) * 1000); admin_queries[name].append(probe.main_queries() - queries_before)
+            wait_until_idle(game_app, table)
+
+        for _ in range(args.rounds):
+            hands = {}
+            for row in harness_db.execute("SELECT id, owner_id FROM images WHERE state = 'hand' AND subfolder = ? ORDER BY id", (args.deck,)): hands.setdefault(row['owner_id'], []).append(row['id'])
+            for code, sock in players:
+                if hands.get(user_ids[code]): act('place', code, sock, 'place_card', {'image_id': rng.choice(hands[user_ids[code]])})
+            wait_until_idle(game_app, table)
+            table_cards = [(row['id'], row['owner_id']) for row in harness_db.execute("SELECT id, owner_id FROM images WHERE state = 'table' ORDER BY id")]
+            owners = [owner_id for _, owner_id in table_cards]
+            for index, (code, sock) in enumerate(players):
+                others = [card for card in table_cards if card[1] != user_ids[code]]
+                for card_id, _ in others[index % max(len(others), 1):][:args.guesses]:
+                    act('guess', code, sock, 'guess', {'image_id': card_id, 'guessed_user_id': rng.choice([owner for owner in owners if owner != user_ids[code]])})
+            wait_until_idle(game_app, table)
+            admin_post('open_cards', '/admin/open_cards')
+            admin_post('new_round', '/new_round')
+            deliveries += sum(len(sock.get_received()) for sock in clients)
+        rounds_elapsed = time.perf_counter() - rounds_started
+
+        # Задержка действия: от начала обработки до первого обновления, ушедшего в комнату этого игрока
+        update_times_by_room = {}
+        for emitted_at, event, room in probe.emits[emits_before:]:
+            if event in UPDATE_EVENTS: update_times_by_room.setdefault(room, []).append(emitted_at)
+        latency_ms = {'place': [], 'guess': []}; missed = 0
+        for kind, action_started, room, _, ok in actions:
+            times = update_times_by_room.get(room, [])
+            position = bisect.bisect_left(times, action_started)
+            if ok and position < len(times): latency_ms[kind].append((times[position] - action_started) * 1000)
+            elif ok: missed += 1
+        round_emits = len(probe.emits) - emits_before
+        round_flushes = list(probe.flushes)
+
+        # Рассылка и построение состояния отдельно: без изменений (ничего не уходит) и с полной отправкой всем
+        warm_ms, full_ms, build_ms = [], [], []
+        for _ in range(args.samples):
+            with game_app.table_context(''):
+                started = time.perf_counter(); game_app.flush_game_state_broadcast('bench'); warm_ms.append((time.perf_counter() - started) * 1000)
+                table.last_state_sent_by_room.clear()
+                started = time.perf_counter(); game_app.flush_game_state_broadcast('bench'); full_ms.append((time.perf_counter() - started) * 1000)
+                snapshot = game_app.get_shared_game_state_snapshot(game_app.get_db())
+                started = time.perf_counter()
+                for code in codes: game_app.get_full_game_state_data(user_code_for_state=code, snapshot=snapshot)
+                build_ms.append((time.perf_counter() - started) * 1000 / len(codes))
+        for sock in clients: sock.get_received(); sock.disconnect()
+        harness_db.close()
+
+        action_queries = {kind: [queries for action_kind, _, _, queries, _ in actions if action_kind == kind] for kind in ('place', 'guess')}
+        return {
+            'config': {'players': args.players, 'spectators': args.spectators, 'rounds': args.rounds, 'guesses': args.guesses, 'deck': args.deck,
+                       'cards_per_player': cards_per_player, 'seed': args.seed, 'debounce_seconds': args.debounce, 'think_ms': args.think_ms, 'samples': args.samples},
+            'environment': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'async_mode': game_app.socketio.async_mode,
+                            'platform': platform.platform(), 'revision': git_revision()},
+            'metrics': {
+                'connect_ms_per_client': round(connect_ms / len(clients), 3),
+                'place_latency_ms': summarize(latency_ms['place']), 'guess_latency_ms': summarize(latency_ms['guess']),
+                'actions': len(actions), 'actions_rejected': sum(1 for action in actions if not action[4]), 'actions_without_update': missed,
+                'emits_per_second': round(round_emits / rounds_elapsed, 1), 'deliveries_per_second': round(deliveries / rounds_elapsed, 1),
+                'queries_per_place': round(sum(action_queries['place']) / max(len(action_queries['place']), 1), 2),
+                'queries_per_guess': round(sum(action_queries['guess']) / max(len(action_queries['guess']), 1), 2),
+                'broadcasts': len(round_flushes), 'broadcast_ms': summarize([ms for ms, _ in round_flushes]),
+                'queries_per_broadcast': round(sum(queries for _, queries in round_flushes) / max(len(round_flushes), 1), 2),
+                'broadcast_unchanged_ms': summarize(warm_ms), 'broadcast_full_ms': summarize(full_ms), 'state_build_ms_per_player': summarize(build_ms),
+                'open_cards_ms': summarize(admin_timings['open_cards']), 'queries_per_open_cards': round(sum(admin_queries['open_cards']) / max(len(admin_queries['open_cards']), 1), 2),
+                'new_round_ms': summarize(admin_timings['new_round']), 'queries_per_new_round': round(sum(admin_queries['new_round']) / max(len(admin_queries['new_round']), 1), 2),
+            },
+        }
+    finally:
+        if sys.stderr is not previous_stderr: sys.stderr.close(); sys.stderr = previous_stderr
+        os.chdir(previous_cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def flatten_metrics(metrics):
+    """{'place_latency_ms': {'p50': ..}} -> {'place_latency_ms.p50': ..}; только числа. Максимум - единичный выброс, не сравнивается."""
+    flat = {}
+    for name, value in metrics.items():
+        if isinstance(value, dict): flat.update({f"{name}.{key}": item for key, item in value.items() if isinstance(item, (int, float)) and key in ('p50', 'p99')})
+        elif isinstance(value, (int, float)): flat[name] = value
+    return flat
+
+
+def compare_reports(baseline, current, tolerance, min_delta_ms):
+    """Строки сравнения и список ухудшившихся метрик. Больше - лучше только для *_per_second; запросы должны совпадать
+    (они детерминированы), время - в пределах tolerance и не меньше min_delta_ms."""
+    if baseline.get('config') != current.get('config'): print("Benchmark: ВНИМАНИЕ: параметры прогонов различаются, сравнение условно.", file=sys.stderr)
+    lines, regressions = [], []
+    old_metrics, new_metrics = flatten_metrics(baseline['metrics']), flatten_metrics(current['metrics'])
+    for name in sorted(set(old_metrics) & set(new_metrics)):
+        old, new = old_metrics[name], new_metrics[name]
+        change = (new - old) / old if old else (0.0 if new == old else float('inf'))
+        if name.endswith('_per_second'): worse = new < old * (1 - tolerance)
+        elif name.startswith('queries_') or name.startswith('actions'): worse = new > old
+        else: worse = new > old * (1 + tolerance) and new - old >= min_delta_ms
+        if worse: regressions.append(name)
+        lines.append(f"{name:40} {old:>12} {new:>12} {change:>+8.1%}{'  <-- хуже' if worse else ''}")
+    return lines, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд Socket.IO: синтетическая игра, задержки, emit/с, запросы на действие.")
+    parser.add_argument('--players', type=int, default=10)
+    parser.add_argument('--spectators', type=int, default=5)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--guesses', type=int, default=2, help="Предположений на игрока за раунд")
+    parser.add_argument('--cards', type=int, default=0, help="Карт на руку (по умолчанию - сколько позволяет колода, не больше 6)")
+    parser.add_argument('--deck', default='ariadna')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--debounce', type=float, default=0.05, help="BROADCAST_DEBOUNCE_SECONDS для прогона")
+    parser.add_argument('--think-ms', type=float, default=0, help="Пауза после каждого действия")
+    parser.add_argument('--samples', type=int, default=20, help="Повторов замера рассылки и построения состояния")
+    parser.add_argument('--out', help="Записать результат в JSON")
+    parser.add_argument('--compare', help="Сравнить с прошлым результатом (JSON)")
+    parser.add_argument('--tolerance', type=float, default=0.3, help="Допустимое ухудшение времени и emit/с (доля)")
+    parser.add_argument('--min-delta-ms', type=float, default=0.5, help="Изменения времени меньше этого не считаются ухудшением")
+    parser.add_argument('--verbose', action='store_true', help="Не глушить логи приложения")
+    args = parser.parse_args()
+    if args.players < 2: parser.error("нужно хотя бы 2 игрока")
+    report = run_benchmark(args)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f: baseline_report = json.load(f)
+        comparison, worse_metrics = compare_reports(baseline_report, report, args.tolerance, args.min_delta_ms)
+        print("\n".join(comparison), file=sys.stderr)
+        if worse_metrics: print(f"Benchmark: Ухудшились: {', '.join(worse_metrics)}", file=sys.stderr); sys.exit(1)
@@ -0,0 +1,140 @@
+"""Восстановление и повтор игры по журналу событий (game_events + game_snapshots в БД стола).
+
+Каждое действие (раздача, ход, предположение, открытие карт, подсчет, смена ведущего...) записано событием в той же
+транзакции, что и само изменение; снимок состояния пишется не реже чем раз в GAME_SNAPSHOT_EVERY событий, поэтому
+восстановление повторяет ограниченное число событий. Команды (запуск из папки приложения):
+
+  python game_replay.py verify  [--table СТОЛ]          - восстановить копию БД из последнего снимка и событий, сверить с таблицами
+  python game_replay.py replay  [--table СТОЛ]          - прогнать весь журнал через score_round и построение состояний рассылки
+  python game_replay.py restore OUT.db [--table СТОЛ] [--upto ID] - записать в OUT.db состояние на момент события ID
+  python game_replay.py export  [--table СТОЛ] > events.jsonl     - события для нагрузочного тестирования
+
+Исходная БД не изменяется: она открывается только для чтения, схема и каталог карт при импорте app не обновляются
+(GAME_INIT_DB=false), все остальное работает на копии. БД должна быть обновлена до текущей схемы запуском приложения.
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import zlib
+
+os.environ['GAME_INIT_DB'] = 'false' # Импорт app не должен мигрировать и менять живые БД столов
+import app as game_app
+
+
+def open_source(table_slug):
+    """БД стола только для чтения; старая схема (приложение еще не запускалось после обновления) не поддерживается."""
+    if table_slug not in game_app._game_tables: sys.exit(f"Неизвестный стол '{table_slug}'. Столы: {', '.join(repr(slug) for slug in game_app.GAME_TABLES)}")
+    db_path = game_app._game_tables[table_slug].db_path
+    if not os.path.exists(db_path): sys.exit(f"БД {db_path} не найдена.")
+    source = sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True); source.row_factory = sqlite3.Row
+    schema_version = source.execute("PRAGMA user_version").fetchone()[0]
+    if schema_version < len(game_app.SCHEMA_MIGRATIONS): sys.exit(f"Схема {db_path} устарела ({schema_version} из {len(game_app.SCHEMA_MIGRATIONS)}): сначала запустите приложение.")
+    return source
+
+
+def copy_database(source, target_path=':memory:'):
+    """Копия БД через backup API (согласованный снимок даже во время игры)."""
+    target = sqlite3.connect(target_path); target.row_factory = sqlite3.Row
+    source.backup(target)
+    return target
+
+
+def game_state(db_conn):
+    return json.loads(zlib.decompress(game_app.dump_game_state(db_conn)))
+
+
+def verify(source):
+    """Восстанавливает копию из журнала и сравнивает с живыми таблицами. Возвращает True, если совпало."""
+    copy = copy_database(source)
+    started = time.perf_counter()
+    rebuilt = game_app.rebuild_game_state(copy)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if rebuilt is None: print("Replay: В журнале нет снимков.", file=sys.stderr); return False
+    expected, actual = game_state(source), game_state(copy)
+    mismatched = [key for key in expected if expected[key] != actual[key]]
+    print(f"Replay: Снимок после события {rebuilt[0]}, повторено событий: {rebuilt[1]}, восстановление {elapsed_ms:.1f} мс.", file=sys.stderr)
+    print(f"Replay: {'Совпадает с таблицами.' if not mismatched else 'РАСХОЖДЕНИЯ: ' + ', '.join(mismatched)}", file=sys.stderr)
+    return not mismatched
+
+
+def replay(source):
+    """Весь журнал с первого снимка: перед каждым 'score' очки пересчитываются score_round и сверяются с записанными,
+    после каждого события строятся состояния всех игроков кодом рассылки. Возвращает True, если подсчет совпал везде."""
+    first = source.execute("SELECT event_id, state FROM game_snapshots ORDER BY event_id LIMIT 1").fetchone()
+    if first is None: print("Replay: В журнале нет снимков.", file=sys.stderr); return False
+    work_dir = tempfile.mkdtemp(prefix='replay-')
+    try:
+        copy_database(source, os.path.join(work_dir, 'replay.db')).close()
+        game_app._game_tables['_replay'] = game_app.GameTable('_replay', db_path=os.path.join(work_dir, 'replay.db'))
+        events = scored = mismatches = 0; apply_ms = build_ms = max_build_ms = 0.0
+        with game_app.table_context('_replay'):
+            db = game_app.get_db()
+            game_app.restore_game_state(db, first['state']); db.commit()
+            for event_id, _, kind, data, snapshot in game_app.iter_game_events(source, first['event_id']):
+                if kind == game_app.EVENT_SCORE:
+                    players, result = game_app.score_current_round(db)
+                    expected = {user_id: rating for user_id, rating in result['ratings'].items() if rating != players[user_id]} if players else {}
+                    recorded = {int(user_id): rating for user_id, rating in data['r'].items()}
+                    scored += 1
+                    if expected != recorded: mismatches += 1; print(f"Replay: Событие {event_id}: подсчет дал {expected}, записано {recorded}", file=sys.stderr)
+                started = time.perf_counter()
+                db.execute("BEGIN IMMEDIATE"); game_app.apply_game_event(db, kind, data, snapshot); game_app.advance_round_version(db); db.commit()
+                game_app.bump_settings_version(); game_app.invalidate_users_cache()
+                apply_ms += (time.perf_counter() - started) * 1000
+                # Одна рассылка на событие: общий снимок и персональные состояния всех игроков, как во flush_game_state_broadcast
+                started = time.perf_counter()
+                snapshot_state = game_app.get_shared_game_state_snapshot(db)
+                for user_code in snapshot_state['users_by_code']: game_app.get_full_game_state_data(user_code_for_state=user_code, snapshot=snapshot_state)
+                elapsed_ms = (time.perf_counter() - started) * 1000; build_ms += elapsed_ms; max_build_ms = max(max_build_ms, elapsed_ms)
+                events += 1
+        print(f"Replay: Событий: {events}, применение {apply_ms:.1f} мс; рассылка: в среднем {build_ms / max(events, 1):.2f} мс, максимум {max_build_ms:.2f} мс.", file=sys.stderr)
+        print(f"Replay: Подсчетов очков: {scored}, расхождений: {mismatches}.", file=sys.stderr)
+        return mismatches == 0
+    finally:
+        game_app._game_tables.pop('_replay', None)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def restore(source, out_path, upto_event_id=None):
+    """Новая БД OUT с состоянием на момент события upto_event_id (по умолчанию - последнего); журнал в ней обрезан там же."""
+    if os.path.exists(out_path): sys.exit(f"Файл {out_path} уже существует.")
+    target = copy_database(source, out_path); completed = False
+    try:
+        rebuilt = game_app.rebuild_game_state(target, upto_event_id)
+        if rebuilt is None: sys.exit("В журнале нет снимков.")
+        if upto_event_id is not None:
+            target.execute("DELETE FROM game_snapshots WHERE event_id > ?", (upto_event_id,)); target.execute("DELETE FROM game_events WHERE id > ?", (upto_event_id,))
+        target.execute("UPDATE game_round SET version = version + 1 WHERE id = 1") # Процессы со старой копией раунда в памяти перечитают ее
+        target.commit(); completed = True
+        print(f"Replay: {out_path}: снимок после события {rebuilt[0]} и {rebuilt[1]} событий.", file=sys.stderr)
+    finally:
+        target.close()
+        if not completed: # Недописанный OUT не оставляем
+            for path in (out_path, out_path + '-wal', out_path + '-shm'):
+                if os.path.exists(path): os.remove(path)
+
+
+def export(source, out=sys.stdout):
+    for event_id, at, kind, data, _ in game_app.iter_game_events(source):
+        out.write(json.dumps({'id': event_id, 'at': at, 'kind': kind, 'data': data}, ensure_ascii=False, separators=(',', ':')) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Повтор и восстановление игры по журналу событий.")
+    parser.add_argument('command', choices=['verify', 'replay', 'restore', 'export'])
+    parser.add_argument('out', nargs='?', help="Файл новой БД для restore")
+    parser.add_argument('--table', default='', help="Стол (по умолчанию основной)")
+    parser.add_argument('--upto', type=int, help="Для restore: последнее учитываемое событие")
+    args = parser.parse_args()
+    source_db = open_source(args.table)
+    if args.command == 'verify': sys.exit(0 if verify(source_db) else 1)
+    elif args.command == 'replay': sys.exit(0 if replay(source_db) else 1)
+    elif args.command == 'restore':
+        if not args.out: parser.error("restore: укажите файл OUT.db")
+        restore(source_db, args.out, args.upto)
+    else: export(source_db)
@@ -0,0 +1,108 @@
+"""Уменьшенные WebP-варианты карт колод для руки, стола и админки.
+
+Оригиналы в static/images/<колода> остаются как есть (их показывает увеличенный просмотр).
+Варианты лежат в static/variants/<xx>/<sha1>-<вариант>.webp: имя зависит только от содержимого
+исходного файла, поэтому одинаковые картинки в разных колодах делят один файл, а измененная
+картинка получает новый URL. manifest.json хранит для каждого файла колоды размер, mtime и пути
+вариантов - повторный запуск пересчитывает только новые и измененные файлы.
+
+Сборка (офлайн, например на этапе build):  python image_variants.py [колода ...]
+Без Pillow сборка пропускается, а приложение отдает оригиналы.
+"""
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try: from PIL import Image
+except ImportError: Image = None
+
+VARIANTS = {'thumb': 200, 'card': 400}  # Имя варианта -> ширина в пикселях (меньшие картинки не увеличиваются)
+VARIANT_QUALITY = 80
+VARIANTS_SUBFOLDER = 'variants'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+
+_manifest_cache = {'stamp': None, 'entries': {}}  # Разобранный manifest.json текущего процесса
+
+
+def manifest_path(static_folder): return os.path.join(static_folder, VARIANTS_SUBFOLDER, 'manifest.json')
+
+
+def make_variants(job):
+    """Рабочая функция пула: (ключ 'колода/файл', путь к оригиналу, static) -> (ключ, запись манифеста)."""
+    key, source_path, static_folder = job
+    with open(source_path, 'rb') as f: digest = hashlib.sha1(f.read()).hexdigest()
+    stat = os.stat(source_path)
+    entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': digest, 'variants': {}}
+    with Image.open(source_path) as original:
+        original = original.convert('RGB')
+        for variant, width in VARIANTS.items():
+            relative_path = '/'.join((VARIANTS_SUBFOLDER, digest[:2], f"{digest}-{variant}.webp"))
+            target_path = os.path.join(static_folder, *relative_path.split('/'))
+            if not os.path.exists(target_path):
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                resized = original.copy(); resized.thumbnail((width, width * 4))
+                tmp_path = f"{target_path}.{os.getpid()}.tmp"
+                resized.save(tmp_path, 'WEBP', quality=VARIANT_QUALITY, method=4); os.replace(tmp_path, target_path)
+            entry['variants'][variant] = relative_path
+    return key, entry
+
+
+def build_variants(static_folder, decks, processes=None):
+    """Создает недостающие варианты для колод параллельно (по процессу на ядро). Возвращает число обработанных файлов."""
+    if Image is None: print("Image variants: Pillow не установлен, варианты не создаются.", file=sys.stderr); return 0
+    started = time.perf_counter()
+    path = manifest_path(static_folder)
+    try:
+        with open(path, encoding='utf-8') as f: manifest = json.load(f)
+    except (OSError, ValueError): manifest = {}
+    jobs = []; known_keys = set()
+    for deck in decks:
+        deck_path = os.path.join(static_folder, 'images', deck)
+        if not os.path.isdir(deck_path): print(f"Image variants: Folder not found: {deck_path}", file=sys.stderr); continue
+        for filename in sorted(os.listdir(deck_path)):
+            if not filename.lower().endswith(IMAGE_EXTENSIONS): continue
+            key = f"{deck}/{filename}"; source_path = os.path.join(deck_path, filename); known_keys.add(key)
+            stat = os.stat(source_path); entry = manifest.get(key)
+            if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns and set(entry['variants']) == set(VARIANTS) \
+                    and all(os.path.exists(os.path.join(static_folder, *p.split('/'))) for p in entry['variants'].values()): continue
+            jobs.append((key, source_path, static_folder))
+    if jobs:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for key, entry in pool.map(make_variants, jobs, chunksize=8): manifest[key] = entry
+    # Записи удаленных файлов из обработанных колод убираем; файлы вариантов остаются (их могут делить другие колоды)
+    manifest = {key: entry for key, entry in manifest.items() if key.split('/', 1)[0] not in decks or key in known_keys}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f: json.dump(manifest, f, ensure_ascii=False, sort_keys=True)
+    os.replace(path + '.tmp', path)
+    print(f"Image variants: {len(jobs)} of {len(known_keys)} files processed in {(time.perf_counter() - started):.1f} s.", file=sys.stderr)
+    return len(jobs)
+
+
+def get_manifest(static_folder):
+    """manifest.json из кэша процесса; перечитывается, когда файл меняется (например, после сборки)."""
+    path = manifest_path(static_folder)
+    try: stat = os.stat(path); stamp = (stat.st_ino, stat.st_mtime_ns)
+    except OSError: stamp = None
+    if stamp != _manifest_cache['stamp']:
+        entries = {}
+        if stamp is not None:
+            try:
+                with open(path, encoding='utf-8') as f: entries = json.load(f)
+            except (OSError, ValueError) as e: print(f"Image variants: Cannot read manifest: {e}", file=sys.stderr)
+        _manifest_cache.update(stamp=stamp, entries=entries)
+    return _manifest_cache['entries']
+
+
+def variant_path(static_folder, subfolder, image, variant):
+    """Путь варианта относительно static или оригинал, если вариант еще не собран."""
+    entry = get_manifest(static_folder).get(f"{subfolder}/{image}")
+    return entry['variants'].get(variant) if entry and variant in entry['variants'] else f"images/{subfolder}/{image}"
+
+
+if __name__ == "__main__":
+    static_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    selected_decks = sys.argv[1:] or sorted(d for d in os.listdir(os.path.join(static_root, 'images')) if os.path.isdir(os.path.join(static_root, 'images', d)) and d not in ('pole', 'rules'))
+    build_variants(static_root, selected_decks)
@@ -0,0 +1,86 @@
+"""Подсчет очков раунда без обращения к БД.
+
+score_round() получает снимок раунда (рейтинги активных игроков, ведущий, карты на столе,
+предположения) и за один проход возвращает новые рейтинги. Применение результата
+(UPDATE users) остается на вызывающем коде.
+"""
+
+LEADER_GUESSED_BY_ALL = 'all'
+LEADER_GUESSED_BY_NONE = 'none'
+LEADER_GUESSED_BY_SOME = 'some'
+
+
+def score_round(players, leader_id, table_cards, guesses, names=None):
+    """Считает очки раунда.
+
+    players     - {user_id: rating} активных игроков;
+    leader_id   - ID ведущего или None;
+    table_cards - [(card_id, owner_id), ...] карты на столе;
+    guesses     - {card_id: {guesser_id: guessed_owner_id}};
+    names       - необязательный {user_id: name}, только для текста в 'log'.
+
+    Возвращает dict: 'ratings' {user_id: new_rating} для всех активных игроков,
+    'changes' {user_id: delta}, 'leader_outcome' (LEADER_GUESSED_BY_* или None), 'log' [str].
+    """
+    names = names or {}
+    name = lambda uid: names.get(uid) or f"ID {uid}"
+    log = []
+    changes = {user_id: 0 for user_id in players}
+    leader_is_active = leader_id in players
+    total_other_active_players = len(players) - (1 if leader_is_active else 0)
+
+    leader_card_id = None
+    if leader_is_active:
+        leader_card_id = next((card_id for card_id, owner_id in table_cards if owner_id == leader_id), None)
+    elif leader_id is not None:
+        log.append(f"Warning: Current leader ID {leader_id} is not in active users. Cannot find leader card on table.")
+
+    # --- Анализ предположений относительно карты ведущего ---
+    correct_guesser_ids_for_leader = []
+    leader_outcome = None
+    if leader_card_id is not None:
+        correct_guesser_ids_for_leader = [guesser_id for guesser_id, guessed_owner_id in guesses.get(leader_card_id, {}).items()
+                                          if guesser_id in players and guesser_id != leader_id and guessed_owner_id == leader_id]
+        correct_count = len(correct_guesser_ids_for_leader)
+        if total_other_active_players > 0 and correct_count == total_other_active_players:
+            # Правило 1: карточку ведущего угадали все - ведущий теряет 3 балла (не ниже 1), остальные очки не начисляются
+            new_leader_rating = max(1, players[leader_id] - 3)
+            changes[leader_id] = new_leader_rating - players[leader_id]
+            log.append(f"Ведущий ({name(leader_id)}) угадан ВСЕМИ ({correct_count} из {total_other_active_players} других игроков). Рейтинг изменен с {players[leader_id]} на {new_leader_rating}. Дальнейший подсчет очков пропускается.")
+            ratings = dict(players); ratings[leader_id] = new_leader_rating
+            return {'ratings': ratings, 'changes': changes, 'leader_outcome': LEADER_GUESSED_BY_ALL, 'log': log}
+        if total_other_active_players > 0 and correct_count == 0:
+            # Правило 2.1: карточку ведущего никто не угадал - ведущий теряет 2 балла
+            leader_outcome = LEADER_GUESSED_BY_NONE
+            changes[leader_id] -= 2
+            log.append(f"Ведущий ({name(leader_id)}) не угадан НИКЕМ (0 из {total_other_active_players} других игроков). Ведущий теряет 2 очка.")
+        elif correct_count > 0:
+            leader_outcome = LEADER_GUESSED_BY_SOME
+    elif leader_is_active:
+        log.append(f"Ведущий ({name(leader_id)}) - особый случай (нет других игроков/нет карты). Специальные правила ведущего не применяются.")
+    elif leader_id is None:
+        log.append("Warning: No current leader defined. Cannot apply leader scoring rules.")
+
+    # Правило 2.2 (часть 1): владелец получает +1 за каждого угадавшего его карту,
+    # угадавший получает +1 за любую верно угаданную карту, кроме карты ведущего.
+    for card_id, card_owner_id in table_cards:
+        if card_owner_id not in players: continue
+        correct_guessers = [guesser_id for guesser_id, guessed_owner_id in guesses.get(card_id, {}).items()
+                            if guesser_id in players and guesser_id != card_owner_id and guessed_owner_id == card_owner_id]
+        if card_owner_id != leader_id:
+            for guesser_id in correct_guessers: changes[guesser_id] += 1
+        if correct_guessers:
+            changes[card_owner_id] += len(correct_guessers)
+            log.append(f"Игрок {name(card_owner_id)} (владелец карты {card_id}) получил +{len(correct_guessers)} очков (Rule 2.2 part 1).")
+
+    # Правило 2.2 (часть 2): +3 каждому, кто угадал карту ведущего
+    for guesser_id in correct_guesser_ids_for_leader: changes[guesser_id] += 3
+
+    # Правило 2.3: ведущий получает +3, если его карту угадали не все и не никто
+    if leader_outcome == LEADER_GUESSED_BY_SOME:
+        changes[leader_id] += 3
+        log.append(f"Ведущий ({name(leader_id)}) угадан SOME ({len(correct_guesser_ids_for_leader)} игроков). Получает +3 очка (Rule 2.3).")
+
+    # Рейтинг не падает ниже 1
+    ratings = {user_id: max(1, rating + changes[user_id]) for user_id, rating in players.items()}
+    return {'ratings': ratings, 'changes': changes, 'leader_outcome': leader_outcome, 'log': log}
@@ -0,0 +1,69 @@
+"""Отпечатки файлов static/ для URL с долгим кэшем и заранее сжатые текстовые ассеты.
+
+URL вида /static/<файл>?v=<отпечаток> меняется вместе с содержимым файла, поэтому браузер может
+хранить его бессрочно (Cache-Control: immutable) и не перепроверять при каждом раунде.
+Сжатые копии (<файл>.gz, <файл>.br) создаются офлайн:  python static_assets.py
+Для .br нужен пакет brotli; без него создаются только .gz.
+"""
+import gzip
+import hashlib
+import os
+import sys
+
+try: import brotli
+except ImportError: brotli = None
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+PRECOMPRESSED_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))  # В порядке предпочтения
+
+_fingerprint_cache = {}  # {путь: (размер, mtime_ns, отпечаток)} - файл перечитывается только после изменения
+
+
+def file_fingerprint(static_folder, filename):
+    """Короткий SHA-1 содержимого файла из static или None, если файла нет."""
+    path = os.path.join(static_folder, filename)
+    try: stat = os.stat(path)
+    except OSError: return None
+    cached = _fingerprint_cache.get(path)
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns: return cached[2]
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''): digest.update(chunk)
+    fingerprint = digest.hexdigest()[:12]
+    _fingerprint_cache[path] = (stat.st_size, stat.st_mtime_ns, fingerprint)
+    return fingerprint
+
+
+def pick_precompressed(static_folder, filename, accept_encoding):
+    """(имя сжатой копии, Content-Encoding) для текстового ассета, если клиент ее примет и она не старее оригинала; иначе None."""
+    if not filename.lower().endswith(COMPRESSIBLE_EXTENSIONS): return None
+    accepted = {part.split(';', 1)[0].strip().lower() for part in (accept_encoding or '').split(',')}
+    path = os.path.join(static_folder, filename)
+    for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+        if encoding not in accepted: continue
+        try:
+            if os.stat(path + suffix).st_mtime_ns >= os.stat(path).st_mtime_ns: return filename + suffix, encoding
+        except OSError: continue
+    return None
+
+
+def precompress_static(static_folder):
+    """Создает .gz (и .br, если есть brotli) рядом с текстовыми ассетами; свежие копии не пересоздаются."""
+    written = 0
+    for root, _, filenames in os.walk(static_folder):
+        for filename in filenames:
+            if not filename.lower().endswith(COMPRESSIBLE_EXTENSIONS): continue
+            path = os.path.join(root, filename)
+            with open(path, 'rb') as f: data = f.read()
+            for suffix, compress in (('.gz', lambda d: gzip.compress(d, 9, mtime=0)), ('.br', brotli.compress if brotli else None)):
+                if compress is None: continue
+                target = path + suffix
+                if os.path.exists(target) and os.stat(target).st_mtime_ns >= os.stat(path).st_mtime_ns: continue
+                with open(target + '.tmp', 'wb') as f: f.write(compress(data))
+                os.replace(target + '.tmp', target); written += 1
+    print(f"Static assets: {written} precompressed files written{'' if brotli else ' (brotli не установлен, только gzip)'}.", file=sys.stderr)
+    return written
+
+
+if __name__ == "__main__":
+    precompress_static(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
@@ -0,0 +1,18 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def game_app(tmp_path_factory):
+    """Модуль app с БД во временной папке (DB_PATH относительный) и без очереди сообщений."""
+    previous_cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('db'))
+    os.environ.update(GAME_TABLES='', SOCKETIO_ASYNC_MODE='threading')
+    os.environ.pop('SOCKETIO_MESSAGE_QUEUE', None)
+    try: yield importlib.import_module('app')
+    finally: os.chdir(previous_cwd)
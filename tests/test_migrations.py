@@ -0,0 +1,48 @@
+import json
+import sqlite3
+
+
+def create_baseline_database(path):
+    """БД в том виде, как ее создавал init_db до миграций: строковый images.status и JSON в images.guesses."""
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, code TEXT UNIQUE NOT NULL, rating INTEGER DEFAULT 0, status TEXT DEFAULT 'pending' NOT NULL);
+        CREATE TABLE images (id INTEGER PRIMARY KEY AUTOINCREMENT, subfolder TEXT NOT NULL, image TEXT NOT NULL, status TEXT, owner_id INTEGER, guesses TEXT DEFAULT '{}');
+        CREATE TABLE settings (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE deck_votes (subfolder TEXT PRIMARY KEY, votes INTEGER DEFAULT 0);
+    """)
+    conn.executemany("INSERT INTO users (id, name, code, rating, status) VALUES (?, ?, ?, ?, 'active')", [(1, 'alice', 'code-a', 4), (2, 'bob', 'code-b', 2), (3, 'carol', 'code-c', 0)])
+    conn.executemany("INSERT INTO images (id, subfolder, image, status, guesses) VALUES (?, 'ariadna', ?, ?, ?)", [
+        (1, '2_image_01.jpg', 'Занято:1', '{}'),
+        (2, '2_image_02.jpg', 'Занято:3', '{}'),
+        (3, '2_image_03.jpg', 'На столе:1', '{"2": 1, "3": 2}'),
+        (4, '2_image_04.jpg', 'На столе:2', '{"1": 2}'),
+        (5, '2_image_05.jpg', 'Занято:Админ', '{}'),
+        (6, '2_image_06.jpg', 'Свободно', '{}'),
+    ])
+    conn.executemany("REPLACE INTO settings (key, value) VALUES (?, ?)", [('game_over', 'false'), ('game_in_progress', 'true'), ('show_card_info', 'false'), ('leading_user_id', '1'), ('active_subfolder', 'ariadna')])
+    conn.commit(); conn.close()
+
+
+def test_baseline_database_survives_all_migrations(game_app, tmp_path, monkeypatch):
+    db_path = str(tmp_path / 'legacy.db')
+    create_baseline_database(db_path)
+    table = game_app.GameTable('legacy', db_path)
+    monkeypatch.setitem(game_app._game_tables, 'legacy', table)
+    game_app.init_db(table)
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(game_app.SCHEMA_MIGRATIONS) == 7
+    cards = {row[0]: row[1:] for row in conn.execute("SELECT id, state, owner_id FROM images WHERE id <= 6")}
+    assert cards == {1: ('hand', 1), 2: ('hand', 3), 3: ('table', 1), 4: ('table', 2), 5: ('discard', None), 6: ('free', None)}
+    assert sorted(conn.execute("SELECT image_id, guesser_id, guessed_owner_id FROM guesses")) == [(3, 2, 1), (3, 3, 2), (4, 1, 2)]
+    assert json.loads(conn.execute("SELECT value FROM settings WHERE key = 'board_layout'").fetchone()[0])
+    conn.close()
+
+    # Повторный старт ничего не меняет
+    game_app.init_db(table)
+    with game_app.table_context('legacy'):
+        snapshot = game_app.get_shared_game_state_snapshot(game_app.get_db())
+    assert {owner_id: [card['id'] for card in hand] for owner_id, hand in snapshot['hands'].items()} == {1: [1], 3: [2]}
+    assert {card['id']: card['guesses'] for card in snapshot['table_cards']} == {3: {'2': 1, '3': 2}, 4: {'1': 2}}
+    assert snapshot['board_layout'] and len(snapshot['game_board']) == len(snapshot['board_layout'])
@@ -0,0 +1,88 @@
+import random
+
+from scoring import LEADER_GUESSED_BY_ALL, score_round
+
+
+def legacy_score_round(players, leader_id, table_cards, guesses):
+    """Порт прежнего подсчета из open_cards (до scoring.py) без БД и логов: новые рейтинги {user_id: rating}.
+    None - раунд, на котором старый код падал с NameError (ведущий активен, но его карты нет на столе)."""
+    active_user_ids = list(players)
+    leader_card_on_table = None
+    if leader_id in active_user_ids:
+        leader_card_on_table = next((card for card in table_cards if card[1] == leader_id), None)
+    rating_changes = {user_id: 0 for user_id in active_user_ids}
+    leader_was_correctly_guessed_by_all_others = leader_was_guessed_by_none_others = False
+    correct_guesser_ids_for_leader = []
+    total_other_active_players = len(players) - (1 if leader_id in players else 0)
+    correct_leader_guesses_count_by_others = None # В старом коде переменная появлялась только при карте ведущего на столе
+
+    if leader_card_on_table and leader_id in players:
+        for guesser_id, guessed_owner_id in guesses.get(leader_card_on_table[0], {}).items():
+            if guesser_id in active_user_ids and guesser_id != leader_id and guessed_owner_id == leader_id: correct_guesser_ids_for_leader.append(guesser_id)
+        correct_leader_guesses_count_by_others = len(correct_guesser_ids_for_leader)
+        if total_other_active_players > 0 and correct_leader_guesses_count_by_others == total_other_active_players:
+            ratings = dict(players); ratings[leader_id] = max(1, players[leader_id] - 3)
+            return ratings # Ранний выход: остальные очки не начислялись
+        elif correct_leader_guesses_count_by_others == 0 and total_other_active_players > 0:
+            leader_was_guessed_by_none_others = True
+            rating_changes[leader_id] -= 2
+
+    for card_id, card_owner_id in table_cards:
+        if card_owner_id not in active_user_ids: continue
+        guessed_by_this_card_count = 0
+        for guesser_id, guessed_owner_id in guesses.get(card_id, {}).items():
+            if guesser_id in active_user_ids and guesser_id != card_owner_id and guessed_owner_id == card_owner_id:
+                guessed_by_this_card_count += 1
+                if card_owner_id != leader_id and guesser_id in rating_changes: rating_changes[guesser_id] += 1
+        if guessed_by_this_card_count > 0: rating_changes[card_owner_id] += guessed_by_this_card_count
+
+    for guesser_id in correct_guesser_ids_for_leader:
+        if guesser_id in rating_changes: rating_changes[guesser_id] += 3
+
+    if leader_id in players and not leader_was_correctly_guessed_by_all_others and not leader_was_guessed_by_none_others:
+        if correct_leader_guesses_count_by_others is None: return None # NameError в старом коде
+        if 0 < correct_leader_guesses_count_by_others < total_other_active_players: rating_changes[leader_id] += 3
+
+    return {user_id: max(1, rating + rating_changes[user_id]) for user_id, rating in players.items()}
+
+
+def random_round(rng):
+    """Случайный раунд: активные игроки, ведущий (бывает неактивным или не задан), карты части игроков и неактивных,
+    предположения от активных и неактивных игроков, в том числе о неактивных владельцах."""
+    player_ids = rng.sample(range(1, 30), rng.randint(1, 8))
+    players = {user_id: rng.randint(0, 45) for user_id in player_ids}
+    inactive_ids = [user_id for user_id in range(30, 34) if rng.random() < 0.3]
+    leader_id = rng.choice(player_ids + inactive_ids + [None] * (1 if rng.random() < 0.1 else 0))
+    owners = [user_id for user_id in player_ids + inactive_ids if rng.random() < 0.9]
+    table_cards = [(100 + index, owner_id) for index, owner_id in enumerate(owners)]
+    everyone = player_ids + inactive_ids
+    guesses = {}
+    for card_id, owner_id in table_cards:
+        for guesser_id in everyone:
+            if rng.random() < 0.7:
+                # Перекос к верной догадке, чтобы чаще выпадали случаи «угадали все» и «не угадал никто»
+                guesses.setdefault(card_id, {})[guesser_id] = owner_id if rng.random() < 0.5 else rng.choice(everyone)
+    return players, leader_id, table_cards, guesses
+
+
+def test_score_round_matches_legacy_rules_on_random_rounds():
+    rng = random.Random(20240611)
+    compared = legacy_failures = 0
+    for _ in range(20000):
+        players, leader_id, table_cards, guesses = random_round(rng)
+        expected = legacy_score_round(players, leader_id, table_cards, guesses)
+        result = score_round(players, leader_id, table_cards, guesses)
+        if expected is None:
+            # Единственное расхождение: старый код падал, движок считает остальные правила
+            assert leader_id in players and all(owner_id != leader_id for _, owner_id in table_cards)
+            legacy_failures += 1; continue
+        assert result['ratings'] == expected, (players, leader_id, table_cards, guesses)
+        assert result['changes'].keys() == players.keys()
+        compared += 1
+    assert compared > 15000 and legacy_failures > 0
+
+
+def test_leader_guessed_by_all_only_changes_leader():
+    result = score_round({1: 10, 2: 5, 3: 2}, 1, [(11, 1), (12, 2), (13, 3)], {11: {2: 1, 3: 1}, 12: {3: 2}})
+    assert result['leader_outcome'] == LEADER_GUESSED_BY_ALL
+    assert result['ratings'] == {1: 7, 2: 5, 3: 2}
@@ -0,0 +1,75 @@
+import time
+
+import pytest
+
+
+class FakePipeline:
+    """Пайплайн: команды копятся и выполняются по execute() одна за другой."""
+    def __init__(self, client): self.client, self.commands = client, []
+    def __getattr__(self, name): return lambda *args: self.commands.append((name, args))
+    def execute(self): return [getattr(self.client, name)(*args) for name, args in self.commands]
+
+
+class FakeRedis:
+    """Подмножество команд redis, которым пользуется реестр сокетов (decode_responses=True)."""
+    def __init__(self): self.data = {}
+    def pipeline(self): return FakePipeline(self)
+    def delete(self, key): return 1 if self.data.pop(key, None) is not None else 0
+    def get(self, key): return None if self.data.get(key) is None else str(self.data[key])
+    def incr(self, key): self.data[key] = int(self.data.get(key, 0)) + 1; return self.data[key]
+    def hset(self, key, field, value): self.data.setdefault(key, {})[field] = value
+    def hget(self, key, field): return self.data.get(key, {}).get(field)
+    def hdel(self, key, *fields): return sum(1 for field in fields if self.data.get(key, {}).pop(field, None) is not None)
+    def hkeys(self, key): return list(self.data.get(key, {}))
+    def hgetall(self, key): return dict(self.data.get(key, {}))
+    def sadd(self, key, member): self.data.setdefault(key, set()).add(member)
+    def srem(self, key, member): self.data.get(key, set()).discard(member)
+    def smembers(self, key): return set(self.data.get(key, set()))
+    def zadd(self, key, mapping): self.data.setdefault(key, {}).update(mapping)
+    def zrem(self, key, member): self.data.get(key, {}).pop(member, None)
+    def zrange(self, key, start, end): return sorted(self.data.get(key, {}), key=self.data.get(key, {}).get)
+    def zrangebyscore(self, key, low, high): return [member for member in self.zrange(key, 0, -1) if low <= self.data[key][member] <= high]
+
+
+@pytest.fixture
+def registry(game_app, monkeypatch):
+    client = FakeRedis()
+    monkeypatch.setitem(game_app._socket_registry, 'client', client)
+    monkeypatch.setitem(game_app._socket_registry, 'heartbeat_started', True) # Без фоновой задачи отметки в тесте
+    monkeypatch.setitem(game_app._socket_registry, 'pruned_at', {})
+    with game_app.table_context(''): yield client
+
+
+def test_register_and_unregister(game_app, registry):
+    game_app.register_socket('sid-1', 'alice'); game_app.register_socket('sid-2', '')
+    assert sorted(game_app.get_connected_sockets()) == [('sid-1', 'alice'), ('sid-2', '')]
+    assert game_app.get_socket_user_code('sid-1') == 'alice'
+    assert game_app.unregister_socket('sid-1') == 'alice'
+    assert game_app.get_connected_sockets() == [('sid-2', '')]
+    prefix = game_app.current_table().registry_prefix
+    assert registry.smembers(prefix + 'worker:' + game_app.registry_worker_id()) == {'sid-2'}
+
+
+def test_sockets_of_dead_workers_are_pruned(game_app, registry):
+    prefix = game_app.current_table().registry_prefix
+    game_app.register_socket('sid-live', 'alice')
+    # Воркер, упавший давно: его sid в общем списке, отметка старше TTL
+    registry.hset(prefix + 'sids', 'sid-dead', 'bob'); registry.sadd(prefix + 'worker:dead', 'sid-dead')
+    registry.zadd(prefix + 'workers', {'dead': time.time() - game_app.SOCKET_REGISTRY_TTL - 1})
+    registry.hset(prefix + 'sids', 'sid-orphan', 'carol') # Без воркера вовсе (записан до появления отметок)
+    assert game_app.get_connected_sockets() == [('sid-live', 'alice')]
+    assert 'dead' not in registry.zrange(prefix + 'workers', 0, -1) and prefix + 'worker:dead' not in registry.data
+
+
+def test_state_version_is_shared_through_registry(game_app, registry):
+    first = game_app.next_game_state_version()
+    assert game_app.next_game_state_version() == first + 1 == game_app.current_game_state_version()
+
+
+def test_in_memory_fallback(game_app, monkeypatch):
+    monkeypatch.setitem(game_app._socket_registry, 'client', None)
+    with game_app.table_context(''):
+        game_app.register_socket('sid-local', 'dave')
+        assert ('sid-local', 'dave') in game_app.get_connected_sockets()
+        assert game_app.unregister_socket('sid-local') == 'dave'
+        assert ('sid-local', 'dave') not in game_app.get_connected_sockets()